@@ -0,0 +1,230 @@
+#######################
+# Ingest benchmark for update_logs.py
+# Measures discovery, header parsing, grouping and upload on a synthetic
+# archive and writes the results as json
+#######################
+
+
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import argparse
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import update_logs
+from benchmarks.synthetic_archive import make_archive
+
+TELESCOPE_NAME = 'BENCH'
+
+
+def measure(results, stage, func, unit='files'):
+    start = time.perf_counter()
+    items = func()
+    seconds = time.perf_counter() - start
+    results[stage] = {
+        'seconds': round(seconds, 6),
+        'items': items,
+        'unit': unit,
+        'rate': round(items / seconds, 2) if seconds else None,
+    }
+    print(f'{stage:>24}: {items} {unit} in {seconds:.3f} s '
+          f'({results[stage]["rate"]} {unit}/s)')
+    return results[stage]
+
+
+def read_frames(files, workers, manifest=None):
+    if workers <= 1:
+        return list(update_logs.iter_folder_frames(files, None, manifest))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(update_logs.iter_folder_frames(
+            files, executor, manifest, workers))
+
+
+def bench_upload(results, grouped, bulk_size, upload_workers):
+    # Targets go to a live Django server with a test database, as in
+    # LiveServerTestCase. Needs DJANGO_SETTINGS_MODULE
+    import django
+    os.environ.setdefault(
+        'DJANGO_SETTINGS_MODULE', 'observatory_logs.settings')
+    django.setup()
+    from django.contrib.auth.models import User
+    from django.contrib.staticfiles.handlers import StaticFilesHandler
+    from django.db import connections
+    from django.test.testcases import LiveServerThread
+    from django.test.utils import (
+        setup_test_environment, teardown_test_environment)
+    from django.test.runner import DiscoverRunner
+    from objects_log.models import Telescope
+
+    setup_test_environment()
+    runner = DiscoverRunner(verbosity=0)
+    old_config = runner.setup_databases()
+    connections_override = {}
+    for conn in connections.all():
+        if conn.vendor == 'sqlite' and conn.is_in_memory_db():
+            conn.inc_thread_sharing()
+            connections_override[conn.alias] = conn
+    if connections_override:
+        # One shared sqlite connection, requests must not overlap
+        upload_workers = 1
+    server = LiveServerThread(
+        'localhost', StaticFilesHandler, connections_override)
+    server.daemon = True
+    server.start()
+    server.is_ready.wait()
+    try:
+        if server.error:
+            raise server.error
+        User.objects.create_user('bench', password='bench')
+        Telescope.objects.create(name=TELESCOPE_NAME)
+        url = f'http://localhost:{server.port}'
+        update_logs.config.update({
+            'UPLOAD_URL': f'{url}/targets/',
+            'REST_USER': 'bench',
+            'REST_PASSWORD': 'bench',
+        })
+
+        def upload():
+            uploader = update_logs.Uploader(max_workers=upload_workers)
+            try:
+                update_logs.send_data(grouped, uploader, bulk_size)
+                uploader.join()
+            finally:
+                uploader.close()
+            return sum(len(g) for g in grouped)
+
+        measure(results, 'upload', upload, 'targets')
+    finally:
+        server.terminate()
+        for conn in connections_override.values():
+            conn.dec_thread_sharing()
+        runner.teardown_databases(old_config)
+        teardown_test_environment()
+
+
+def compare(results, baseline_file, tolerance):
+    with open(baseline_file) as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    for stage, result in results.items():
+        old = baseline.get(stage)
+        if not old or not old['rate'] or not result['rate']:
+            continue
+        ratio = result['rate'] / old['rate']
+        print(f'{stage:>24}: {ratio:.2f}x of baseline')
+        if ratio < 1 - tolerance:
+            regressions.append(stage)
+    return regressions
+
+
+def run(args, archive):
+    results = {}
+    if not args.archive:
+        measure(results, 'generate', lambda: len(make_archive(
+            archive, args.nights, args.frames, args.objects,
+            args.formats.split(','), (args.size, args.size))))
+
+    files = []
+
+    def discover():
+        dirs = update_logs.get_dirs_to_walk(
+            archive, dt.datetime(1900, 1, 1), dt.datetime(2100, 1, 1))
+        files.extend(f for d in sorted(dirs)
+                     for f in update_logs.iter_files(d))
+        return len(files)
+
+    measure(results, 'discovery', discover)
+    measure(results, 'parse', lambda: len(read_frames(files, 1)))
+    if args.workers > 1:
+        measure(results, f'parse_workers_{args.workers}',
+                lambda: len(read_frames(files, args.workers)))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        manifest = update_logs.open_manifest(
+            os.path.join(tmp_dir, 'manifest.sqlite'))
+        measure(results, 'parse_manifest_fill',
+                lambda: len(read_frames(files, args.workers, manifest)))
+        measure(results, 'parse_manifest_cached',
+                lambda: len(read_frames(files, args.workers, manifest)))
+        manifest.close()
+
+    frames = read_frames(files, args.workers)
+    empty = update_logs.AliasDict()
+    rows = [update_logs.get_row(f, empty, empty, empty) for f in frames]
+    nights = {}
+    for row in rows:
+        nights.setdefault(os.path.dirname(row['path']), []).append(row)
+    grouped = []
+
+    def group():
+        grouped.extend(
+            update_logs.get_grouped_folder_data(
+                night_rows, TELESCOPE_NAME,
+                update_logs.get_visit_gap(args.visit_gap), args.with_frames)
+            for night_rows in nights.values())
+        return len(rows)
+
+    measure(results, 'grouping', group, 'frames')
+
+    if args.upload:
+        bench_upload(results, grouped, args.bulk_size, args.upload_workers)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-a", "--archive", type=str,
+        help="Existing archive to read. If none, a synthetic one is made")
+    parser.add_argument("-n", "--nights", type=int, default=2)
+    parser.add_argument("-f", "--frames", type=int, default=500,
+                        help="Frames per night of the synthetic archive")
+    parser.add_argument("-o", "--objects", type=int, default=20)
+    parser.add_argument("--formats", type=str, default='gz,bz2,fits')
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("-w", "--workers", type=int,
+                        default=os.cpu_count() or 1)
+    parser.add_argument("-g", "--visit_gap", type=float, default=60)
+    parser.add_argument("--with_frames", action='store_true')
+    parser.add_argument(
+        "-u", "--upload", action='store_true',
+        help="Upload targets to a live Django server with a test database")
+    parser.add_argument("-b", "--bulk_size", type=int, default=100)
+    parser.add_argument("-uw", "--upload_workers", type=int, default=4)
+    parser.add_argument("--output", type=str,
+                        help="Json file for the results")
+    parser.add_argument("--compare", type=str,
+                        help="Json file with results of an earlier run")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2,
+        help="Allowed relative drop of a rate before it is a regression")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = run(args, args.archive or tmp_dir)
+
+    report = {
+        'meta': {
+            'datetime': dt.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        if regressions:
+            print(f'Regressions: {", ".join(regressions)}')
+            sys.exit(1)
@@ -0,0 +1,117 @@
+#######################
+# Synthetic FITS archive for benchmarks
+# Writes date directories in the layout read by update_logs.py
+#######################
+
+
+import os
+import gzip
+import bz2
+import random
+import argparse
+import datetime as dt
+import astropy.io.fits as fits
+
+FITS_BLOCK = 2880
+FORMATS = {
+    'fits': ('.fits', open),
+    'gz': ('.fits.gz', lambda f, mode: gzip.open(f, mode, compresslevel=1)),
+    'bz2': ('.fits.bz2', lambda f, mode: bz2.open(f, mode, compresslevel=1)),
+}
+FILTERS = ['U', 'B', 'V', 'R', 'I']
+OBSERVERS = ['ABC', 'DEF', 'GHI', 'JKL']
+CALIBRATIONS = ['bias', 'dark', 'flat']
+
+
+def pad(data):
+    return data + b'\0' * (-len(data) % FITS_BLOCK)
+
+
+def get_header(obs_datetime, object_name, observers, color_filter, exptime,
+               shape, index):
+    hdr = fits.Header()
+    hdr['SIMPLE'] = True
+    hdr['BITPIX'] = 16
+    hdr['NAXIS'] = 2
+    hdr['NAXIS1'] = shape[0]
+    hdr['NAXIS2'] = shape[1]
+    hdr['BZERO'] = 32768
+    hdr['DATE-OBS'] = (obs_datetime.strftime('%Y-%m-%d'), 'UT date')
+    hdr['TIME-OBS'] = (obs_datetime.strftime('%H:%M:%S.%f'), 'UT time')
+    hdr['OBJECT'] = object_name
+    hdr['OBSERVER'] = ' '.join(observers)
+    hdr['FILTER'] = color_filter
+    hdr['EXPTIME'] = (exptime, 'Exposure time [s]')
+    hdr['CCD-TEMP'] = (round(-25 + random.random(), 2), 'CCD temperature [C]')
+    hdr['IMAGETYP'] = (
+        object_name if object_name in CALIBRATIONS else 'object')
+    hdr['RA'] = f'{random.randint(0, 23):02d}:{random.randint(0, 59):02d}:00'
+    hdr['DEC'] = f'+{random.randint(0, 89):02d}:{random.randint(0, 59):02d}:00'
+    hdr['FRAMENO'] = index
+    for i in range(8):
+        hdr.add_comment(f'Synthetic frame comment {i}')
+    hdr.add_history('Written by benchmarks/synthetic_archive.py')
+    return hdr
+
+
+def make_night(root, night_date, frames, objects, formats, shape, start_index):
+    # Night directories are named after the morning date, frames start
+    # at 18:00 UT of the evening before
+    night_dir = os.path.join(root, night_date.isoformat())
+    os.makedirs(night_dir, exist_ok=True)
+    obs_datetime = dt.datetime.combine(
+        night_date - dt.timedelta(days=1), dt.time(18))
+    data = pad(b'\0' * (shape[0] * shape[1] * 2))
+    names = CALIBRATIONS + [f'OBJ {i:03d}' for i in range(objects)]
+
+    files = []
+    index = start_index
+    while len(files) < frames:
+        object_name = random.choice(names)
+        observers = random.sample(OBSERVERS, random.randint(1, 2))
+        exptime = float(random.choice([1, 5, 10, 30, 60, 120]))
+        for _ in range(min(random.randint(5, 40), frames - len(files))):
+            color_filter = random.choice(FILTERS)
+            ext, opener = FORMATS[formats[index % len(formats)]]
+            path = os.path.join(night_dir, f'frame_{index:07d}{ext}')
+            hdr = get_header(obs_datetime, object_name, observers,
+                             color_filter, exptime, shape, index)
+            with opener(path, 'wb') as f_out:
+                f_out.write(hdr.tostring().encode('ascii'))
+                f_out.write(data)
+            files.append(path)
+            obs_datetime += dt.timedelta(seconds=exptime + 5)
+            index += 1
+        obs_datetime += dt.timedelta(minutes=random.randint(1, 90))
+    return files
+
+
+def make_archive(root, nights=1, frames=100, objects=10,
+                 formats=('gz', 'bz2', 'fits'), shape=(256, 256),
+                 first_date=dt.date(2021, 1, 5), seed=0):
+    random.seed(seed)
+    files = []
+    for i in range(nights):
+        files += make_night(root, first_date + dt.timedelta(days=i),
+                            frames, objects, formats, shape, len(files))
+    return files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root", type=str, help="Archive directory")
+    parser.add_argument("-n", "--nights", type=int, default=1)
+    parser.add_argument("-f", "--frames", type=int, default=100,
+                        help="Frames per night")
+    parser.add_argument("-o", "--objects", type=int, default=10)
+    parser.add_argument("--formats", type=str, default='gz,bz2,fits',
+                        help="Comma separated: gz, bz2, fits")
+    parser.add_argument("--size", type=int, default=256,
+                        help="Frame width and height in pixels")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    files = make_archive(
+        args.root, args.nights, args.frames, args.objects,
+        args.formats.split(','), (args.size, args.size), seed=args.seed)
+    print(f'{len(files)} frames written to {args.root}')
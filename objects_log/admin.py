@@ -1,5 +1,11 @@
 from django.contrib import admin
-from .models import Target, Observer, ColorFilter, Program, Telescope, Tag, Night
+from .models import (
+    Target, Observer, ColorFilter, Program, Telescope, Tag, Night, Frame,
+    ExportJob)
+from django.conf import settings
+from django.http import FileResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
 from django.db import models
 from django.forms import TextInput, Textarea
 from django.conf.locale.en import formats as en_formats
@@ -7,9 +13,7 @@ from django.conf.locale.pl import formats as pl_formats
 from django.utils.html import format_html
 from django.db.models import Q, Sum
 from rangefilter.filter import DateRangeFilter
-from import_export.admin import ExportActionMixin
-from import_export import resources
-from import_export.fields import Field
+import os
 
 en_formats.DATETIME_FORMAT = "d-m-y H:i:s"
 pl_formats.DATETIME_FORMAT = "d-m-y H:i:s"
@@ -84,42 +88,11 @@ class NightAdmin(admin.ModelAdmin):
     note_display.short_description = 'Note'
 
 
-class TargetResource(resources.ModelResource):
-    res_program = Field(column_name='program')
-    res_colorfilters = Field(column_name='color_filters')
-    res_tags = Field(column_name='tags')
-    res_total_exposure_time = Field(column_name='total_exposure_time_min')
-    telescope = Field(attribute='telescope__name', column_name='telescope')
-
-    class Meta:
-        model = Target
-        fields = ('datetime_start', 'datetime_end', 'jd_start', 'observers',
-                  'name', 'telescope', 'res_program', 'res_colorfilters', 
-                  'res_tags', 'res_total_exposure_time', 'number_of_frames')
-        export_order = fields
-
-    def dehydrate_res_program(self, target):
-        if not target.program:
-            return '---'
-        return target.program.name
-
-    def dehydrate_res_total_exposure_time(self, target):
-        if target.total_exposure_time is not None:
-            return round(target.total_exposure_time / 60, 1)
-        return target.total_exposure_time
-
-    def dehydrate_res_colorfilters(self, target):
-        return ', '.join([f.name for f in target.colorfilters.all()])
-
-    def dehydrate_res_tags(self, target):
-        return ', '.join([f.name for f in target.tags.all()])
-
-
 @admin.register(Target)
-class TargetAdmin(ExportActionMixin, admin.ModelAdmin):
+class TargetAdmin(admin.ModelAdmin):
     # change_list_template = "admin/change_list_filter_sidebar.html"
-    resource_class = TargetResource
     list_per_page = 40
+    actions = ('export_xlsx', 'export_csv', 'export_json')
     class Media:
         css = {
             'all' : ('admin/css/target_side.css',)
@@ -145,6 +118,27 @@ class TargetAdmin(ExportActionMixin, admin.ModelAdmin):
     def observers_list(self, obj):
         return ', '.join([f.name for f in obj.observers.all()])
 
+    def queue_export(self, request, queryset, export_format):
+        # Files are written by the run_export_jobs worker, the request only
+        # stores the selected ids
+        target_ids = list(queryset.values_list('pk', flat=True))
+        job = ExportJob.objects.create(
+            user=request.user, export_format=export_format,
+            target_ids=target_ids, total=len(target_ids))
+        url = reverse('admin:objects_log_exportjob_changelist')
+        self.message_user(request, format_html(
+            'Export job #{} of {} targets queued, see <a href="{}">export '
+            'jobs</a>', job.pk, job.total, url))
+
+    def export_xlsx(self, request, queryset):
+        self.queue_export(request, queryset, 'xlsx')
+
+    def export_csv(self, request, queryset):
+        self.queue_export(request, queryset, 'csv')
+
+    def export_json(self, request, queryset):
+        self.queue_export(request, queryset, 'json')
+
     list_display = ('name', 'datetime_start', 'jd_start', 'observers_list',
         'colorfilters_display', 'program', 'telescope', 
         'total_exposure_time_display', 'note_display', 'tags_display')
@@ -160,6 +154,9 @@ class TargetAdmin(ExportActionMixin, admin.ModelAdmin):
     colorfilters_display.short_description = 'Filters'
     tags_display.short_description = 'Tags'
     observers_list.short_description = 'Observers'
+    export_xlsx.short_description = 'Export selected targets to XLSX'
+    export_csv.short_description = 'Export selected targets to CSV'
+    export_json.short_description = 'Export selected targets to JSON'
 
     # formfield_overrides = {
     #     models.CharField: {'widget': TextInput(attrs={'size':'10'})},
@@ -179,6 +176,64 @@ class TargetAdmin(ExportActionMixin, admin.ModelAdmin):
     # program.empty_value_display = '???'
 
 
+@admin.register(ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+
+    def progress_display(self, obj):
+        if not obj.total:
+            return '-'
+        return f'{obj.processed}/{obj.total} ({100 * obj.processed // obj.total}%)'
+
+    def download_link(self, obj):
+        if obj.status != ExportJob.DONE:
+            return None
+        url = reverse('admin:objects_log_exportjob_download', args=[obj.pk])
+        return format_html('<a href="{}">{}</a>', url, obj.file)
+
+    def download_view(self, request, pk):
+        job = get_object_or_404(ExportJob, pk=pk, status=ExportJob.DONE)
+        if not self.has_view_permission(request, job):
+            raise Http404
+        path = os.path.join(settings.EXPORT_ROOT, job.file)
+        if not os.path.exists(path):
+            raise Http404
+        return FileResponse(open(path, 'rb'), as_attachment=True,
+            filename=job.file)
+
+    def get_urls(self):
+        return [
+            path('<int:pk>/download/',
+                self.admin_site.admin_view(self.download_view),
+                name='objects_log_exportjob_download'),
+        ] + super().get_urls()
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    progress_display.short_description = 'Progress'
+    download_link.short_description = 'File'
+
+    list_display = ('id', 'created', 'user', 'export_format', 'status',
+        'progress_display', 'download_link')
+    list_filter = ('status', 'export_format')
+    exclude = ('target_ids',)
+    readonly_fields = ('progress_display', 'download_link')
+
+
+@admin.register(Frame)
+class FrameAdmin(admin.ModelAdmin):
+    list_display = ('path', 'obs_datetime', 'target', 'colorfilter',
+        'exposure_time', 'ccd_temp')
+    list_select_related = ('target', 'colorfilter')
+    raw_id_fields = ('target',)
+    list_filter = (('obs_datetime', DateRangeFilter), 'colorfilter')
+    search_fields = ('path',)
+    list_per_page = 100
+
+
 @admin.register(Tag)
 class TagAdmin(admin.ModelAdmin):
 
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class ObjectsLogConfig(AppConfig):
     name = 'objects_log'
+
+    def ready(self):
+        from objects_log import signals  # noqa: F401
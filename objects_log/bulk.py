@@ -0,0 +1,254 @@
+from django.db import connection, transaction
+from django.db.models import OuterRef, Subquery
+
+from objects_log.models import (
+    Target, Night, ColorFilter, Observer, Program, Frame)
+from objects_log.stats import invalidate_target_stats
+import csv
+import io
+import logging
+
+logger = logging.getLogger('django')
+
+FRAMES_BATCH = 5000
+FRAME_FIELDS = (
+    'target', 'path', 'obs_datetime', 'colorfilter', 'exposure_time',
+    'ccd_temp')
+
+
+def get_or_create_many(model, field, values):
+    # One query for existing rows, one insert and one query for missing ones
+    values = set(values)
+    if not values:
+        return {}
+    objects = {
+        getattr(o, field): o
+        for o in model.objects.filter(**{f'{field}__in': values})
+    }
+    missing = values - set(objects)
+    if missing:
+        model.objects.bulk_create(
+            [model(**{field: v}) for v in missing], ignore_conflicts=True)
+        objects.update({
+            getattr(o, field): o
+            for o in model.objects.filter(**{f'{field}__in': missing})
+        })
+    return objects
+
+
+def get_last_programs(names):
+    # Same rule as Target.save: program of the latest target with the name.
+    # The latest start per name is a correlated subquery, served by the
+    # (name, datetime_start) index
+    names = set(names)
+    if not names:
+        return {}
+    last_start = Target.objects.filter(
+        name=OuterRef('name')).order_by('-datetime_start').values(
+            'datetime_start')[:1]
+    return {
+        name: (datetime_start, program_id)
+        for name, datetime_start, program_id in Target.objects.filter(
+            name__in=names, datetime_start=Subquery(last_start)).order_by(
+                'datetime_start').values_list(
+                    'name', 'datetime_start', 'program_id')
+    }
+
+
+def find_existing_targets(items):
+    # (telescope id, datetime_start) -> pk of items which are already stored
+    if not items:
+        return {}
+    return {
+        (telescope_id, datetime_start): pk
+        for pk, telescope_id, datetime_start in Target.objects.filter(
+            telescope__in={item['telescope'] for item in items},
+            datetime_start__in={item['datetime_start'] for item in items},
+        ).values_list('pk', 'telescope_id', 'datetime_start')
+    }
+
+
+def split_existing(items, upsert=False):
+    # New items, items of stored targets (with their pk, to be updated when
+    # upsert is set) and duplicates, repeated items of a batch included
+    existing = find_existing_targets(items)
+    new_items = []
+    updates = []
+    duplicates = []
+    for item in items:
+        key = (item['telescope'].pk, item['datetime_start'])
+        if key not in existing:
+            new_items.append(item)
+        elif upsert and existing[key]:
+            updates.append(dict(item, pk=existing[key]))
+        else:
+            duplicates.append(item)
+        existing[key] = None
+    return new_items, updates, duplicates
+
+
+def copy_frames(frames):
+    # PostgreSQL COPY in batches of FRAMES_BATCH rows, streamed as csv
+    fields = [Frame._meta.get_field(name) for name in FRAME_FIELDS]
+    columns = ', '.join(f'"{field.column}"' for field in fields)
+    sql = (f'COPY "{Frame._meta.db_table}" ({columns}) '
+           'FROM STDIN WITH (FORMAT csv)')
+    with connection.cursor() as cursor:
+        for i in range(0, len(frames), FRAMES_BATCH):
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for frame in frames[i:i + FRAMES_BATCH]:
+                values = [getattr(frame, field.attname) for field in fields]
+                writer.writerow(['' if v is None else v for v in values])
+            buffer.seek(0)
+            cursor.copy_expert(sql, buffer)
+
+
+def load_frames(frames):
+    if connection.vendor == 'postgresql':
+        copy_frames(frames)
+    else:
+        Frame.objects.bulk_create(frames, batch_size=FRAMES_BATCH)
+
+
+def get_related(colorfilters_data, observers_data, frames_data):
+    colorfilters = get_or_create_many(
+        ColorFilter, 'name',
+        [c['name'] for data in colorfilters_data for c in data]
+        + [f['colorfilter'] for data in frames_data for f in data
+           if f.get('colorfilter')])
+    observers = get_or_create_many(
+        Observer, 'name', [o['name'] for data in observers_data for o in data])
+    return colorfilters, observers
+
+
+def add_related(targets, colorfilters_data, observers_data, frames_data,
+                colorfilters, observers):
+    TargetColorFilter = Target.colorfilters.through
+    TargetColorFilter.objects.bulk_create([
+        TargetColorFilter(
+            target_id=target.pk, colorfilter_id=colorfilters[c['name']].pk)
+        for target, data in zip(targets, colorfilters_data)
+        for c in {c['name']: c for c in data}.values()
+    ])
+    TargetObserver = Target.observers.through
+    TargetObserver.objects.bulk_create([
+        TargetObserver(
+            target_id=target.pk, observer_id=observers[o['name']].pk)
+        for target, data in zip(targets, observers_data)
+        for o in {o['name']: o for o in data}.values()
+    ])
+
+    load_frames([
+        Frame(
+            target_id=target.pk,
+            path=f['path'],
+            obs_datetime=f['obs_datetime'],
+            colorfilter=colorfilters.get(f.get('colorfilter')),
+            exposure_time=f.get('exposure_time'),
+            ccd_temp=f.get('ccd_temp'),
+        )
+        for target, data in zip(targets, frames_data) for f in data
+    ])
+
+
+@transaction.atomic
+def create_targets(items):
+    items = [dict(item) for item in items]
+    colorfilters_data = [item.pop('colorfilters', None) or [] for item in items]
+    observers_data = [item.pop('observers', None) or [] for item in items]
+    programs_data = [item.pop('program', None) for item in items]
+    frames_data = [item.pop('frames', None) or [] for item in items]
+
+    colorfilters, observers = get_related(
+        colorfilters_data, observers_data, frames_data)
+    programs = get_or_create_many(
+        Program, 'name', [p['name'] for p in programs_data if p])
+    last_programs = get_last_programs(
+        [item['name'] for item, p in zip(items, programs_data) if not p])
+
+    targets = [Target(**item) for item in items]
+    nights = get_or_create_many(
+        Night, 'date', [t.get_night_date() for t in targets])
+
+    for target, program_data in zip(targets, programs_data):
+        target.night = nights[target.get_night_date()]
+        target.jd_start = target.get_jd_start(target.datetime_start)
+        if program_data:
+            target.program = programs[program_data['name']]
+        else:
+            last = last_programs.get(target.name)
+            target.program_id = last[1] if last else None
+        last = last_programs.get(target.name)
+        if not last or last[0] <= target.datetime_start:
+            last_programs[target.name] = (
+                target.datetime_start, target.program_id)
+
+    targets = Target.objects.bulk_create(targets)
+    if any(t.pk is None for t in targets):
+        # Backends which do not return ids from bulk inserts (SQLite)
+        ids = {
+            (telescope_id, datetime_start): pk
+            for pk, telescope_id, datetime_start in Target.objects.filter(
+                telescope__in={t.telescope_id for t in targets},
+                datetime_start__in={t.datetime_start for t in targets},
+            ).values_list('pk', 'telescope_id', 'datetime_start')
+        }
+        for target in targets:
+            target.pk = ids[(target.telescope_id, target.datetime_start)]
+
+    add_related(targets, colorfilters_data, observers_data, frames_data,
+                colorfilters, observers)
+    # bulk_create does not send post_save
+    invalidate_target_stats([t.telescope_id for t in targets])
+
+    logger.info(f'\nCreated {len(targets)} objects in bulk')
+    return targets
+
+
+@transaction.atomic
+def update_targets(items):
+    # Items carry the pk of the stored target with the same telescope and
+    # datetime_start. Values coming from the frames are replaced, fields
+    # edited by hand (notes, tags, coordinates, program) are kept unless
+    # the item has them
+    items = [dict(item) for item in items]
+    colorfilters_data = [item.pop('colorfilters', None) or [] for item in items]
+    observers_data = [item.pop('observers', None) or [] for item in items]
+    programs_data = [item.pop('program', None) for item in items]
+    frames_data = [item.pop('frames', None) for item in items]
+
+    colorfilters, observers = get_related(
+        colorfilters_data, observers_data,
+        [data for data in frames_data if data])
+    programs = get_or_create_many(
+        Program, 'name', [p['name'] for p in programs_data if p])
+
+    targets = Target.objects.in_bulk([item['pk'] for item in items])
+    targets = [targets[item['pk']] for item in items]
+    fields = set()
+    for target, item, program_data in zip(targets, items, programs_data):
+        for field, value in item.items():
+            if field not in ('pk', 'telescope', 'datetime_start'):
+                setattr(target, field, value)
+                fields.add(field)
+        if program_data:
+            target.program = programs[program_data['name']]
+            fields.add('program')
+    if fields:
+        Target.objects.bulk_update(targets, fields)
+
+    pks = [target.pk for target in targets]
+    Target.colorfilters.through.objects.filter(target_id__in=pks).delete()
+    Target.observers.through.objects.filter(target_id__in=pks).delete()
+    Frame.objects.filter(target_id__in=[
+        target.pk for target, data in zip(targets, frames_data)
+        if data is not None
+    ]).delete()
+    add_related(targets, colorfilters_data, observers_data,
+                [data or [] for data in frames_data],
+                colorfilters, observers)
+    invalidate_target_stats([t.telescope_id for t in targets])
+
+    logger.info(f'\nUpdated {len(targets)} objects in bulk')
+    return targets
@@ -0,0 +1,176 @@
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from objects_log.models import Target
+
+import csv
+import os
+import logging
+
+logger = logging.getLogger('django')
+
+CHUNK_SIZE = 2000
+# Columns of the former admin TargetResource export
+EXPORT_COLUMNS = (
+    'datetime_start', 'datetime_end', 'jd_start', 'observers', 'name',
+    'telescope', 'program', 'color_filters', 'tags',
+    'total_exposure_time_min', 'number_of_frames')
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+TARGET_FIELDS = (
+    'id', 'datetime_start', 'datetime_end', 'jd_start', 'name',
+    'telescope__name', 'program__name', 'total_exposure_time',
+    'number_of_frames')
+# Export column, many to many field and name lookup on its through model
+RELATED_NAMES = (
+    ('observers', 'observers', 'observer__name'),
+    ('color_filters', 'colorfilters', 'colorfilter__name'),
+    ('tags', 'tags', 'tag__name'),
+)
+
+
+def iter_chunks(queryset, chunk_size=CHUNK_SIZE):
+    # Plain rows from a server-side cursor (on PostgreSQL), no model
+    # instances are built
+    chunk = []
+    for row in queryset.values_list(*TARGET_FIELDS).iterator(
+            chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_related_names(ids):
+    # column -> target id -> joined names, one query per relation
+    related = {}
+    for column, field, through_field in RELATED_NAMES:
+        through = getattr(Target, field).through
+        names = {}
+        for target_id, name in through.objects.filter(
+                target_id__in=ids).order_by(through_field).values_list(
+                    'target_id', through_field):
+            names.setdefault(target_id, []).append(name)
+        related[column] = {
+            target_id: ', '.join(n) for target_id, n in names.items()}
+    return related
+
+
+def get_row(values, related):
+    (target_id, datetime_start, datetime_end, jd_start, name, telescope,
+     program, total_exposure_time, number_of_frames) = values
+    if total_exposure_time is not None:
+        total_exposure_time = round(float(total_exposure_time) / 60, 1)
+    return {
+        'datetime_start': datetime_start,
+        'datetime_end': datetime_end,
+        'jd_start': float(jd_start),
+        'observers': related['observers'].get(target_id, ''),
+        'name': name,
+        'telescope': telescope,
+        'program': program or '---',
+        'color_filters': related['color_filters'].get(target_id, ''),
+        'tags': related['tags'].get(target_id, ''),
+        'total_exposure_time_min': total_exposure_time,
+        'number_of_frames': number_of_frames,
+    }
+
+
+def iter_rows(queryset):
+    for chunk in iter_chunks(queryset):
+        related = get_related_names([values[0] for values in chunk])
+        for values in chunk:
+            yield get_row(values, related)
+
+
+def iter_rows_by_ids(ids, on_chunk=None):
+    # Rows in the order of ids, on_chunk gets the number of ids done
+    for i in range(0, len(ids), CHUNK_SIZE):
+        chunk_ids = ids[i:i + CHUNK_SIZE]
+        values = {
+            v[0]: v for v in Target.objects.filter(
+                pk__in=chunk_ids).values_list(*TARGET_FIELDS)
+        }
+        related = get_related_names(list(values))
+        for pk in chunk_ids:
+            if pk in values:
+                yield get_row(values[pk], related)
+        if on_chunk:
+            on_chunk(i + len(chunk_ids))
+
+
+def iter_ndjson(rows):
+    encoder = DjangoJSONEncoder()
+    for row in rows:
+        yield encoder.encode(row) + '\n'
+
+
+class Echo:
+    # File-like object handing the line written by csv.writer back
+    def write(self, value):
+        return value
+
+
+def iter_csv(rows):
+    writer = csv.DictWriter(Echo(), fieldnames=EXPORT_COLUMNS)
+    yield writer.writeheader()
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def iter_export(queryset, export_format):
+    rows = iter_rows(queryset)
+    if export_format == 'csv':
+        return iter_csv(rows)
+    return iter_ndjson(rows)
+
+
+def write_csv(rows, f):
+    writer = csv.DictWriter(f, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def write_json(rows, f):
+    # JSON array written row by row
+    encoder = DjangoJSONEncoder()
+    f.write('[')
+    for i, row in enumerate(rows):
+        f.write((',\n' if i else '\n') + encoder.encode(row))
+    f.write('\n]\n')
+
+
+def write_xlsx(rows, path):
+    # Write-only workbooks keep rows in a temporary file, not in memory
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('targets')
+    sheet.append(EXPORT_COLUMNS)
+    for row in rows:
+        # Excel does not store time zones, datetimes are in UTC
+        sheet.append([
+            timezone.make_naive(v, timezone.utc)
+            if isinstance(v, timezone.datetime) else v
+            for v in row.values()
+        ])
+    workbook.save(path)
+
+
+def write_export(rows, path, export_format):
+    # Written next to path and renamed, so a half written file is never
+    # served
+    part_path = f'{path}.part'
+    if export_format == 'xlsx':
+        write_xlsx(rows, part_path)
+    else:
+        write = write_csv if export_format == 'csv' else write_json
+        with open(part_path, 'w', newline='') as f:
+            write(rows, f)
+    os.replace(part_path, path)
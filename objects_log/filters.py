@@ -0,0 +1,26 @@
+import django_filters
+
+from objects_log.models import Target
+
+
+class TargetFilter(django_filters.FilterSet):
+    # Query parameters of the targets API. Lookups are exact, so that they
+    # are served by the indexes on the target table and on the unique names
+    # of the related models
+    telescope = django_filters.CharFilter(field_name='telescope__name')
+    datetime_start = django_filters.IsoDateTimeFromToRangeFilter()
+    jd = django_filters.RangeFilter(field_name='jd_start')
+    night = django_filters.DateFilter(field_name='night__date')
+    night_range = django_filters.DateFromToRangeFilter(
+        field_name='night__date')
+    name = django_filters.CharFilter()
+    program = django_filters.CharFilter(field_name='program__name')
+    observer = django_filters.CharFilter(
+        field_name='observers__name', distinct=True)
+    filter = django_filters.CharFilter(
+        field_name='colorfilters__name', distinct=True)
+    tag = django_filters.CharFilter(field_name='tags__name', distinct=True)
+
+    class Meta:
+        model = Target
+        fields = []
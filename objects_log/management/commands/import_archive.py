@@ -0,0 +1,136 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+import update_logs
+from objects_log.models import Telescope
+from objects_log.serializers import TargetBulkSerializer
+
+
+def iter_archive_files(dirs_to_walk):
+    for _dir in dirs_to_walk:
+        yield from update_logs.iter_files(_dir)
+
+
+class Command(BaseCommand):
+    help = ('Import a telescope archive straight into the database. Frames '
+            'are read and grouped like update_logs.py does, targets are '
+            'stored in bulk')
+
+    def add_arguments(self, parser):
+        parser.add_argument('telescope', help='Telescope name')
+        parser.add_argument('data_dir', help='Archive root with night dirs')
+        parser.add_argument('-nd', '--names_dict')
+        parser.add_argument('-fd', '--filters_dict')
+        parser.add_argument('-od', '--observers_dict')
+        parser.add_argument(
+            '-s', '--datetime_start', default='1900-01-01T12:00:00')
+        parser.add_argument(
+            '-e', '--datetime_end', default='2100-01-01T12:00:00')
+        parser.add_argument(
+            '-w', '--workers', type=int, default=os.cpu_count(),
+            help='Number of processes reading FITS headers')
+        parser.add_argument(
+            '-g', '--visit_gap', type=float, default=60,
+            help='Minutes between frames which split a visit, 0 joins all')
+        parser.add_argument(
+            '-b', '--batch_size', type=int, default=2000,
+            help='Targets stored in one transaction')
+        parser.add_argument(
+            '-m', '--manifest',
+            help='Sqlite file to cache read headers, see update_logs.py')
+        parser.add_argument(
+            '--frames', action='store_true', help='Store every frame too')
+        parser.add_argument(
+            '--update', action='store_true',
+            help='Update targets which are already stored')
+
+    def handle(self, *args, **options):
+        try:
+            telescope = Telescope.objects.get(name=options['telescope'])
+        except Telescope.DoesNotExist:
+            raise CommandError(f'No telescope {options["telescope"]}')
+        data_dir = options['data_dir']
+        if not os.path.isdir(data_dir):
+            raise CommandError(f'Wrong data dir: {data_dir}')
+
+        dicts = [
+            update_logs.get_dict(options[name])
+            for name in ('names_dict', 'filters_dict', 'observers_dict')
+        ]
+        dirs_to_walk = sorted(update_logs.get_dirs_to_walk(
+            data_dir,
+            update_logs.validate_datetime(options['datetime_start']),
+            update_logs.validate_datetime(options['datetime_end']),
+        ))
+        visit_gap = update_logs.get_visit_gap(options['visit_gap'])
+        manifest = None
+        if options['manifest']:
+            manifest = update_logs.open_manifest(options['manifest'])
+        executor = update_logs.get_executor(options['workers'])
+
+        self.counts = {
+            'created': 0, 'updated': 0, 'duplicates': 0, 'rejected': 0}
+        start = time.perf_counter()
+        try:
+            # One stream of files over all nights keeps the pool busy
+            # across directory boundaries, rows are grouped per night
+            rows = update_logs.iter_folder_data(
+                iter_archive_files(dirs_to_walk), *dicts, executor,
+                manifest, options['workers'])
+            batch = []
+            table = update_logs.FrameTable()
+            night_dir = None
+            frames = 0
+            for row in rows:
+                row_dir = os.path.join(data_dir, os.path.relpath(
+                    row['path'], data_dir).split(os.sep)[0])
+                if row_dir != night_dir and len(table):
+                    batch += self.group(table, telescope, visit_gap, options)
+                    table = update_logs.FrameTable()
+                night_dir = row_dir
+                table.append(row)
+                frames += 1
+                if len(batch) >= options['batch_size']:
+                    self.store(batch, options['update'])
+                    batch = []
+            if len(table):
+                batch += self.group(table, telescope, visit_gap, options)
+            if batch:
+                self.store(batch, options['update'])
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if manifest is not None:
+                manifest.close()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(dirs_to_walk)} nights, {frames} frames in '
+            f'{time.perf_counter() - start:.1f} s: {self.counts["created"]} '
+            f'targets created, {self.counts["updated"]} updated, '
+            f'{self.counts["duplicates"]} already stored, '
+            f'{self.counts["rejected"]} rejected'))
+
+    def group(self, table, telescope, visit_gap, options):
+        targets = update_logs.group_frame_table(
+            table, telescope.name, visit_gap, options['frames'])
+        return list(targets.values())
+
+    def store(self, targets, update=False):
+        # Checked like a post to the bulk endpoint, so a target the
+        # database can not take (e.g. a too long observer name) is skipped
+        # instead of aborting the import
+        serializer = TargetBulkSerializer(
+            data=targets, many=True, context={'upsert': update})
+        serializer.is_valid(raise_exception=True)
+        for rejected in serializer.rejected:
+            self.stderr.write(f'Target skipped: {rejected}')
+        created = serializer.save()
+        self.counts['created'] += len(created)
+        self.counts['updated'] += len(serializer.updates)
+        self.counts['duplicates'] += len(serializer.duplicates)
+        self.counts['rejected'] += len(serializer.rejected)
+        self.stdout.write(
+            f'Stored {len(created)} targets, '
+            f'updated {len(serializer.updates)}')
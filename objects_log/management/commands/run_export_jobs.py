@@ -0,0 +1,105 @@
+import datetime as dt
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from objects_log import export
+from objects_log.models import ExportJob
+
+logger = logging.getLogger('django')
+
+# A job running longer lost its worker, e.g. to a restart or a crash
+STALE_TIMEOUT = dt.timedelta(hours=1)
+
+
+def fail_stale_jobs(timeout=STALE_TIMEOUT):
+    # Failed and not queued again, so that a job which brings its worker
+    # down does not run in a loop. It can be queued again in the admin
+    failed = ExportJob.objects.filter(
+        status=ExportJob.RUNNING,
+        started__lt=timezone.now() - timeout).update(
+            status=ExportJob.FAILED,
+            error=f'Not finished after {timeout}, worker stopped',
+            finished=timezone.now())
+    if failed:
+        logger.warning(f'{failed} stale export jobs failed')
+    return failed
+
+
+def claim_job(timeout=STALE_TIMEOUT):
+    # The conditional update makes a job run by one worker only
+    fail_stale_jobs(timeout)
+    pending = ExportJob.objects.filter(status=ExportJob.PENDING).order_by(
+        'created').values_list('pk', flat=True)
+    for pk in pending[:10]:
+        claimed = ExportJob.objects.filter(
+            pk=pk, status=ExportJob.PENDING).update(
+                status=ExportJob.RUNNING, started=timezone.now())
+        if claimed:
+            return ExportJob.objects.get(pk=pk)
+    return None
+
+
+def run_job(job):
+    os.makedirs(settings.EXPORT_ROOT, exist_ok=True)
+    file_name = f'targets_{job.pk}.{job.export_format}'
+
+    def on_chunk(processed):
+        ExportJob.objects.filter(pk=job.pk).update(processed=processed)
+
+    rows = export.iter_rows_by_ids(job.target_ids, on_chunk)
+    try:
+        export.write_export(
+            rows, os.path.join(settings.EXPORT_ROOT, file_name),
+            job.export_format)
+    except Exception as e:
+        logger.exception(f'Export job {job.pk} failed')
+        ExportJob.objects.filter(pk=job.pk).update(
+            status=ExportJob.FAILED, error=str(e), finished=timezone.now())
+        return False
+
+    ExportJob.objects.filter(pk=job.pk).update(
+        status=ExportJob.DONE, file=file_name, finished=timezone.now())
+    return True
+
+
+class Command(BaseCommand):
+    help = ('Run the target exports queued in the admin. Polls the database '
+            'for pending jobs and writes their files to EXPORT_ROOT')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-i', '--interval', type=float, default=5,
+            help='Seconds between checks for new jobs')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Exit when no job is pending')
+        parser.add_argument(
+            '-t', '--timeout', type=float, default=60,
+            help='Minutes after which a running job is failed, its worker '
+                 'is taken as stopped')
+
+    def handle(self, *args, **options):
+        timeout = dt.timedelta(minutes=options['timeout'])
+        while True:
+            job = claim_job(timeout)
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+                continue
+
+            self.stdout.write(
+                f'Export job {job.pk}: {job.total} targets to '
+                f'{job.export_format}')
+            start = time.time()
+            if run_job(job):
+                self.stdout.write(self.style.SUCCESS(
+                    f'Export job {job.pk} done in {time.time() - start:.1f} s'))
+            else:
+                self.stdout.write(self.style.ERROR(
+                    f'Export job {job.pk} failed'))
@@ -0,0 +1,29 @@
+# Generated by Django 3.1.4 on 2026-10-18 10:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('objects_log', '0018_auto_20210511_1356'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Frame',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=1023)),
+                ('obs_datetime', models.DateTimeField(db_index=True)),
+                ('exposure_time', models.FloatField(blank=True, help_text='Exposure time in seconds', null=True)),
+                ('ccd_temp', models.FloatField(blank=True, null=True)),
+                ('colorfilter', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='objects_log.colorfilter')),
+                ('target', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='frames', to='objects_log.target')),
+            ],
+            options={
+                'ordering': ('obs_datetime',),
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.4 on 2026-10-18 10:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('objects_log', '0019_frame'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='target',
+            index=models.Index(fields=['telescope', 'datetime_start'], name='objects_log_telesco_b8e2af_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.4 on 2026-10-18 10:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('objects_log', '0020_target_telescope_datetime_start_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='target',
+            index=models.Index(fields=['datetime_start', 'id'], name='objects_log_datetim_41bb14_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.1.4 on 2026-10-18 10:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('objects_log', '0021_target_datetime_start_id_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='target',
+            index=models.Index(fields=['name', 'datetime_start'], name='objects_log_name_ac6bd1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='target',
+            index=models.Index(fields=['jd_start'], name='objects_log_jd_star_851e6c_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.core.management import call_command
+from django.db import migrations
+
+
+def create_cache_table(apps, schema_editor):
+    # Target stats are cached in the database cache table, see settings.
+    # Nothing is done if it exists or another cache backend is configured
+    call_command(
+        'createcachetable', database=schema_editor.connection.alias,
+        verbosity=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('objects_log', '0023_exportjob'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_cache_table, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.db import models
 from django.apps import apps
 from django.core.validators import MaxValueValidator, MinValueValidator
@@ -51,6 +52,12 @@ class Target(models.Model):
 
     class Meta:
         ordering = ('-datetime_start',)
+        indexes = [
+            models.Index(fields=['telescope', 'datetime_start']),
+            models.Index(fields=['datetime_start', 'id']),
+            models.Index(fields=['name', 'datetime_start']),
+            models.Index(fields=['jd_start']),
+        ]
 
     def __str__(self):
         return f'{self.name}'
@@ -66,11 +73,13 @@ class Target(models.Model):
 
         return jd
     
+    def get_night_date(self):
+        return (self.datetime_start - dt.timedelta(hours=12)).date()
+
     def get_night(self):
-        object_night = (self.datetime_start - dt.timedelta(hours=12)).date()
         night, _ = apps.get_model(
             'objects_log.Night').objects.get_or_create(
-                date=object_night,
+                date=self.get_night_date(),
         )
 
         return night
@@ -91,6 +100,65 @@ class Target(models.Model):
         return super().save(*args, **kwargs)
 
 
+class Frame(models.Model):
+    target = models.ForeignKey('objects_log.Target',
+        related_name='frames', on_delete=models.CASCADE)
+    path = models.CharField(max_length=1023)
+    obs_datetime = models.DateTimeField(db_index=True)
+    colorfilter = models.ForeignKey('objects_log.ColorFilter', null=True,
+        blank=True, on_delete=models.SET_NULL)
+    exposure_time = models.FloatField(null=True, blank=True,
+        help_text='Exposure time in seconds')
+    ccd_temp = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('obs_datetime',)
+
+    def __str__(self):
+        return f'{self.path}'
+
+
+class ExportJob(models.Model):
+    # Target export requested in the admin, written to EXPORT_ROOT by the
+    # run_export_jobs worker
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+    FORMAT_CHOICES = (
+        ('xlsx', 'XLSX'),
+        ('csv', 'CSV'),
+        ('json', 'JSON'),
+    )
+
+    created = models.DateTimeField(auto_now_add=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True,
+        blank=True, on_delete=models.SET_NULL)
+    export_format = models.CharField(max_length=4, choices=FORMAT_CHOICES)
+    status = models.CharField(max_length=7, choices=STATUS_CHOICES,
+        default=PENDING, db_index=True)
+    target_ids = models.JSONField(default=list)
+    total = models.IntegerField(default=0)
+    processed = models.IntegerField(default=0)
+    file = models.CharField(max_length=1023, blank=True,
+        help_text='Path relative to EXPORT_ROOT')
+    error = models.TextField(blank=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('-created',)
+
+    def __str__(self):
+        return f'{self.export_format} export #{self.pk}'
+
+
 class Observer(models.Model):
     name = models.CharField(max_length=5, unique=True)
     note = models.TextField(max_length=511, null=True, blank=True)
@@ -1,7 +1,10 @@
 from rest_framework import serializers
-from objects_log.models import Observer, Target, ColorFilter, Telescope, Program
+from objects_log.models import (
+    Observer, Target, ColorFilter, Telescope, Program, Frame)
+from django.db.models import Count, Max, Min, Sum
 from django.utils import timezone
 from rest_framework.validators import UniqueTogetherValidator
+from objects_log import bulk
 import logging
 
 logger = logging.getLogger('django')
@@ -47,6 +50,16 @@ class ProgramSerializer(serializers.ModelSerializer):
         }
 
 
+class FrameSerializer(serializers.ModelSerializer):
+    colorfilter = serializers.CharField(
+        max_length=12, required=False, allow_null=True)
+
+    class Meta:
+        model = Frame
+        fields = ('path', 'obs_datetime', 'colorfilter', 'exposure_time',
+                  'ccd_temp')
+
+
 class TargetSerializer(serializers.ModelSerializer):
     telescope = serializers.SlugRelatedField(
         many=False, read_only=False, queryset=Telescope.objects.all(),
@@ -64,7 +77,8 @@ class TargetSerializer(serializers.ModelSerializer):
         model = Target
         fields = ['datetime_start', 'datetime_end', 'observers', 'name',
             'ra', 'dec', 'note', 'telescope', 'colorfilters',
-            'total_exposure_time', 'number_of_frames', 'program',]
+            'total_exposure_time', 'number_of_frames', 'program',
+            'ccd_temp_min', 'ccd_temp_max',]
         validators = [
             UniqueTogetherValidator(
                 queryset=Target.objects.all(),
@@ -124,19 +138,88 @@ class TargetSerializer(serializers.ModelSerializer):
         return target
 
 
+def get_rejected_item(index, item, errors):
+    rejected = {'index': index, 'errors': errors}
+    if isinstance(item, dict):
+        for field in ('name', 'telescope', 'datetime_start'):
+            rejected[field] = item.get(field)
+    return rejected
+
+
+class TargetBulkListSerializer(serializers.ListSerializer):
+    # Validates and creates a whole batch with set-based queries. Items are
+    # validated one by one: invalid ones are left out and reported in
+    # `rejected` with their index, so one bad header does not fail the
+    # batch. Targets which already exist (same telescope and
+    # datetime_start) are skipped and reported in `duplicates`, like
+    # rejected single posts. With the `upsert` context flag they are
+    # updated instead
+
+    def to_internal_value(self, data):
+        self.rejected = []
+        if not isinstance(data, list):
+            return super().to_internal_value(data)
+        names = {
+            item['telescope'] for item in data
+            if isinstance(item, dict) and isinstance(item.get('telescope'), str)
+        }
+        telescopes = {t.name: t for t in Telescope.objects.filter(name__in=names)}
+        attrs = []
+        for index, item in enumerate(data):
+            try:
+                validated = self.child.run_validation(item)
+                if validated['telescope'] not in telescopes:
+                    raise serializers.ValidationError({'telescope': [
+                        f'Object with name={validated["telescope"]} '
+                        'does not exist.']})
+            except serializers.ValidationError as e:
+                self.rejected.append(get_rejected_item(index, item, e.detail))
+                continue
+            validated['telescope'] = telescopes[validated['telescope']]
+            attrs.append(validated)
+        return attrs
+
+    def validate(self, attrs):
+        unique_attrs, self.updates, duplicates = bulk.split_existing(
+            attrs, self.context.get('upsert'))
+        self.duplicates = [
+            {
+                'name': item['name'],
+                'telescope': item['telescope'].name,
+                'datetime_start': item['datetime_start'],
+            }
+            for item in duplicates
+        ]
+        return unique_attrs
+
+    def create(self, validated_data):
+        if self.updates:
+            bulk.update_targets(self.updates)
+        return bulk.create_targets(validated_data)
+
+
+class TargetBulkSerializer(TargetSerializer):
+    telescope = serializers.CharField(max_length=257)
+    program = ProgramSerializer(required=False, allow_null=True)
+    frames = FrameSerializer(many=True, required=False)
+
+    class Meta(TargetSerializer.Meta):
+        fields = TargetSerializer.Meta.fields + ['frames']
+        validators = []
+        list_serializer_class = TargetBulkListSerializer
+
+
 class TargetStatsSerializer(serializers.BaseSerializer):
+    # One aggregate query, Max is served by the (telescope, datetime_start)
+    # index
     def to_representation(self, instance):
-        last_instance = instance.order_by(
-            '-datetime_start').first()
-
-        if not last_instance:
-            last_datetime = None
-        else:
-            last_datetime = last_instance.datetime_start
-            
-        counts = instance.count()
-
-        return {
-            'last_datetime': last_datetime,
-            'counts': counts,
-        }
+        stats = instance.order_by().aggregate(
+            last_datetime=Max('datetime_start'),
+            first_datetime=Min('datetime_start'),
+            counts=Count('id'),
+            number_of_frames=Sum('number_of_frames'),
+            total_exposure_time=Sum('total_exposure_time'),
+        )
+        stats['number_of_frames'] = stats['number_of_frames'] or 0
+        stats['total_exposure_time'] = stats['total_exposure_time'] or 0
+        return stats
@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from objects_log.models import ExportJob, Target
+from objects_log.stats import invalidate_target_stats
+import os
+
+
+@receiver(post_save, sender=Target)
+@receiver(post_delete, sender=Target)
+def target_changed(sender, instance, **kwargs):
+    invalidate_target_stats([instance.telescope_id])
+
+
+@receiver(post_delete, sender=ExportJob)
+def export_job_deleted(sender, instance, **kwargs):
+    if instance.file:
+        path = os.path.join(settings.EXPORT_ROOT, instance.file)
+        if os.path.exists(path):
+            os.remove(path)
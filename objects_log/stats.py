@@ -0,0 +1,63 @@
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import DatabaseError, transaction
+
+from objects_log.models import Target
+import logging
+
+logger = logging.getLogger('django')
+
+# Cached results are dropped whenever targets change, the timeout only
+# limits how long changes made around the ORM (raw SQL) stay unnoticed
+STATS_TIMEOUT = 60 * 60
+STATS_KEY = 'target_stats:{}'
+
+
+def get_stats_key(telescope_id=None):
+    return STATS_KEY.format(telescope_id or 'all')
+
+
+def is_shared_cache():
+    # Targets written by other processes can not invalidate a per process
+    # cache, whose stats would stay stale until the timeout
+    return not isinstance(caches['default'], LocMemCache)
+
+
+def get_target_stats(telescope=None):
+    # Stats of all targets or of the targets of one telescope
+    from objects_log.serializers import TargetStatsSerializer
+
+    telescope_id = telescope.pk if telescope else None
+    key = get_stats_key(telescope_id)
+    shared = is_shared_cache()
+    data = None
+    if shared:
+        try:
+            data = cache.get(key)
+        except DatabaseError as e:
+            # E.g. the cache table is missing, stats are not cached then
+            logger.error(f'Stats cache unavailable - {e}')
+            shared = False
+    if data is None:
+        targets = Target.objects.all()
+        if telescope_id:
+            targets = targets.filter(telescope_id=telescope_id)
+        data = TargetStatsSerializer(targets).data
+        if shared:
+            cache.set(key, data, STATS_TIMEOUT)
+    return data
+
+
+def invalidate_target_stats(telescope_ids):
+    # Done after the commit, so that a concurrent request can not cache
+    # the stats from before the change
+    keys = [get_stats_key()] + [get_stats_key(t) for t in set(telescope_ids)]
+    transaction.on_commit(lambda: delete_stats(keys))
+
+
+def delete_stats(keys):
+    # A cache error must not fail a change which is already committed
+    try:
+        cache.delete_many(keys)
+    except DatabaseError as e:
+        logger.error(f'Stats cache unavailable - {e}')
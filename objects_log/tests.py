@@ -1,3 +1,668 @@
-from django.test import TestCase
+import csv
+import datetime as dt
+import io
+import json
+import os
+import shutil
+import tempfile
+from importlib import import_module
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from benchmarks.synthetic_archive import get_header, make_archive
+
+from objects_log import bulk, export, views
+from objects_log.models import (
+    Target, Telescope, Program, ColorFilter, Frame, Tag, ExportJob)
+from objects_log.management.commands import run_export_jobs
+
+
+def get_datetime(*args):
+    return dt.datetime(*args, tzinfo=timezone.utc)
+
+
+def get_item(name, datetime_start, **kwargs):
+    # Target as sent by update_logs.py to /targets/bulk/
+    item = {
+        'name': name,
+        'datetime_start': datetime_start,
+        'datetime_end': datetime_start,
+        'telescope': 'T60',
+        'colorfilters': [{'name': 'V'}, {'name': 'R'}, {'name': 'V'}],
+        'observers': [{'name': 'ABC'}],
+        'total_exposure_time': 10,
+        'number_of_frames': 2,
+    }
+    item.update(kwargs)
+    return item
+
+
+def get_frames(number):
+    return [
+        {
+            'path': f'/data/{i}.fits',
+            'obs_datetime': '2021-01-04T18:00:00Z',
+            'colorfilter': 'V',
+            'exposure_time': 5,
+            'ccd_temp': -20,
+        }
+        for i in range(number)
+    ]
+
+
+class ApiTestMixin:
+
+    def setUp(self):
+        self.telescope = Telescope.objects.create(name='T60')
+        self.client = APIClient()
+        self.user = User.objects.create(username='observer')
+        self.client.force_authenticate(self.user)
+
+    def post_bulk(self, items, upsert=False):
+        url = '/targets/bulk/?upsert=1' if upsert else '/targets/bulk/'
+        return self.client.post(url, items, format='json')
+
+
+class ApiTestCase(ApiTestMixin, TestCase):
+    pass
+
+
+class GetOrCreateManyTests(TestCase):
+
+    def test_creates_missing_only(self):
+        existing = ColorFilter.objects.create(name='V')
+        filters = bulk.get_or_create_many(ColorFilter, 'name', ['V', 'R', 'R'])
+        self.assertEqual(sorted(filters), ['R', 'V'])
+        self.assertEqual(filters['V'].pk, existing.pk)
+        self.assertEqual(ColorFilter.objects.count(), 2)
+
+    def test_empty(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(bulk.get_or_create_many(ColorFilter, 'name', []), {})
+
+
+class BulkUploadTests(ApiTestCase):
+
+    def test_creates_targets_and_reports_duplicates(self):
+        response = self.post_bulk([
+            get_item('M31', '2021-01-04T18:00:00Z'),
+            get_item('NGC', '2021-01-04T19:00:00Z'),
+            get_item('NGC', '2021-01-04T19:00:00Z'),
+        ])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['created'], 2)
+        self.assertEqual(len(response.json()['duplicates']), 1)
+
+        target = Target.objects.get(name='M31')
+        self.assertEqual(
+            sorted(c.name for c in target.colorfilters.all()), ['R', 'V'])
+        self.assertEqual([o.name for o in target.observers.all()], ['ABC'])
+        self.assertEqual(str(target.night), '04-01-2021')
+        self.assertAlmostEqual(
+            float(target.jd_start), target.get_jd_start(target.datetime_start),
+            places=5)
+
+        response = self.post_bulk([get_item('M31', '2021-01-04T18:00:00Z')])
+        self.assertEqual(response.json()['created'], 0)
+        self.assertEqual(len(response.json()['duplicates']), 1)
+
+    def test_unknown_telescope(self):
+        response = self.post_bulk(
+            [get_item('M31', '2021-01-04T18:00:00Z', telescope='T2')])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['created'], 0)
+        self.assertEqual(
+            list(response.json()['rejected'][0]['errors']), ['telescope'])
+        self.assertFalse(Target.objects.exists())
+
+    def test_invalid_items_rejected(self):
+        # The valid items of a batch are stored, the others are reported
+        items = [
+            get_item(f'T{i}', f'2021-01-04T18:0{i}:00Z') for i in range(5)]
+        items[2]['observers'] = [{'name': 'ABCDEF'}]
+        items[4]['datetime_start'] = 'tonight'
+        response = self.post_bulk(items)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['created'], 3)
+        rejected = response.json()['rejected']
+        self.assertEqual([r['index'] for r in rejected], [2, 4])
+        self.assertEqual(rejected[0]['name'], 'T2')
+        self.assertIn('observers', rejected[0]['errors'])
+        self.assertIn('datetime_start', rejected[1]['errors'])
+        self.assertEqual(
+            sorted(Target.objects.values_list('name', flat=True)),
+            ['T0', 'T1', 'T3'])
+
+    def test_not_a_list(self):
+        response = self.post_bulk(get_item('M31', '2021-01-04T18:00:00Z'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_program_inheritance(self):
+        # Like Target.save, targets without a program get the program of the
+        # latest target with the same name, also one from the same batch
+        program = Program.objects.create(name='P1', author='a')
+        Target.objects.create(
+            name='M31', telescope=self.telescope, program=program,
+            datetime_start=get_datetime(2020, 1, 1, 20))
+        self.post_bulk([
+            get_item('M31', '2021-01-04T18:00:00Z'),
+            get_item('NGC', '2021-01-04T19:00:00Z', program={'name': 'P2'}),
+            get_item('NGC', '2021-01-04T21:00:00Z'),
+        ])
+        self.assertEqual(
+            Target.objects.get(
+                name='M31', datetime_start=get_datetime(2021, 1, 4, 18)
+            ).program, program)
+        self.assertEqual(
+            Target.objects.get(
+                name='NGC', datetime_start=get_datetime(2021, 1, 4, 21)
+            ).program.name, 'P2')
+
+    def test_many_stored_names(self):
+        # Names already stored are looked up in one query, not one
+        # condition per name
+        start = get_datetime(2021, 1, 1)
+        items = [
+            get_item(f'T{i}', (start + dt.timedelta(minutes=i)).isoformat())
+            for i in range(1200)
+        ]
+        self.assertEqual(self.post_bulk(items).json()['created'], 1200)
+        items = [
+            get_item(f'T{i}', (start + dt.timedelta(days=1, minutes=i)).isoformat())
+            for i in range(1200)
+        ]
+        self.assertEqual(self.post_bulk(items).json()['created'], 1200)
+
+    def test_upsert(self):
+        self.post_bulk(
+            [get_item('M31', '2021-01-04T18:00:00Z', frames=get_frames(2))])
+        target = Target.objects.get()
+        target.note = 'keep'
+        target.save()
+
+        response = self.post_bulk([
+            get_item('M31', '2021-01-04T18:00:00Z', number_of_frames=5,
+                     frames=get_frames(5), colorfilters=[{'name': 'B'}]),
+            get_item('M31', '2021-01-04T18:00:00Z'),
+            get_item('NGC', '2021-01-04T19:00:00Z'),
+        ], upsert=True)
+        self.assertEqual(response.json()['created'], 1)
+        self.assertEqual(response.json()['updated'], 1)
+        self.assertEqual(len(response.json()['duplicates']), 1)
+
+        target = Target.objects.get(name='M31')
+        self.assertEqual(target.number_of_frames, 5)
+        self.assertEqual(target.note, 'keep')
+        self.assertEqual(target.frames.count(), 5)
+        self.assertEqual([c.name for c in target.colorfilters.all()], ['B'])
+        self.assertEqual(Frame.objects.count(), 5)
+
+
+class StatsCacheTests(ApiTestMixin, TransactionTestCase):
+    # Stats are dropped from the cache after the commit, so the tests run
+    # in transactions which are really committed
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.post_bulk([get_item('M31', '2021-01-04T18:00:00Z')])
+
+    def get_counts(self, url='/stats/targets/'):
+        return self.client.get(url).json()['counts']
+
+    def test_cached(self):
+        self.assertEqual(self.get_counts(), 1)
+        # Changes around the ORM signals stay unnoticed until the timeout
+        Target.objects.update(number_of_frames=5)
+        self.assertEqual(
+            self.client.get('/stats/targets/').json()['number_of_frames'], 2)
+
+    def test_invalidated_by_bulk_upload(self):
+        self.assertEqual(self.get_counts(), 1)
+        self.assertEqual(self.get_counts('/stats/targets/T60'), 1)
+        self.post_bulk([get_item('NGC', '2021-01-04T19:00:00Z')])
+        self.assertEqual(self.get_counts(), 2)
+        self.assertEqual(self.get_counts('/stats/targets/T60'), 2)
+
+    def test_invalidated_by_save_and_delete(self):
+        self.assertEqual(self.get_counts('/stats/targets/T60'), 1)
+        Target.objects.create(
+            name='NGC', telescope=self.telescope,
+            datetime_start=get_datetime(2021, 1, 5, 18))
+        self.assertEqual(self.get_counts('/stats/targets/T60'), 2)
+        Target.objects.get(name='M31').delete()
+        self.assertEqual(self.get_counts('/stats/targets/T60'), 1)
+
+    def test_other_telescope_kept(self):
+        other = Telescope.objects.create(name='T2')
+        self.assertEqual(self.get_counts('/stats/targets/T60'), 1)
+        self.post_bulk([get_item('NGC', '2021-01-04T19:00:00Z', telescope='T2')])
+        Target.objects.update(number_of_frames=5)
+        self.assertEqual(self.get_counts('/stats/targets/T60'), 1)
+        self.assertEqual(self.get_counts('/stats/targets/T2'), 1)
+        self.assertEqual(self.get_counts(), 2)
+        self.assertEqual(Target.objects.filter(telescope=other).count(), 1)
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_not_cached_per_process(self):
+        self.assertEqual(self.get_counts(), 1)
+        Target.objects.update(number_of_frames=5)
+        self.assertEqual(
+            self.client.get('/stats/targets/').json()['number_of_frames'], 5)
+        self.assertIsNone(cache.get('target_stats:all'))
+
+    def test_missing_cache_table(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE cache_table')
+        with self.assertLogs('django', 'ERROR'):
+            self.assertEqual(self.get_counts(), 1)
+            response = self.post_bulk(
+                [get_item('NGC', '2021-01-04T19:00:00Z')])
+        self.assertEqual(response.status_code, 201)
+        with self.assertLogs('django', 'ERROR'):
+            self.assertEqual(self.get_counts(), 2)
+
+        # Created again by the migration
+        migration = import_module('objects_log.migrations.0024_cache_table')
+        with connection.schema_editor() as schema_editor:
+            migration.create_cache_table(None, schema_editor)
+        self.assertIn('cache_table', connection.introspection.table_names())
+        self.assertEqual(self.get_counts(), 2)
+        Target.objects.update(number_of_frames=5)
+        self.assertEqual(
+            self.client.get('/stats/targets/').json()['number_of_frames'], 4)
+
+
+class TargetListTests(ApiTestCase):
+
+    def post_targets(self, number, start=None, **kwargs):
+        start = start or get_datetime(2021, 1, 4, 18)
+        self.post_bulk([
+            get_item(f'T{i}', (start + dt.timedelta(minutes=i)).isoformat(),
+                     program={'name': f'P{i}'},
+                     observers=[{'name': 'ABC'}, {'name': f'O{i}'}], **kwargs)
+            for i in range(number)
+        ])
+
+    def get_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_page(self):
+        self.post_targets(30)
+        for pagination in ('', '&pagination=cursor'):
+            self.assertEqual(
+                self.get_queries(f'/targets/?per_page=2{pagination}'),
+                self.get_queries(f'/targets/?per_page=30{pagination}'))
+
+    def test_related_fields(self):
+        self.post_targets(1)
+        target = self.client.get('/targets/').json()['results'][0]
+        self.assertEqual(target['program']['name'], 'P0')
+        self.assertEqual(
+            sorted(o['name'] for o in target['observers']), ['ABC', 'O0'])
+        self.assertEqual(
+            sorted(c['name'] for c in target['colorfilters']), ['R', 'V'])
+
+    def walk(self, url):
+        names = []
+        while url:
+            page = self.client.get(url).json()
+            names.extend(t['name'] for t in page['results'])
+            url = page['next']
+        return names
+
+    def test_cursor_pagination(self):
+        self.post_targets(7)
+        names = self.walk('/targets/?pagination=cursor&per_page=3')
+        self.assertEqual(names, [f'T{i}' for i in reversed(range(7))])
+
+    def test_cursor_pagination_ties(self):
+        # Targets of other telescopes may start at the same time, the id
+        # keeps pages apart
+        for i in range(2, 8):
+            Telescope.objects.create(name=f'T{i}')
+        self.post_bulk([
+            get_item(f'N{i}', '2021-01-04T18:00:00Z', telescope=f'T{i}')
+            for i in range(2, 8)
+        ] + [get_item('M31', '2021-01-04T17:00:00Z')])
+        names = self.walk('/targets/?pagination=cursor&per_page=4')
+        self.assertEqual(len(names), 7)
+        self.assertEqual(
+            names, list(Target.objects.order_by(
+                '-datetime_start', '-id').values_list('name', flat=True)))
+        self.assertEqual(names[-1], 'M31')
+
+    def test_cursor_page_size_limit(self):
+        self.post_targets(3)
+        page = self.client.get(
+            '/targets/?pagination=cursor&per_page=5000').json()
+        self.assertEqual(len(page['results']), 3)
+        self.assertEqual(views.TargetCursorPagination.max_page_size, 1000)
+
+
+class TargetFilterTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        Telescope.objects.create(name='T2')
+        self.post_bulk([
+            get_item('M31', '2021-01-04T18:00:00Z', program={'name': 'P1'}),
+            get_item('NGC', '2021-01-05T19:00:00Z',
+                     observers=[{'name': 'XYZ'}], colorfilters=[{'name': 'R'}]),
+            get_item('M31', '2021-01-06T20:00:00Z', telescope='T2',
+                     colorfilters=[{'name': 'B'}]),
+        ])
+        self.targets = {
+            t.datetime_start.day: t for t in Target.objects.all()}
+        self.targets[4].tags.add(
+            Tag.objects.create(name='var'), Tag.objects.create(name='cal'))
+        self.targets[5].tags.add(Tag.objects.get(name='var'))
+
+    def get_days(self, query):
+        response = self.client.get(f'/targets/?{query}')
+        self.assertEqual(response.status_code, 200)
+        return sorted(
+            int(t['datetime_start'][8:10]) for t in response.json()['results'])
+
+    def test_fields(self):
+        self.assertEqual(self.get_days('telescope=T2'), [6])
+        self.assertEqual(self.get_days('name=M31'), [4, 6])
+        # The later M31 target inherits the program
+        self.assertEqual(self.get_days('program=P1'), [4, 6])
+        self.assertEqual(self.get_days('observer=ABC'), [4, 6])
+        self.assertEqual(self.get_days('filter=R'), [4, 5])
+        self.assertEqual(self.get_days('name=M31&telescope=T60'), [4])
+        self.assertEqual(self.get_days('telescope=T3'), [])
+
+    def test_ranges(self):
+        self.assertEqual(self.get_days(
+            'datetime_start_after=2021-01-05T00:00:00Z'), [5, 6])
+        self.assertEqual(self.get_days(
+            'datetime_start_after=2021-01-04T18:00:00Z'
+            '&datetime_start_before=2021-01-05T19:00:00Z'), [4, 5])
+        jd = self.targets[5].jd_start
+        self.assertEqual(self.get_days(f'jd_min={jd}'), [5, 6])
+        self.assertEqual(self.get_days(f'jd_max={jd}'), [4, 5])
+
+    def test_nights(self):
+        night = self.targets[5].night.date
+        self.assertEqual(self.get_days(f'night={night}'), [5])
+        self.assertEqual(
+            self.get_days(f'night_range_after={night}'), [5, 6])
+        self.assertEqual(
+            self.get_days(f'night_range_before={night}'), [4, 5])
+
+    def test_distinct_many_to_many(self):
+        self.assertEqual(self.get_days('tag=var'), [4, 5])
+        self.assertEqual(self.get_days('tag=cal'), [4])
+        self.assertEqual(self.get_days('filter=V'), [4])
+
+    def test_invalid(self):
+        for query, field in (('datetime_start_after=yesterday',
+                              'datetime_start'),
+                             ('jd_min=x', 'jd'),
+                             ('night=2021-13-01', 'night')):
+            response = self.client.get(f'/targets/?{query}')
+            self.assertEqual(response.status_code, 400)
+            self.assertIn(field, response.json())
+
+
+class TargetExportTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        Telescope.objects.create(name='T2')
+        self.post_bulk([
+            get_item('M31', '2021-01-04T18:00:00Z', program={'name': 'P1'},
+                     observers=[{'name': 'XYZ'}, {'name': 'ABC'}],
+                     total_exposure_time=90),
+            get_item('NGC', '2021-01-05T19:00:00Z', telescope='T2'),
+        ])
+        Target.objects.get(name='NGC').tags.add(Tag.objects.create(name='var'))
+
+    def export(self, query=''):
+        response = self.client.get(f'/targets/export/?{query}')
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_ndjson(self):
+        response, content = self.export()
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['name'] for row in rows], ['NGC', 'M31'])
+        self.assertEqual(list(rows[0]), list(export.EXPORT_COLUMNS))
+        self.assertEqual(rows[1]['datetime_start'], '2021-01-04T18:00:00Z')
+        self.assertEqual(rows[1]['observers'], 'ABC, XYZ')
+        self.assertEqual(rows[1]['color_filters'], 'R, V')
+        self.assertEqual(rows[1]['program'], 'P1')
+        self.assertEqual(rows[1]['total_exposure_time_min'], 1.5)
+        self.assertEqual(rows[0]['tags'], 'var')
+        self.assertEqual(rows[0]['telescope'], 'T2')
+
+    def test_csv(self):
+        response, content = self.export('export_format=csv')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn('targets.csv', response['Content-Disposition'])
+        rows = list(csv.DictReader(io.StringIO(content)))
+        self.assertEqual([row['name'] for row in rows], ['NGC', 'M31'])
+        self.assertEqual(rows[1]['observers'], 'ABC, XYZ')
+
+    def test_filters(self):
+        content = self.export('telescope=T2')[1]
+        self.assertEqual(
+            [json.loads(line)['name'] for line in content.splitlines()],
+            ['NGC'])
+        self.assertEqual(self.export('name=Vega')[1], '')
+
+    def test_queries_per_chunk(self):
+        # One query for the targets and one per many to many relation
+        with self.assertNumQueries(4):
+            rows = list(export.iter_rows(Target.objects.all()))
+        self.assertEqual(len(rows), 2)
+
+    def test_invalid(self):
+        response = self.client.get('/targets/export/?export_format=xml')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/targets/export/?jd_min=x')
+        self.assertEqual(response.status_code, 400)
+
+
+class ExportJobTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.export_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.export_root)
+        settings = override_settings(EXPORT_ROOT=self.export_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.post_bulk([
+            get_item(f'T{i}', f'2021-01-04T18:0{i}:00Z') for i in range(5)])
+        self.admin = User.objects.create_superuser('admin', password='x')
+        self.client.force_login(self.admin)
+
+    def queue(self, export_format='csv'):
+        ids = Target.objects.values_list('pk', flat=True)
+        response = self.client.post(
+            '/admin/objects_log/target/',
+            {'action': f'export_{export_format}',
+             '_selected_action': list(ids)})
+        self.assertEqual(response.status_code, 302)
+        return ExportJob.objects.latest('pk')
+
+    def run_job(self):
+        job = run_export_jobs.claim_job()
+        self.assertTrue(run_export_jobs.run_job(job))
+        job.refresh_from_db()
+        return job
+
+    def test_queue(self):
+        job = self.queue('xlsx')
+        self.assertEqual(job.status, ExportJob.PENDING)
+        self.assertEqual(job.total, 5)
+        self.assertEqual(job.user, self.admin)
+        self.assertEqual(os.listdir(self.export_root), [])
+
+    def test_claim_once(self):
+        first = self.queue()
+        second = self.queue()
+        self.assertEqual(run_export_jobs.claim_job(), first)
+        self.assertEqual(run_export_jobs.claim_job(), second)
+        self.assertIsNone(run_export_jobs.claim_job())
+        first.refresh_from_db()
+        self.assertEqual(first.status, ExportJob.RUNNING)
+        self.assertIsNotNone(first.started)
+
+    def test_stale_job_failed(self):
+        stale = self.queue()
+        running = self.queue()
+        self.assertEqual(run_export_jobs.claim_job(), stale)
+        self.assertEqual(run_export_jobs.claim_job(), running)
+        ExportJob.objects.filter(pk=stale.pk).update(
+            started=timezone.now() - dt.timedelta(hours=2))
+        pending = self.queue()
+        with self.assertLogs('django', 'WARNING'):
+            self.assertEqual(run_export_jobs.claim_job(), pending)
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, ExportJob.FAILED)
+        self.assertIn('worker stopped', stale.error)
+        self.assertIsNotNone(stale.finished)
+        running.refresh_from_db()
+        self.assertEqual(running.status, ExportJob.RUNNING)
+        # Not claimed again
+        self.assertIsNone(run_export_jobs.claim_job(dt.timedelta(hours=3)))
+
+    @mock.patch.object(export, 'CHUNK_SIZE', 2)
+    def test_run_csv(self):
+        # Rows come in the order of the selection, over several chunks
+        self.queue()
+        # Targets deleted after the job was queued are left out
+        Target.objects.get(name='T3').delete()
+        job = self.run_job()
+        self.assertEqual(job.status, ExportJob.DONE)
+        self.assertEqual(job.processed, 5)
+        self.assertIsNotNone(job.finished)
+        with open(os.path.join(self.export_root, job.file)) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(
+            [row['name'] for row in rows], ['T4', 'T2', 'T1', 'T0'])
+
+    def test_run_json_and_xlsx(self):
+        from openpyxl import load_workbook
+
+        self.queue('json')
+        job = self.run_job()
+        with open(os.path.join(self.export_root, job.file)) as f:
+            self.assertEqual(len(json.load(f)), 5)
+        self.queue('xlsx')
+        job = self.run_job()
+        sheet = load_workbook(
+            os.path.join(self.export_root, job.file), read_only=True).active
+        rows = list(sheet.values)
+        self.assertEqual(rows[0], export.EXPORT_COLUMNS)
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[1][0], dt.datetime(2021, 1, 4, 18, 4))
+
+    def test_failed(self):
+        job = self.queue()
+        with mock.patch.object(
+                export, 'write_csv', side_effect=OSError('disk full')):
+            self.assertFalse(
+                run_export_jobs.run_job(run_export_jobs.claim_job()))
+        job.refresh_from_db()
+        self.assertEqual(job.status, ExportJob.FAILED)
+        self.assertEqual(job.error, 'disk full')
+        self.assertEqual(job.file, '')
+
+    def test_command(self):
+        self.queue()
+        self.queue('json')
+        out = io.StringIO()
+        call_command('run_export_jobs', '--once', stdout=out)
+        self.assertEqual(
+            ExportJob.objects.filter(status=ExportJob.DONE).count(), 2)
+        self.assertEqual(len(os.listdir(self.export_root)), 2)
+
+    def test_download_and_delete(self):
+        job = self.queue()
+        url = f'/admin/objects_log/exportjob/{job.pk}/download/'
+        self.assertEqual(self.client.get(url).status_code, 404)
+        job = self.run_job()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'T4', b''.join(response.streaming_content))
+        response.close()
+        self.client.logout()
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+        path = os.path.join(self.export_root, job.file)
+        self.assertTrue(os.path.exists(path))
+        job.delete()
+        self.assertFalse(os.path.exists(path))
+
+
+class ImportArchiveTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        make_archive(self.root, nights=2, frames=30, objects=3, shape=(8, 8))
+        # A frame whose observer name is too long for the database
+        hdr = get_header(dt.datetime(2021, 1, 5, 10), 'BAD', ['TOOLONG'],
+                         'V', 10.0, (8, 8), 999)
+        with open(os.path.join(self.root, '2021-01-05', 'bad.fits'),
+                  'wb') as f:
+            f.write(hdr.tostring().encode('ascii') + bytes(2880))
+        Telescope.objects.create(name='T60')
+
+    def import_archive(self, *args):
+        out = io.StringIO()
+        err = io.StringIO()
+        call_command('import_archive', 'T60', self.root, '-w', '1',
+                     '--frames', *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_import(self):
+        out, err = self.import_archive()
+        self.assertIn("'BAD'", err)
+        self.assertFalse(Target.objects.filter(name='BAD').exists())
+        self.assertEqual(Frame.objects.count(), 60)
+        self.assertEqual(
+            Target.objects.aggregate(n=Sum('number_of_frames'))['n'], 60)
+        self.assertEqual(
+            set(Target.objects.values_list('night__date', flat=True)),
+            {dt.date(2021, 1, 4), dt.date(2021, 1, 5)})
+        target = Target.objects.filter(name='OBJ 000').first()
+        self.assertEqual(
+            target.frames.count(), target.number_of_frames)
+        self.assertTrue(target.observers.exists())
+        created = Target.objects.count()
+        self.assertIn(f'{created} targets created', out)
+        self.assertIn('1 rejected', out)
+
+    def test_update(self):
+        self.import_archive()
+        targets = Target.objects.count()
+        Target.objects.update(number_of_frames=0)
+        out = self.import_archive()[0]
+        self.assertIn(f'0 targets created, 0 updated, {targets} already', out)
+        self.assertEqual(
+            Target.objects.aggregate(n=Sum('number_of_frames'))['n'], 0)
+        out = self.import_archive('--update')[0]
+        self.assertIn(f'0 targets created, {targets} updated', out)
+        self.assertEqual(
+            Target.objects.aggregate(n=Sum('number_of_frames'))['n'], 60)
+        self.assertEqual(Frame.objects.count(), 60)
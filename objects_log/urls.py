@@ -5,6 +5,8 @@ from django.contrib import admin
 urlpatterns = [
     # path('', admin.site.urls),
     path('targets/', views.target_list),
+    path('targets/bulk/', views.target_bulk),
+    path('targets/export/', views.target_export),
     path('targets/<int:pk>/', views.target_detail),
     path('stats/targets/', views.targets_stats),
     path('stats/targets/<str:tname>', views.targets_stats_telescope),
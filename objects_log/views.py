@@ -3,12 +3,15 @@ from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework import permissions
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import PageNumberPagination, CursorPagination
 
 from objects_log.models import Target, Telescope
-from objects_log.serializers import TargetSerializer, TargetStatsSerializer
+from objects_log.filters import TargetFilter
+from objects_log.serializers import TargetSerializer, TargetBulkSerializer
+from objects_log import export, stats
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.http import StreamingHttpResponse
 import logging
 
 logger = logging.getLogger('django')
@@ -19,13 +22,35 @@ class StandardResultsSetPagination(PageNumberPagination):
     page_size_query_param = 'per_page'
     max_page_size = 100
 
+
+class TargetCursorPagination(CursorPagination):
+    # Keyset pagination for walking the whole log (?pagination=cursor), the
+    # cost of a page does not grow with its position like OFFSET does
+    page_size = 25
+    page_size_query_param = 'per_page'
+    max_page_size = 1000
+    ordering = ('-datetime_start', '-id')
+
+
+def get_target_paginator(request):
+    if request.query_params.get('pagination') == 'cursor':
+        return TargetCursorPagination()
+    return StandardResultsSetPagination()
+
 @api_view(['GET', 'POST'])
 @permission_classes((permissions.IsAuthenticated,))
 def target_list(request):
 
     if request.method == 'GET':
-        paginator = StandardResultsSetPagination()
-        targets = Target.objects.all()
+        paginator = get_target_paginator(request)
+        targets = Target.objects.select_related(
+            'program', 'telescope').prefetch_related(
+                'colorfilters', 'observers')
+        filterset = TargetFilter(request.query_params, queryset=targets)
+        if not filterset.is_valid():
+            return Response(
+                filterset.errors, status=status.HTTP_400_BAD_REQUEST)
+        targets = filterset.qs
         result_page = paginator.paginate_queryset(targets, request)
         serializer = TargetSerializer(result_page, many=True)
         return paginator.get_paginated_response(serializer.data)
@@ -39,6 +64,51 @@ def target_list(request):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(['POST'])
+@permission_classes((permissions.IsAuthenticated,))
+def target_bulk(request):
+
+    if request.method == 'POST':
+        upsert = request.query_params.get('upsert') in ('1', 'true')
+        serializer = TargetBulkSerializer(
+            data=request.data, many=True, context={'upsert': upsert})
+        if serializer.is_valid():
+            targets = serializer.save()
+            if serializer.rejected:
+                logger.error(f'Rejected targets: {serializer.rejected}')
+            return Response({
+                'created': len(targets),
+                'updated': len(serializer.updates),
+                'duplicates': serializer.duplicates,
+                'rejected': serializer.rejected,
+            }, status=status.HTTP_201_CREATED)
+        logger.error(f"{request.data}\n {serializer.errors}")
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(['GET'])
+@permission_classes((permissions.IsAuthenticated,))
+def target_export(request):
+    # Streams all targets matching the list filters, `export_format` is
+    # ndjson (default) or csv
+    export_format = request.query_params.get('export_format', 'ndjson')
+    if export_format not in export.EXPORT_FORMATS:
+        return Response(
+            f'Unknown export format {export_format}, use one of: '
+            f'{", ".join(export.EXPORT_FORMATS)}',
+            status=status.HTTP_400_BAD_REQUEST)
+    filterset = TargetFilter(request.query_params, queryset=Target.objects.all())
+    if not filterset.is_valid():
+        return Response(filterset.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    response = StreamingHttpResponse(
+        export.iter_export(filterset.qs, export_format),
+        content_type=export.EXPORT_FORMATS[export_format])
+    response['Content-Disposition'] = \
+        f'attachment; filename="targets.{export_format}"'
+    return response
+
+
 @api_view(['GET', 'PUT', 'DELETE'])
 @permission_classes((permissions.IsAuthenticated,))
 def target_detail(request, pk):
@@ -66,9 +136,7 @@ def target_detail(request, pk):
 def targets_stats(request):
 
     if request.method == 'GET':
-        targets = Target.objects.all()
-        serializer = TargetStatsSerializer(targets)
-        return Response(serializer.data)
+        return Response(stats.get_target_stats())
 
 @api_view(['GET'])
 @permission_classes((permissions.IsAuthenticated,))
@@ -80,6 +148,4 @@ def targets_stats_telescope(request, tname):
         except ObjectDoesNotExist:
             return Response(f'The {tname} telescope was not found in the DB',
                 status=status.HTTP_400_BAD_REQUEST)
-        targets = Target.objects.filter(telescope=telescope)
-        serializer = TargetStatsSerializer(targets)
-        return Response(serializer.data)
\ No newline at end of file
+        return Response(stats.get_target_stats(telescope))
\ No newline at end of file
@@ -42,6 +42,7 @@ INSTALLED_APPS = [
     'grappelli',
     'objects_log.apps.ObjectsLogConfig',
     'rest_framework',
+    'django_filters',
     'corsheaders',
     'django_extensions',
     'rangefilter',
@@ -122,6 +123,19 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 100,
 }
 
+# Target stats are cached. Targets also change in other processes
+# (import_archive, run_export_jobs, other web workers), so the cache must
+# be shared: the table of the default database cache is created by the
+# migrations. Stats are not cached with a per process backend like
+# LocMemCache, or when the cache raises database errors
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get(
+            'CACHE_BACKEND', 'django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'cache_table'),
+    }
+}
+
 
 
 # Password validation
@@ -149,6 +163,10 @@ PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(PROJECT_ROOT, 'static')
 
+# Files written by the run_export_jobs worker
+EXPORT_ROOT = os.environ.get(
+    'EXPORT_ROOT', os.path.join(PROJECT_ROOT, 'exports'))
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
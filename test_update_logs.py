@@ -0,0 +1,933 @@
+import bz2
+import datetime as dt
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import update_logs
+
+
+class CheckpointsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.checkpoints = update_logs.Checkpoints(
+            os.path.join(self.tmp_dir, 'state.sqlite'), 'T60')
+        self.dirs = [
+            os.path.join(self.tmp_dir, d)
+            for d in ('2021-01-05', '2021-01-06', '2021-01-07')
+        ]
+
+    def tearDown(self):
+        self.checkpoints.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def read(self, directory, targets=()):
+        self.checkpoints.queue(directory, targets)
+        self.checkpoints.update(
+            directory, 1, 1, map(update_logs.get_target_key, targets))
+
+    def test_resume_from_newest_read_directory(self):
+        self.checkpoints.plan(self.dirs)
+        for directory in self.dirs:
+            self.read(directory)
+        self.assertEqual(
+            self.checkpoints.get_resume_directory(), self.dirs[-1])
+
+    def test_resume_from_oldest_unread_directory(self):
+        # The newest night is read first, a run stopped after it must not
+        # skip the older nights
+        self.checkpoints.plan(self.dirs)
+        self.read(self.dirs[-1])
+        self.assertEqual(self.checkpoints.get_resume_directory(), self.dirs[0])
+        self.read(self.dirs[0])
+        self.assertEqual(self.checkpoints.get_resume_directory(), self.dirs[1])
+
+    def test_resume_from_queued_targets(self):
+        target = {'telescope': 'T60', 'name': 'M31',
+                  'datetime_start': '2021-01-05T20:00:00'}
+        self.checkpoints.plan(self.dirs)
+        self.read(self.dirs[0], [target])
+        self.read(self.dirs[1])
+        self.read(self.dirs[2])
+        self.assertEqual(self.checkpoints.get_resume_directory(), self.dirs[0])
+        self.checkpoints.set_done(target)
+        self.assertEqual(
+            self.checkpoints.get_resume_directory(), self.dirs[-1])
+
+
+class AliasDictTests(unittest.TestCase):
+
+    def test_aliases(self):
+        names_dict = update_logs.AliasDict(
+            {'Andromeda': {'M31', 'NGC 224'}, 'M33': {'TRIANGULUM'}})
+        self.assertEqual(
+            update_logs.check_in_dict(names_dict, ' ngc 224 '), 'Andromeda')
+        self.assertEqual(update_logs.check_in_dict(names_dict, 'm33'), 'M33')
+        self.assertEqual(
+            update_logs.check_in_dict(names_dict, 'Unknown'), 'Unknown')
+
+    def test_ambiguous_alias(self):
+        with self.assertLogs(update_logs.logger, 'WARNING') as logs:
+            names_dict = update_logs.AliasDict(
+                {'M42': {'ORION', 'NGC 1976'}, 'B33': {'ORION'}})
+        self.assertIn("Alias ORION is ambiguous, used by: ['B33', 'M42']",
+                      logs.output[0])
+        self.assertEqual(names_dict.ambiguous, {'ORION': {'B33', 'M42'}})
+        self.assertNotIn('ORION', names_dict.index)
+        # The raw name is kept, not one of the owners picked at random
+        with self.assertLogs(update_logs.logger, 'WARNING') as logs:
+            self.assertEqual(
+                update_logs.check_in_dict(names_dict, 'Orion '), 'Orion')
+        self.assertIn('Name Orion is ambiguous', logs.output[0])
+        self.assertEqual(
+            update_logs.check_in_dict(names_dict, 'ngc 1976'), 'M42')
+
+    def test_alias_also_a_name(self):
+        with self.assertLogs(update_logs.logger, 'WARNING') as logs:
+            names_dict = update_logs.AliasDict(
+                {'Pleiades': {'M45'}, 'M45': {'SEVEN SISTERS'}})
+        self.assertIn('Alias M45 of Pleiades is also a name', logs.output[0])
+        # The name wins over the alias
+        self.assertEqual(update_logs.check_in_dict(names_dict, 'm45'), 'M45')
+        self.assertEqual(
+            update_logs.check_in_dict(names_dict, 'seven sisters'), 'M45')
+
+    def test_memo_reset_by_build_index(self):
+        names_dict = update_logs.AliasDict({'Andromeda': {'M31'}})
+        self.assertEqual(update_logs.check_in_dict(names_dict, 'M32'), 'M32')
+        self.assertEqual(names_dict.memo, {'M32': 'M32'})
+        names_dict['Andromeda'].add('M32')
+        # Memoized until the index is built again
+        self.assertEqual(update_logs.check_in_dict(names_dict, 'M32'), 'M32')
+        names_dict.build_index()
+        self.assertEqual(names_dict.memo, {})
+        self.assertEqual(
+            update_logs.check_in_dict(names_dict, 'M32'), 'Andromeda')
+
+
+class OutboxTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmp_dir, 'state.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_old_rejected_pruned(self):
+        outbox = update_logs.Outbox(self.state_file)
+        now = time.time()
+        with mock.patch.object(update_logs.time, 'time',
+                               return_value=now - 2 * 24 * 3600):
+            outbox.put({'name': 'old pending'})
+            outbox.put_rejected([{'name': 'old'}], 'error')
+        outbox.put_rejected([{'name': 'new'}], 'error')
+        outbox.close()
+
+        with self.assertLogs(update_logs.logger, 'INFO') as logs:
+            outbox = update_logs.Outbox(
+                self.state_file, keep_rejected=24 * 3600)
+        self.assertIn('1 rejected outbox items deleted', logs.output[0])
+        self.assertEqual(outbox.count(update_logs.OUTBOX_REJECTED), 1)
+        self.assertEqual(
+            [data for _, data in outbox.get_pending([], 10)],
+            [{'name': 'old pending'}])
+        outbox.close()
+
+
+class Response:
+
+    def __init__(self, status_code, rejected=()):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.content = b'error'
+        self.rejected = list(rejected)
+
+    def json(self):
+        return {'created': 1, 'updated': 0, 'duplicates': [],
+                'rejected': self.rejected}
+
+
+class StubUploader:
+    # Answers every post with the same status, in the calling thread
+    max_workers = 2
+
+    def __init__(self, status_code, rejected=()):
+        self.status_code = status_code
+        self.rejected = rejected
+        self.posts = 0
+
+    def submit(self, url, data, callback=None, errback=None):
+        self.posts += 1
+        callback(Response(self.status_code, self.rejected), data)
+
+    def join(self):
+        pass
+
+
+class OutboxSenderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.outbox = update_logs.Outbox(
+            os.path.join(self.tmp_dir, 'state.sqlite'))
+
+    def tearDown(self):
+        self.outbox.close()
+        shutil.rmtree(self.tmp_dir)
+
+    @mock.patch.dict(update_logs.config, {'UPLOAD_URL': 'http://api/targets/'})
+    def send(self, uploader, retry_interval, seconds,
+             data=({'name': 'M31'},)):
+        sender = update_logs.OutboxSender(
+            self.outbox, uploader, retry_interval).start()
+        sender.submit(None, list(data))
+        time.sleep(seconds)
+        sender.join()
+
+    def test_server_error_pauses_sending(self):
+        uploader = StubUploader(500)
+        self.send(uploader, retry_interval=60, seconds=0.3)
+        self.assertEqual(uploader.posts, 1)
+        self.assertEqual(self.outbox.count(), 1)
+
+    def test_server_error_rejects_after_max_attempts(self):
+        uploader = StubUploader(500)
+        self.send(uploader, retry_interval=0.01, seconds=0.5)
+        self.assertEqual(uploader.posts, update_logs.OUTBOX_MAX_ATTEMPTS)
+        self.assertEqual(self.outbox.count(), 0)
+        self.assertEqual(
+            self.outbox.count(update_logs.OUTBOX_REJECTED), 1)
+
+    def test_rejected_items_only(self):
+        # One invalid target does not reject the rest of its bulk upload
+        uploader = StubUploader(201, rejected=[
+            {'index': 1, 'errors': {'observers': ['Too long']}}])
+        self.send(uploader, retry_interval=60, seconds=0.1,
+                  data=[{'name': 'M31'}, {'name': 'NGC'}, {'name': 'M33'}])
+        self.assertEqual(self.outbox.count(), 0)
+        payload, error = self.outbox.db.execute(
+            'SELECT payload, last_error FROM outbox WHERE status = ?',
+            (update_logs.OUTBOX_REJECTED,)).fetchone()
+        self.assertEqual(json.loads(payload), [{'name': 'NGC'}])
+        self.assertIn('Too long', error)
+
+    def test_sent(self):
+        uploader = StubUploader(201)
+        self.send(uploader, retry_interval=60, seconds=0.1)
+        self.assertEqual(uploader.posts, 1)
+        self.assertEqual(self.outbox.count(), 0)
+        self.assertEqual(
+            self.outbox.count(update_logs.OUTBOX_REJECTED), 0)
+
+
+class StubSession:
+    # Answers posts with the given statuses in turn, an exception instance
+    # is raised instead
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.posts = []
+        self.lock = threading.Lock()
+
+    def post(self, url, data, timeout):
+        with self.lock:
+            self.posts.append(json.loads(data))
+            answer = self.answers.pop(0) if len(self.answers) > 1 \
+                else self.answers[0]
+        if isinstance(answer, Exception):
+            raise answer
+        return Response(answer)
+
+    def close(self):
+        pass
+
+
+@mock.patch.dict(update_logs.config,
+                 {'REST_USER': 'user', 'REST_PASSWORD': 'password'})
+class UploaderTests(unittest.TestCase):
+
+    def get_uploader(self, *answers, max_workers=4, retries=2):
+        uploader = update_logs.Uploader(
+            max_workers=max_workers, retries=retries, backoff=0.5)
+        uploader.session = StubSession(*answers)
+        self.addCleanup(uploader.close)
+        return uploader
+
+    def test_adaptive_limit(self):
+        uploader = self.get_uploader(201)
+        self.assertEqual(uploader.limit, 2)
+        # One step up for each window near the best latency
+        for latency in [0.1] * 2 + [0.1] * 3:
+            uploader.record_latency(latency)
+        self.assertEqual(uploader.limit, 4)
+        # Never above max_workers
+        for latency in [0.15] * 4:
+            uploader.record_latency(latency)
+        self.assertEqual(uploader.limit, 4)
+        self.assertEqual(uploader.best_latency, 0.1)
+        # Halved when latency rises above LATENCY_TOLERANCE times the best
+        for latency in [0.5] * 4 + [0.3] * 2 + [1.0]:
+            uploader.record_latency(latency)
+        self.assertEqual(uploader.limit, 1)
+        # An incomplete window does not change the limit
+        uploader.limit = 2
+        uploader.record_latency(0.1)
+        self.assertEqual(uploader.limit, 2)
+        uploader.record_latency(0.1)
+        self.assertEqual(uploader.limit, 3)
+        self.assertEqual(len(uploader.latencies), 18)
+
+    @mock.patch.object(update_logs.time, 'sleep')
+    def test_retries(self, sleep):
+        import requests
+
+        uploader = self.get_uploader(
+            503, requests.ConnectionError('refused'), 429, 201, retries=3)
+        self.assertEqual(
+            uploader.post('http://api/targets/', {'name': 'M31'}).status_code,
+            201)
+        self.assertEqual(len(uploader.session.posts), 4)
+        self.assertEqual(
+            [c.args[0] for c in sleep.call_args_list], [0.5, 1.0, 2.0])
+        # Other errors are answers, not retried
+        uploader = self.get_uploader(400)
+        self.assertEqual(uploader.post('http://api/', {}).status_code, 400)
+        self.assertEqual(len(uploader.session.posts), 1)
+        for status in update_logs.RETRY_STATUSES:
+            uploader = self.get_uploader(status)
+            with self.assertLogs(update_logs.logger, 'ERROR'):
+                with self.assertRaisesRegex(Exception, 'No connection'):
+                    uploader.post('http://api/', {})
+            self.assertEqual(len(uploader.session.posts), 3)
+
+    @mock.patch.object(update_logs.time, 'sleep')
+    def test_errors_through_join(self, sleep):
+        responses = []
+        uploader = self.get_uploader(201, max_workers=2)
+        for i in range(6):
+            uploader.submit('http://api/', {'name': f'M{i}'},
+                            lambda response, data: responses.append(data))
+        uploader.join()
+        self.assertEqual(len(responses), 6)
+        self.assertEqual(uploader.in_flight, 0)
+
+        # Without errback the first failure stops the upload
+        uploader = self.get_uploader(503, max_workers=2)
+        with self.assertLogs(update_logs.logger, 'ERROR'):
+            uploader.submit('http://api/', {'name': 'M31'})
+            with self.assertRaisesRegex(Exception, 'No connection'):
+                uploader.join()
+        with self.assertRaisesRegex(Exception, 'No connection'):
+            uploader.submit('http://api/', {'name': 'M32'})
+        self.assertEqual(len(uploader.session.posts), 3)
+
+        # With errback it is passed the error and the data
+        failed = []
+        uploader = self.get_uploader(503, max_workers=2)
+        with self.assertLogs(update_logs.logger, 'ERROR'):
+            for i in range(2):
+                uploader.submit(
+                    'http://api/', {'name': f'M{i}'},
+                    errback=lambda e, data: failed.append((str(e), data)))
+            uploader.join()
+        self.assertEqual(sorted(data['name'] for _, data in failed),
+                         ['M0', 'M1'])
+        self.assertIn('No connection', failed[0][0])
+        self.assertIsNone(uploader.error)
+
+
+def get_rows(name, start, number, minutes=1):
+    # Rows of frames taken every minutes from start
+    return [
+        {
+            'obs_datetime': start + dt.timedelta(minutes=i * minutes),
+            'object_name': name,
+            'observers': [{'name': 'ABC'}],
+            'color_filter': 'V',
+            'exptime': 30.0,
+            'ccd_temp': -20.0,
+            'path': f'/data/{name}_{i}.fits',
+        }
+        for i in range(number)
+    ]
+
+
+@mock.patch.object(update_logs, 'TABLE_CHUNK', 4)
+class VisitGrouperTests(unittest.TestCase):
+    gap = update_logs.get_visit_gap(30)
+
+    def group(self, rows, visit_gap):
+        table = update_logs.FrameTable()
+        for row in rows:
+            table.append(row)
+        return update_logs.group_frame_table(table, 'T60', visit_gap, True)
+
+    def stream(self, rows, visit_gap):
+        grouper = update_logs.VisitGrouper('T60', visit_gap, True)
+        early = {}
+        for row in rows:
+            early.update(grouper.append(row))
+        return early, grouper.close(), len(grouper.table)
+
+    def test_final_visits_come_early(self):
+        start = dt.datetime(2021, 1, 4, 18)
+        rows = sorted(
+            get_rows('M31', start, 10)
+            + get_rows('NGC', start + dt.timedelta(minutes=20), 10)
+            + get_rows('M31', start + dt.timedelta(hours=3), 10),
+            key=lambda row: row['obs_datetime'])
+        early, rest, left = self.stream(rows, self.gap)
+        self.assertEqual(
+            sorted(t['name'] for t in early.values()), ['M31', 'NGC'])
+        self.assertEqual(left, 10)
+        self.assertEqual({**early, **rest}, self.group(rows, self.gap))
+
+    def test_out_of_order(self):
+        start = dt.datetime(2021, 1, 4, 18)
+        rows = get_rows('NGC', start + dt.timedelta(hours=4), 10) \
+            + get_rows('M31', start, 10, minutes=20)
+        early, rest, left = self.stream(rows, self.gap)
+        self.assertEqual(early, {})
+        self.assertEqual(rest, self.group(rows, self.gap))
+
+    def test_without_visit_gap(self):
+        start = dt.datetime(2021, 1, 4, 18)
+        rows = get_rows('M31', start, 10, minutes=60)
+        early, rest, left = self.stream(rows, None)
+        self.assertEqual(early, {})
+        self.assertEqual(len(rest), 1)
+        self.assertEqual(rest, self.group(rows, None))
+
+    def test_paths_only_with_frames(self):
+        grouper = update_logs.VisitGrouper('T60', self.gap)
+        for row in get_rows('M31', dt.datetime(2021, 1, 4, 18), 3):
+            grouper.append(row)
+        self.assertIsNone(grouper.table.paths)
+        self.assertNotIn('frames', list(grouper.close().values())[0])
+
+
+def write_frame(directory, name, obs_datetime, file_name=None):
+    # Written next to its final name and renamed, like cameras do
+    import numpy as np
+    from astropy.io import fits
+
+    header = fits.Header()
+    header['DATE-OBS'] = obs_datetime.isoformat()
+    header['OBJECT'] = name
+    header['OBSERVER'] = 'ABC'
+    header['FILTER'] = 'V'
+    header['EXPTIME'] = 30.0
+    file_name = file_name or f'{name}_{obs_datetime:%H%M%S}.fits'
+    tmp_path = os.path.join(directory, f'.{file_name}.tmp')
+    fits.PrimaryHDU(
+        np.zeros((8, 8), dtype=np.int16), header=header).writeto(tmp_path)
+    os.rename(tmp_path, os.path.join(directory, file_name))
+
+
+class StubSender:
+    # Collects what follow sends, in place of the uploader and the outbox
+
+    def __init__(self):
+        self.targets = []
+        self.sent = threading.Event()
+
+    def submit(self, url, data, callback=None):
+        self.targets.extend(data)
+        self.sent.set()
+
+    def join(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FollowTests(unittest.TestCase):
+    start = dt.datetime(2021, 2, 1, 20)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.night_dir = os.path.join(self.tmp_dir, '2021-02-02')
+        os.mkdir(self.night_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_frames(self, sender, number):
+        # Number of frames of the last target sent, within a few seconds
+        for _ in range(50):
+            if sender.sent.wait(0.1):
+                sender.sent.clear()
+                if sender.targets[-1]['number_of_frames'] == number:
+                    return number
+        return sender.targets[-1]['number_of_frames'] \
+            if sender.targets else None
+
+    def follow(self, polling):
+        sender = StubSender()
+        stop = threading.Event()
+        get_night_dir = update_logs.get_night_dir
+
+        def get_night_dir_until_stopped(data_dir):
+            if stop.is_set():
+                raise KeyboardInterrupt
+            return get_night_dir(data_dir)
+
+        for i in range(2):
+            write_frame(
+                self.night_dir, 'M31', self.start + dt.timedelta(minutes=i))
+        with mock.patch.object(
+                update_logs, 'get_sender', return_value=(sender, sender)), \
+                mock.patch.object(
+                    update_logs, 'get_dir_state',
+                    wraps=update_logs.get_dir_state) as get_dir_state, \
+                mock.patch.object(
+                    update_logs, 'get_night_dir', get_night_dir_until_stopped), \
+                mock.patch.dict(
+                    update_logs.config, {'UPLOAD_URL': 'http://api/targets/'}):
+            thread = threading.Thread(
+                target=update_logs.follow,
+                args=(self.tmp_dir, 'T60', update_logs.AliasDict(),
+                      update_logs.AliasDict(), update_logs.AliasDict()),
+                kwargs={'bulk_size': 10, 'interval': 0.1,
+                        'polling': polling,
+                        'visit_gap': update_logs.get_visit_gap(30)})
+            thread.start()
+            try:
+                self.assertEqual(self.get_frames(sender, 2), 2)
+                for i in range(2, 4):
+                    write_frame(self.night_dir, 'M31',
+                                self.start + dt.timedelta(minutes=i))
+                self.assertEqual(self.get_frames(sender, 4), 4)
+                # A frame written again replaces the one read before
+                write_frame(self.night_dir, 'M33',
+                            self.start + dt.timedelta(minutes=3),
+                            'M31_200300.fits')
+                self.assertEqual(self.get_frames(sender, 1), 1)
+            finally:
+                stop.set()
+                thread.join(5)
+        targets = {t['name']: t for t in sender.targets}
+        self.assertEqual(targets['M31']['number_of_frames'], 3)
+        self.assertEqual(
+            targets['M31']['datetime_start'], self.start.isoformat())
+        self.assertEqual(targets['M33']['number_of_frames'], 1)
+        # Only the frames just written are looked at, once each
+        self.assertEqual(
+            sum(len(c.args[0]) for c in get_dir_state.call_args_list), 5)
+
+    def test_follow_inotify(self):
+        try:
+            import inotify_simple  # noqa: F401
+        except ImportError:
+            self.skipTest('inotify_simple not installed')
+        with mock.patch.object(
+                update_logs, 'PollingWatcher',
+                side_effect=AssertionError('polling instead of inotify')):
+            self.follow(polling=False)
+
+    def test_follow_polling(self):
+        self.follow(polling=True)
+
+
+
+class DoneSender(StubSender):
+    # Answers every upload at once, like OutboxSender with checkpoints
+
+    def __init__(self, checkpoints):
+        super().__init__()
+        self.checkpoints = checkpoints
+
+    def submit(self, url, data, callback=None):
+        super().submit(url, data, callback)
+        for target in data:
+            self.checkpoints.set_done(target)
+
+
+@mock.patch.dict(update_logs.config, {'UPLOAD_URL': 'http://api/targets/'})
+class ProcessDirsTests(unittest.TestCase):
+    start = dt.datetime(2021, 2, 1, 20)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.night_dir = os.path.join(self.tmp_dir, '2021-02-02')
+        os.mkdir(self.night_dir)
+        for i in range(3):
+            write_frame(
+                self.night_dir, 'M31', self.start + dt.timedelta(minutes=i))
+        state_file = os.path.join(self.tmp_dir, 'state.sqlite')
+        self.checkpoints = update_logs.Checkpoints(state_file, 'T60')
+        self.manifest = update_logs.open_manifest(state_file)
+
+    def tearDown(self):
+        self.checkpoints.close()
+        self.manifest.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def process(self, names_dict=None, full_scan=False):
+        sender = DoneSender(self.checkpoints)
+        update_logs.process_dirs(
+            [self.night_dir], 'T60', names_dict or update_logs.AliasDict(),
+            update_logs.AliasDict(), update_logs.AliasDict(), sender,
+            manifest=self.manifest, bulk_size=10,
+            visit_gap=update_logs.get_visit_gap(30),
+            checkpoints=self.checkpoints, full_scan=full_scan)
+        return [target['name'] for target in sender.targets]
+
+    def test_full_scan_after_dictionary_fix(self):
+        # Frames of a past night, whose mtimes are trusted
+        self.set_mtimes(time.time_ns() - 3600 * 10 ** 9)
+        self.assertEqual(self.process(), ['M31'])
+        self.assertEqual(self.process(), [])
+        names_dict = update_logs.AliasDict({'Andromeda': {'M31'}})
+        self.assertEqual(self.process(names_dict), [])
+        self.assertEqual(
+            self.process(names_dict, full_scan=True), ['Andromeda'])
+        self.assertEqual(self.process(names_dict, full_scan=True), [])
+
+    def set_mtimes(self, mtime_ns):
+        for path in update_logs.get_files(self.night_dir) + [self.night_dir]:
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    def test_recent_mtimes_not_trusted(self):
+        self.assertEqual(self.process(), ['M31'])
+        # The first frame is rewritten within the same timestamp tick
+        mtime_ns = os.stat(self.night_dir).st_mtime_ns
+        frame = update_logs.get_files(self.night_dir)[0]
+        other_dir = os.path.join(self.tmp_dir, 'other')
+        os.mkdir(other_dir)
+        write_frame(other_dir, 'NGC', self.start)
+        shutil.copyfile(update_logs.get_files(other_dir)[0], frame)
+        self.set_mtimes(mtime_ns)
+        self.assertIn('NGC', self.process())
+
+        self.set_mtimes(time.time_ns() - 3600 * 10 ** 9)
+        self.process()
+        self.assertTrue(self.checkpoints.is_unchanged(
+            self.night_dir, update_logs.get_tree_mtime(self.night_dir)))
+
+
+def get_header_bytes(*cards, blocks=None):
+    # Raw header of the given cards, padded to whole FITS blocks
+    header = b''.join(card.encode('ascii').ljust(80) for card in
+                      ('SIMPLE  =                    T',) + cards + ('END',))
+    size = blocks * 2880 if blocks else -(-len(header) // 2880) * 2880
+    return header.ljust(size)
+
+
+def write_header(directory, *cards, name='frame.fits'):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(get_header_bytes(*cards) + bytes(2880))
+    return path
+
+
+FRAME_CARDS = (
+    "DATE-OBS= '2021-02-01T20:00:00.123' / start of exposure",
+    "OBJECT  = 'O''Brien 1'",
+    "OBSERVER= 'ABC XYZ '",
+    "FILTER  = 'V       '",
+    'EXPTIME =                 3D1 / seconds',
+    'CCD-TEMP=            -2.05E+1',
+    'GAIN    =                    2',
+    'FLIPSTAT=                    F',
+    'EMPTY   =',
+)
+
+
+class HeaderReaderTests(unittest.TestCase):
+
+    def setUp(self):
+        import numpy as np
+        from astropy.io import fits
+
+        self.tmp_dir = tempfile.mkdtemp()
+        header = fits.Header()
+        for card in FRAME_CARDS[:6]:
+            header.append(fits.Card.fromstring(card))
+        for i in range(40):
+            header.add_comment(f'Comment {i}, so the header takes 2 blocks')
+        # Random data does not compress, it is much larger than the header
+        data = np.random.RandomState(0).randint(
+            0, 30000, (1024, 1024)).astype(np.int16)
+        self.frame = os.path.join(self.tmp_dir, 'frame.fits')
+        fits.PrimaryHDU(data, header=header).writeto(self.frame)
+        with open(self.frame, 'rb') as f:
+            self.raw = f.read()
+        self.frames = {'.fits': self.frame}
+        for ext, module in (('.gz', gzip), ('.bz2', bz2)):
+            self.frames[ext] = self.write(
+                f'frame.fits{ext}', module.compress(self.raw))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def read(self, path):
+        start = update_logs.read_stats['bytes']
+        hdr = update_logs.read_header(path)
+        return hdr, update_logs.read_stats['bytes'] - start
+
+    def test_same_header_as_astropy(self):
+        from astropy.io import fits
+
+        expected = dict(fits.getheader(self.frame))
+        for ext, path in self.frames.items():
+            hdr, _ = self.read(path)
+            self.assertEqual(hdr, expected, ext)
+            self.assertEqual(hdr, dict(fits.getheader(path)), ext)
+            self.assertEqual(
+                update_logs.read_header(path, update_logs.KEYWORDS)['OBJECT'],
+                "O'Brien 1", ext)
+
+    def test_stops_at_end(self):
+        # Only the header blocks are read, or for compressed frames the
+        # buffered start of the file
+        self.assertEqual(self.read(self.frames['.fits'])[1], 2 * 2880)
+        self.assertLess(self.read(self.frames['.gz'])[1], 64 * 1024)
+        self.assertLess(
+            self.read(self.frames['.bz2'])[1],
+            os.path.getsize(self.frames['.bz2']))
+        path = self.write('end.fits.gz', gzip.compress(
+            self.raw[:2 * 2880] + b'junk after the header'))
+        self.assertEqual(self.read(path)[0]['OBJECT'], "O'Brien 1")
+
+    def assert_problem(self, path, message):
+        frame, error = update_logs.get_file_frame(path)
+        self.assertIsNone(frame)
+        self.assertIn('HDR problem in file', error[1])
+        self.assertIn(message, error[1])
+
+    def test_empty_and_junk(self):
+        self.assert_problem(self.write('empty.fits', b''), 'No SIMPLE card')
+        self.assert_problem(
+            self.write('empty.fits.gz', b''), 'No SIMPLE card')
+        self.assert_problem(self.write('empty.fits.bz2', b''), 'ended before')
+        junk = bytes(range(256)) * 20
+        self.assert_problem(self.write('junk.fits', junk), 'No SIMPLE card')
+        self.assert_problem(self.write('junk.fits.gz', junk), 'gzip')
+        self.assert_problem(
+            self.write('junk.fits.bz2', junk), 'Invalid data stream')
+
+    def test_truncated(self):
+        # A header without its END card is reported, not read partially
+        for ext, module in (('', None), ('.gz', gzip), ('.bz2', bz2)):
+            content = self.raw[:3000]
+            if module:
+                content = module.compress(content)
+            self.assert_problem(
+                self.write(f'header.fits{ext}', content), 'No END card')
+        # Cut inside the compressed stream before END
+        self.assert_problem(
+            self.write('stream.fits.gz', gzip.compress(self.raw)[:100]),
+            'HDR problem')
+        # The data part is not needed
+        path = self.write('data.fits', self.raw[:3 * 2880])
+        self.assertEqual(self.read(path)[0]['OBJECT'], "O'Brien 1")
+
+    @mock.patch.object(update_logs, 'MAX_HEADER_BLOCKS', 1)
+    def test_header_longer_than_max_blocks(self):
+        for path in self.frames.values():
+            self.assert_problem(path, 'No END card')
+
+
+class MapHeaderBytesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.frame = write_header(self.tmp_dir, *FRAME_CARDS)
+        with open(self.frame, 'ab') as f:
+            f.write(b'\0' * 2 * 2880)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_header_view(self):
+        with open(self.frame, 'rb') as f:
+            expected = f.read(2880)
+        with update_logs.map_header_bytes(self.frame) as header_bytes:
+            self.assertIsInstance(header_bytes, memoryview)
+            self.assertEqual(bytes(header_bytes), expected)
+        # Released before the mapping is closed
+        with self.assertRaises(ValueError):
+            bytes(header_bytes)
+
+    def test_empty_file(self):
+        path = os.path.join(self.tmp_dir, 'empty.fits')
+        open(path, 'wb').close()
+        with update_logs.map_header_bytes(path) as header_bytes:
+            self.assertEqual(header_bytes, b'')
+
+    @mock.patch.object(update_logs, 'MAX_HEADER_BLOCKS', 2)
+    def test_no_end_card(self):
+        # END only in the fourth block
+        path = os.path.join(self.tmp_dir, 'long.fits')
+        with open(path, 'wb') as f:
+            f.write(get_header_bytes(*FRAME_CARDS * 12))
+        self.assertEqual(os.path.getsize(path), 4 * 2880)
+        with update_logs.map_header_bytes(path) as header_bytes:
+            self.assertEqual(len(header_bytes), 2 * 2880)
+        frame, error = update_logs.get_file_frame(path)
+        self.assertIsNone(frame)
+        self.assertIn('No END card', error[1])
+
+    def test_parse_error_with_slice_held(self):
+        # The slice outlives the with in the traceback, the parse error
+        # must not be replaced by a BufferError when closing the mapping
+        def parse_cards(header_bytes, keywords=None):
+            card = header_bytes[:80]
+            raise RuntimeError(f'cannot parse {len(card)}')
+
+        with mock.patch.object(update_logs, 'parse_cards', parse_cards):
+            with self.assertRaisesRegex(RuntimeError, 'cannot parse 80'):
+                update_logs.read_header(self.frame, update_logs.KEYWORDS)
+
+
+class CardParserTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_astropy_header(self, header_bytes):
+        from astropy.io import fits
+
+        return dict(fits.Header.fromstring(header_bytes.decode('ascii')))
+
+    def test_same_values_as_astropy(self):
+        header_bytes = get_header_bytes(*FRAME_CARDS)
+        names = [card[:8].strip() for card in FRAME_CARDS]
+        hdr = update_logs.parse_cards(header_bytes, names)
+        astropy_hdr = self.get_astropy_header(header_bytes)
+        self.assertEqual(hdr, {name: astropy_hdr[name] for name in names})
+        self.assertEqual(hdr['OBJECT'], "O'Brien 1")
+        self.assertEqual(hdr['EXPTIME'], 30.0)
+        self.assertIs(hdr['FLIPSTAT'], False)
+        self.assertIsNone(hdr['EMPTY'])
+
+    def test_card_values(self):
+        for value, expected in (("'A''B'  / c", "A'B"), ("''", ''),
+                                ('1.5D-2', 0.015), ('-7 / c', -7),
+                                ('T', True), ('', None)):
+            card = f'KEY     = {value}'.encode('ascii').ljust(80)
+            self.assertEqual(
+                update_logs.parse_card_value(card), expected, value)
+
+    def test_malformed_cards(self):
+        for value in ("'unclosed", "'long&'", '(1, 2)', 'abc'):
+            card = f'KEY     = {value}'.encode('ascii').ljust(80)
+            with self.assertRaises(ValueError, msg=value):
+                update_logs.parse_card_value(card)
+
+    def test_last_card_wins_and_end(self):
+        header_bytes = get_header_bytes(
+            "OBJECT  = 'M31'", "OBJECT  = 'M33'", 'COMMENT OBJECT = x')
+        header_bytes += b"OBJECT  = 'after end'".ljust(80)
+        self.assertEqual(
+            update_logs.parse_cards(header_bytes, ['OBJECT', 'COMMENT']),
+            {'OBJECT': 'M33'})
+
+    def test_continue_falls_back_to_astropy(self):
+        path = write_header(
+            self.tmp_dir, *FRAME_CARDS[:1],
+            "OBJECT  = 'a long object name&'", "CONTINUE  ' continued'")
+        hdr = update_logs.read_header(path, update_logs.KEYWORDS)
+        self.assertEqual(hdr['OBJECT'], 'a long object name continued')
+
+    def test_unreadable_header_is_reported(self):
+        # Neither parse_cards nor astropy read the header, the run goes on
+        write_header(self.tmp_dir, *FRAME_CARDS[:1], "OBJECT  = 'M31",
+                     name='bad.fits')
+        write_header(self.tmp_dir, *FRAME_CARDS, name='good.fits')
+        files = update_logs.get_files(self.tmp_dir)
+        frame, error = update_logs.get_file_frame(files[0])
+        self.assertIsNone(frame)
+        self.assertIn('HDR problem in file', error[1])
+        with self.assertLogs(update_logs.logger, 'WARNING'):
+            rows = update_logs.get_folder_data(
+                files, update_logs.AliasDict(), update_logs.AliasDict(),
+                update_logs.AliasDict())
+        self.assertEqual([row['object_name'] for row in rows], ["O'Brien 1"])
+
+
+class FrameCopiesTests(unittest.TestCase):
+    start = dt.datetime(2021, 2, 1, 20)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.manifest = update_logs.open_manifest(
+            os.path.join(self.tmp_dir, 'manifest.sqlite'))
+        write_frame(self.tmp_dir, 'M31', self.start)
+        self.frame = os.path.join(self.tmp_dir, 'M31_200000.fits')
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def copy(self, directory, compression=None, extra=b''):
+        # Copy of the frame in a subdirectory, compressed or with more data
+        os.makedirs(os.path.join(self.tmp_dir, directory), exist_ok=True)
+        path = os.path.join(self.tmp_dir, directory, 'M31_200000.fits')
+        with open(self.frame, 'rb') as f:
+            data = f.read() + extra
+        if compression is not None:
+            path = f'{path}.{compression}'
+            data = {'gz': gzip, 'bz2': bz2}[compression].compress(data)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def read(self, files):
+        return list(update_logs.iter_folder_frames(
+            files, manifest=self.manifest))
+
+    def test_copies_of_any_compression(self):
+        files = [self.frame, self.copy('gz', 'gz'), self.copy('bz2', 'bz2'),
+                 self.copy('reduced')]
+        with mock.patch.object(
+                update_logs, 'parse_cards',
+                wraps=update_logs.parse_cards) as parse_cards:
+            frames = self.read(files)
+        self.assertEqual([frame['path'] for frame in frames], [self.frame])
+        self.assertEqual(parse_cards.call_count, 1)
+
+    def test_copies_in_later_runs(self):
+        self.read([self.frame])
+        with mock.patch.object(
+                update_logs, 'parse_cards',
+                wraps=update_logs.parse_cards) as parse_cards:
+            self.assertEqual(self.read([self.copy('bz2', 'bz2')]), [])
+        parse_cards.assert_not_called()
+
+    def test_first_copy_removed(self):
+        copy = self.copy('bz2', 'bz2')
+        self.read([self.frame])
+        os.remove(self.frame)
+        self.assertEqual(
+            [frame['object'] for frame in self.read([copy])], ['M31'])
+
+    def test_other_data_size(self):
+        # Same header but more data is not a copy
+        other = self.copy('other', extra=b'\0' * 2880)
+        frames = self.read([self.frame, other])
+        self.assertEqual(
+            [frame['path'] for frame in frames], [self.frame, other])
+        self.assertEqual(frames[1]['object'], 'M31')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,19 +5,27 @@
 
 
 import os
-import astropy.io.fits as fits
 import datetime as dt
 import gzip
+import bz2
 import re
-import glob
-from pprint import pprint as pp
+import math
+import mmap
 import argparse
-import requests
 import json
-import dateutil.parser as dateparser
 import csv 
 import logging
+import sqlite3
+import hashlib
 from dotenv import dotenv_values
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import threading
+import contextlib
+import cProfile
+import time
+# astropy, numpy, requests, dateutil and multiprocessing are imported where
+# they are used, so a run with nothing to do starts fast
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
@@ -26,24 +34,238 @@ config = dotenv_values(".env")
 
 ALLOWED_EXT = ['.gz', '.bz2', '.fit', '.fits']
 FORBIDDEN_KEYS = ['HISTORY', 'COMMENT']
+FITS_BLOCK = 2880
+FITS_CARD = 80
+MAX_HEADER_BLOCKS = 1000
+MANIFEST_CHUNK = 500
+READ_CHUNK = 16
+READ_WINDOW = 4
+TABLE_CHUNK = 4096
+RETRY_STATUSES = (429, 502, 503, 504)
+LATENCY_TOLERANCE = 2
+LATENCY_QUANTILES = (0.5, 0.9, 0.99)
+OUTBOX_PENDING = 'pending'
+OUTBOX_REJECTED = 'rejected'
+OUTBOX_POLL = 5
+# Server errors after which an item is rejected, it will not go through
+OUTBOX_MAX_ATTEMPTS = 5
+# Rejected items are logged when rejected and kept this long to be looked
+# into, older ones are deleted when the outbox is opened
+OUTBOX_KEEP_REJECTED = 30 * 24 * 3600
+# Mtimes newer than this when a directory is listed are not trusted to
+# show later changes, see get_settled_state
+MTIME_SETTLE_NS = 10 * 10 ** 9
+# Header keywords of the frame values, a telescope config may change them.
+# Without a time keyword the date keyword holds the whole datetime
+KEYWORDS = {
+    'date': 'DATE-OBS',
+    'time': 'TIME-OBS',
+    'object': 'OBJECT',
+    'observer': 'OBSERVER',
+    'filter': 'FILTER',
+    'exptime': 'EXPTIME',
+    'ccd_temp': 'CCD-TEMP',
+    'imagetyp': 'IMAGETYP',
+}
+KEYWORD_PROFILES = {
+    # DATE-OBS date and TIME-OBS time, as written at T60
+    'default': {},
+    # DATE-OBS with date and time, as most current acquisition software
+    'isot': {'time': None},
+}
 DATE_REGEX = '^\d{4}\-(0[1-9]|1[012])\-(0[1-9]|[12][0-9]|3[01])$'
 
 
+class Metrics:
+    # Time and item counts per stage, counters and upload latencies of one
+    # run. Parse times are summed over worker processes
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, items=0):
+        with self.lock:
+            stage_data = self.stages.setdefault(
+                stage, {'seconds': 0., 'items': 0})
+            stage_data['seconds'] += seconds
+            stage_data['items'] += items
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe_latency(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage, items=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, items)
+
+    def timed_iter(self, stage, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, time.perf_counter() - start)
+                return
+            self.add(stage, time.perf_counter() - start, 1)
+            yield item
+
+    def get_latency_percentiles(self):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {}
+        return {
+            q: latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+            for q in LATENCY_QUANTILES
+        }
+
+    def summary(self):
+        stages = {
+            stage: {
+                'seconds': round(data['seconds'], 6),
+                'items': data['items'],
+                'rate': round(data['items'] / data['seconds'], 2)
+                    if data['seconds'] else None,
+            }
+            for stage, data in self.stages.items()
+        }
+        return {
+            'stages': stages,
+            'counters': dict(self.counters),
+            'upload_latency': {
+                str(q): round(v, 6)
+                for q, v in self.get_latency_percentiles().items()
+            },
+        }
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, path, telescope_name):
+        # Textfile collector format, written to a temporary file first so
+        # the collector never reads a half written file
+        label = f'telescope="{telescope_name}"'
+        lines = [
+            '# HELP update_logs_stage_seconds Time spent in a stage.',
+            '# TYPE update_logs_stage_seconds gauge',
+        ]
+        lines += [
+            f'update_logs_stage_seconds{{{label},stage="{stage}"}} '
+            f'{data["seconds"]}'
+            for stage, data in self.stages.items()
+        ]
+        lines += [
+            '# HELP update_logs_stage_items Items handled in a stage.',
+            '# TYPE update_logs_stage_items gauge',
+        ]
+        lines += [
+            f'update_logs_stage_items{{{label},stage="{stage}"}} '
+            f'{data["items"]}'
+            for stage, data in self.stages.items()
+        ]
+        lines += [
+            '# HELP update_logs_counter Counters of the last run.',
+            '# TYPE update_logs_counter gauge',
+        ]
+        lines += [
+            f'update_logs_counter{{{label},name="{name}"}} {value}'
+            for name, value in self.counters.items()
+        ]
+        lines += [
+            '# HELP update_logs_upload_latency_seconds Upload latency.',
+            '# TYPE update_logs_upload_latency_seconds summary',
+        ]
+        lines += [
+            f'update_logs_upload_latency_seconds{{{label},quantile="{q}"}} {v}'
+            for q, v in self.get_latency_percentiles().items()
+        ]
+        lines += [
+            f'update_logs_upload_latency_seconds_sum{{{label}}} '
+            f'{sum(self.latencies)}',
+            f'update_logs_upload_latency_seconds_count{{{label}}} '
+            f'{len(self.latencies)}',
+            '# HELP update_logs_last_run_timestamp_seconds End of last run.',
+            '# TYPE update_logs_last_run_timestamp_seconds gauge',
+            f'update_logs_last_run_timestamp_seconds{{{label}}} {time.time()}',
+        ]
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+
+metrics = Metrics()
+read_stats = {'bytes': 0, 'fallbacks': 0, 'copies': 0}
+
+
+class AliasDict(dict):
+    # Canonical name -> set of upper case aliases. build_index makes the
+    # alias -> canonical name index used by check_in_dict and resets the
+    # memo of already resolved raw names
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.build_index()
+
+    def build_index(self):
+        owners = {}
+        for header, body in self.items():
+            for alias in body:
+                owners.setdefault(alias, set()).add(header)
+
+        self.index = {}
+        self.ambiguous = {}
+        self.memo = {}
+        for alias, headers in sorted(owners.items()):
+            if len(headers) > 1:
+                logger.warning(
+                    f'Alias {alias} is ambiguous, used by: {sorted(headers)}')
+                self.ambiguous[alias] = headers
+                continue
+            header = next(iter(headers))
+            if alias in self and alias != header:
+                logger.warning(
+                    f'Alias {alias} of {header} is also a name, '
+                    f'{alias} is used')
+            self.index[alias] = header
+
+
 def check_in_dict(_dict, _name):
-    _name = _name.strip()
-    _name_up = _name.upper()
-    if _name in _dict.keys():
-        return _name
-    elif _name_up in _dict.keys():
-        return _name_up
+    if _name in _dict.memo:
+        return _dict.memo[_name]
+
+    name = _name.strip()
+    name_up = name.upper()
+    if name in _dict:
+        result = name
+    elif name_up in _dict:
+        result = name_up
+    elif name_up in _dict.ambiguous:
+        logger.warning(
+            f'Name {name} is ambiguous, used by: '
+            f'{sorted(_dict.ambiguous[name_up])}')
+        result = name
     else:
-        for header, body in _dict.items():
-            if _name_up in body: return header
-    return _name
+        result = _dict.index.get(name_up, name)
+
+    _dict.memo[_name] = result
+    return result
 
 
 def read_dict(_file):
-    _dict = {}
+    _dict = AliasDict()
     with open(_file) as csvfile:
         reader = csv.reader(csvfile)
         for row in reader:
@@ -51,13 +273,15 @@ def read_dict(_file):
             if not row: continue
             header = row[0]
             body = set([x.upper() for x in row[1:]])
+            if header in _dict:
+                logger.warning(f'{header} repeated in {_file}, aliases merged')
+                body |= _dict[header]
             _dict[header] = body
+    _dict.build_index()
     return _dict
 
 
 def get_dirs_to_walk(data_dir, datetime_start, datetime_end):
-    folders_in_root = os.listdir(data_dir)
-
     date_start = datetime_start.date()
     if datetime_start.hour >= 12:
         date_start = date_start + dt.timedelta(days=1)
@@ -77,126 +301,1398 @@ def get_dirs_to_walk(data_dir, datetime_start, datetime_end):
     return dirs_to_walk
 
 
-def get_files(_dir):
-    
-    files_in_folder = []
+def iter_files(_dir):
     for r, d, f in os.walk(_dir):
-        for file in f:
-            files_in_folder.append(os.path.join(r, file))
-    
-    files_to_open = []
-    for _file in files_in_folder:
-        if os.path.isfile(_file):
+        d.sort()
+        for file in sorted(f):
+            _file = os.path.join(r, file)
             if os.path.splitext(_file)[-1] in ALLOWED_EXT:
-                files_to_open.append(_file)
-    
-    return files_to_open
+                if os.path.isfile(_file):
+                    yield _file
 
 
-def get_folder_data(files_to_open, names_dict, filters_dict, observers_dict):
-    folder_data = []
-    logger.debug(files_to_open)
+def get_files(_dir):
+    return list(iter_files(_dir))
+
+
+def open_frame(raw, f):
+    ext = os.path.splitext(f)[-1]
+    if ext == '.gz':
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    if ext == '.bz2':
+        return bz2.BZ2File(raw, 'rb')
+    return raw
+
+
+def has_end_card(block):
+    for i in range(0, len(block), FITS_CARD):
+        if block[i:i + 8] == b'END     ':
+            return True
+    return False
+
+
+def read_header_bytes(f):
+    # Decompress block by block and stop at the END card, so the data
+    # part of the frame is never read
+    blocks = []
+    with open(f, 'rb') as raw, open_frame(raw, f) as f_in:
+        for _ in range(MAX_HEADER_BLOCKS):
+            block = f_in.read(FITS_BLOCK)
+            if not block:
+                break
+            blocks.append(block)
+            if has_end_card(block):
+                break
+        read_stats['bytes'] += raw.tell()
+    return b''.join(blocks)
+
+
+def parse_card_value(card):
+    # Value of a fixed format card: string, logical, integer or float.
+    # Anything else raises ValueError, so astropy reads the header instead
+    value = card[10:].strip()
+    if value.startswith(b"'"):
+        end = 1
+        while True:
+            end = value.find(b"'", end)
+            if end < 0:
+                raise ValueError(f'Unclosed string in card: {card}')
+            if value[end + 1:end + 2] != b"'":
+                break
+            end += 2
+        string = value[1:end].replace(b"''", b"'").rstrip().decode('ascii')
+        if string.endswith('&'):
+            raise ValueError(f'Long string in card: {card}')
+        return string
+    value = value.split(b'/', 1)[0].strip()
+    if not value:
+        return None
+    if value == b'T':
+        return True
+    if value == b'F':
+        return False
+    try:
+        return int(value)
+    except ValueError:
+        return float(value.replace(b'D', b'E'))
+
+
+def parse_cards(header_bytes, names):
+    # Values of the wanted keywords only, straight from the 80 byte cards.
+    # Like a dict of an astropy Header, the last card of a keyword wins
+    # Slices of a memoryview are not copied, only wanted cards are
+    wanted = {name.encode('ascii').ljust(8): name for name in names}
+    hdr = {}
+    for i in range(0, len(header_bytes), FITS_CARD):
+        keyword = header_bytes[i:i + 8]
+        if keyword == b'END     ':
+            break
+        if keyword in wanted:
+            card = bytes(header_bytes[i:i + FITS_CARD])
+            if card[8:10] == b'= ':
+                hdr[wanted[bytes(keyword)]] = parse_card_value(card)
+    return hdr
+
+
+@contextlib.contextmanager
+def map_header_bytes(f):
+    # Header of an uncompressed frame as a view of a read only mapping.
+    # Random access advice turns off kernel readahead, so only the pages
+    # of the header blocks are read and the data part is never paged in
+    with open(f, 'rb') as raw:
+        size = os.fstat(raw.fileno()).st_size
+        if not size:
+            yield b''
+            return
+        mapped = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_RANDOM)
+            view = memoryview(mapped)
+            end = min(size, MAX_HEADER_BLOCKS * FITS_BLOCK)
+            for start in range(0, end, FITS_BLOCK):
+                if has_end_card(view[start:start + FITS_BLOCK]):
+                    end = start + FITS_BLOCK
+                    break
+            header_bytes = view[:end]
+            read_stats['bytes'] += end
+            try:
+                yield header_bytes
+            finally:
+                # Views must be gone before the mapping is closed
+                header_bytes.release()
+                view.release()
+        finally:
+            try:
+                mapped.close()
+            except BufferError:
+                # A slice is still referenced, e.g. by the traceback of an
+                # error raised while parsing. Closing here would hide that
+                # error, the mapping is closed when the slice is freed
+                pass
+
+
+@contextlib.contextmanager
+def open_header_bytes(f):
+    if os.path.splitext(f)[-1] in ('.gz', '.bz2'):
+        yield read_header_bytes(f)
+    else:
+        with map_header_bytes(f) as header_bytes:
+            yield header_bytes
+
+
+def get_data_size(f, header_size):
+    # Size of the data part, without decompressing: gzip keeps the size
+    # (modulo 2**32) in its last 4 bytes, bz2 has no such field
+    ext = os.path.splitext(f)[-1]
+    if ext == '.bz2':
+        return None
+    with open(f, 'rb') as raw:
+        if ext != '.gz':
+            return os.fstat(raw.fileno()).st_size - header_size
+        raw.seek(-4, os.SEEK_END)
+        return int.from_bytes(raw.read(4), 'little') - header_size
+
+
+def get_fingerprint(f, header_bytes):
+    # Copies of a frame have the same header and data size
+    data_size = get_data_size(f, len(header_bytes))
+    return (f'{hashlib.sha1(header_bytes).hexdigest()}:'
+            f'{"" if data_size is None else data_size}')
+
+
+def split_fingerprint(fingerprint):
+    # (header hash, data size), the data size of bz2 frames is None
+    header_hash, _, data_size = fingerprint.partition(':')
+    return header_hash, int(data_size) if data_size else None
+
+
+def read_header_fingerprint(f, keywords=None, known=()):
+    # Only the given header keywords are parsed, by parse_cards. Headers it
+    # can not read and calls without keywords go through astropy. Headers
+    # with a hash in one of known are copies and are not parsed at all,
+    # None is returned instead
+    with open_header_bytes(f) as header_bytes:
+        if header_bytes[:8] != b'SIMPLE  ':
+            raise OSError('No SIMPLE card found, this file does not appear '
+                          'to be a valid FITS file')
+        last_block = (len(header_bytes) - 1) // FITS_BLOCK * FITS_BLOCK
+        if not has_end_card(header_bytes[last_block:]):
+            # Truncated, still being written or longer than
+            # MAX_HEADER_BLOCKS
+            raise OSError('No END card found in the header')
+        fingerprint = get_fingerprint(f, header_bytes)
+        header_hash = split_fingerprint(fingerprint)[0]
+        if any(header_hash in headers for headers in known):
+            read_stats['copies'] += 1
+            return None, fingerprint
+        if keywords:
+            try:
+                return parse_cards(
+                    header_bytes, [k for k in keywords.values() if k]
+                ), fingerprint
+            except ValueError:
+                read_stats['fallbacks'] += 1
+        header_string = bytes(header_bytes).decode('ascii')
+
+    import astropy.io.fits as fits
+    from astropy.io.fits.verify import VerifyError
+
+    try:
+        return dict(fits.Header.fromstring(header_string)), fingerprint
+    except VerifyError as e:
+        # Reported like the other unreadable headers
+        raise ValueError(f'invalid header - {e}') from e
+
+
+def read_header(f, keywords=None):
+    return read_header_fingerprint(f, keywords)[0]
+
+
+def get_obs_datetime(date, time_obs=None):
+    # Fractions of seconds may have any number of digits or be missing
+    value = date if time_obs is None else f'{date}T{time_obs}'
+    value, _, fraction = value.strip().partition('.')
+    obs_datetime = dt.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+    if fraction:
+        obs_datetime += dt.timedelta(microseconds=round(
+            float(f'0.{fraction}') * 1e6))
+    return obs_datetime.isoformat()
+
+
+def get_file_frame(f, keywords=KEYWORDS, known=()):
+    # Returns (frame, error). The frame holds the raw header values only,
+    # dictionaries are applied later so cached frames stay valid after a
+    # dictionary change. Errors are passed back instead of being logged
+    # here, so the parent process logs them in file order for any worker count.
+    # A known header gives a frame with its fingerprint and a copy flag only
+    try:
+        hdr, fingerprint = read_header_fingerprint(f, keywords, known)
+    except (OSError, EOFError, ValueError) as e:
+        return None, (logging.WARNING, f'HDR problem in file: {f} - {e}')
+    if hdr is None:
+        return {'fingerprint': fingerprint, 'copy': True}, None
+
+    try:
+        date = hdr[keywords['date']]
+        time_obs = None
+        if keywords['time'] and 'T' not in date:
+            time_obs = hdr[keywords['time']]
+        obs_datetime = get_obs_datetime(date, time_obs)
+        frame = {
+            'obs_datetime': obs_datetime,
+            # Calibration frames often have the image type only
+            'object': hdr.get(keywords['object'])
+                or hdr[keywords['imagetyp']],
+            'observer': hdr[keywords['observer']],
+            'filter': hdr[keywords['filter']],
+            'exptime': hdr[keywords['exptime']],
+            'ccd_temp': hdr.get(keywords['ccd_temp']),
+            'imagetyp': hdr.get(keywords['imagetyp']),
+            'fingerprint': fingerprint,
+        }
+    except (KeyError, TypeError, ValueError) as e:
+        return None, (logging.WARNING, f'HDR problem in file: {f} - '
+                                       f'missing or wrong keyword {e}')
+    return frame, None
+
+
+def get_row(frame, names_dict, filters_dict, observers_dict):
+    object_name = check_in_dict(names_dict, frame['object'])
+    observers = [
+        check_in_dict(observers_dict, observer) for observer in frame['observer'].strip().split()
+    ]
+    observers = [
+        {'name': observer} for observer in observers
+    ]
+    color_filter = check_in_dict(filters_dict, frame['filter'])
+
+    row = {
+        'obs_datetime': frame['obs_datetime'],
+        'object_name': object_name,
+        'observers': observers,
+        'color_filter': color_filter,
+        'exptime': frame['exptime'],
+        'ccd_temp': frame.get('ccd_temp'),
+        'path': frame.get('path'),
+    }
+    return row
+
+
+def get_files_frames(files_to_open, keywords=KEYWORDS, known=None):
+    # Also returns the time spent and the read_stats of the files, as this
+    # may run in a worker process. Copies of a header read before in the
+    # chunk or in known are not parsed. Worker processes only get the
+    # headers of their own chunk, copies of other chunks are parsed and
+    # dropped by FrameCopies afterwards
+    start = time.perf_counter()
+    stats_start = dict(read_stats)
+    seen = set()
+    known = (seen,) if known is None else (seen, known)
+    results = []
+    for f in files_to_open:
+        frame, error = get_file_frame(f, keywords, known)
+        if frame and not frame.get('copy'):
+            seen.add(split_fingerprint(frame['fingerprint'])[0])
+        results.append((frame, error))
+    return (results, time.perf_counter() - start,
+            {k: v - stats_start[k] for k, v in read_stats.items()})
+
+
+def iter_chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def open_manifest(manifest_file):
+    manifest = sqlite3.connect(manifest_file)
+    manifest.execute(
+        'CREATE TABLE IF NOT EXISTS manifest ('
+        'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, frame TEXT, '
+        'keywords TEXT)'
+    )
+    manifest.execute(
+        'CREATE TABLE IF NOT EXISTS header_fingerprints ('
+        'header_hash TEXT PRIMARY KEY, data_size INTEGER, path TEXT)'
+    )
+    manifest.commit()
+    return manifest
+
+
+def get_keywords_digest(keywords):
+    # Frames read with other header keywords are not reused
+    return hashlib.sha1(
+        json.dumps(keywords, sort_keys=True).encode()).hexdigest()
+
+
+def get_manifest_frames(manifest, files_stats, keywords=KEYWORDS):
+    # Only frames of files whose size and mtime did not change are returned
+    cached = {}
+    digest = get_keywords_digest(keywords)
+    paths = list(files_stats)
+    for i in range(0, len(paths), MANIFEST_CHUNK):
+        chunk = paths[i:i + MANIFEST_CHUNK]
+        rows = manifest.execute(
+            'SELECT path, size, mtime_ns, frame, keywords FROM manifest '
+            f'WHERE path IN ({",".join("?" * len(chunk))})', chunk)
+        for path, size, mtime_ns, frame, frame_digest in rows:
+            if (files_stats[path] == (size, mtime_ns)
+                    and frame_digest == digest):
+                cached[path] = json.loads(frame)
+    return cached
+
+
+def update_manifest(manifest, files_stats, frames, keywords=KEYWORDS):
+    # Files with a recent mtime may still change without changing it, they
+    # are read again, see get_settled_state
+    digest = get_keywords_digest(keywords)
+    settled_ns = time.time_ns() - MTIME_SETTLE_NS
+    manifest.executemany(
+        'INSERT OR REPLACE INTO manifest '
+        '(path, size, mtime_ns, frame, keywords) VALUES (?, ?, ?, ?, ?)',
+        [(f, *files_stats[f], json.dumps(frame), digest)
+         for f, frame in frames.items() if files_stats[f][1] <= settled_ns]
+    )
+    manifest.commit()
+
+
+def get_fingerprint_paths(manifest, header_hashes):
+    # header hash: (path, data size)
+    paths = {}
+    header_hashes = list(header_hashes)
+    for i in range(0, len(header_hashes), MANIFEST_CHUNK):
+        chunk = header_hashes[i:i + MANIFEST_CHUNK]
+        for header_hash, data_size, path in manifest.execute(
+                'SELECT header_hash, data_size, path FROM header_fingerprints '
+                f'WHERE header_hash IN ({",".join("?" * len(chunk))})', chunk):
+            paths[header_hash] = (path, data_size)
+    return paths
+
+
+def update_fingerprints(manifest, paths):
+    manifest.executemany(
+        'INSERT OR REPLACE INTO header_fingerprints '
+        '(header_hash, data_size, path) VALUES (?, ?, ?)',
+        [(header_hash, data_size, path)
+         for header_hash, (path, data_size) in paths.items()])
+    manifest.commit()
+
+
+def is_same_data_size(data_size, other):
+    # bz2 keeps no data size, so its copies are matched by header only
+    return data_size is None or other is None or data_size == other
+
+
+class FrameCopies:
+    # Path and data size of the first seen copy of every frame header. With
+    # a manifest the paths are kept there, so a copy found in a later run or
+    # another directory is still known. A first copy which was removed
+    # is replaced by the next one. Copies have the same header hash, and the
+    # same data size where both sizes are known
+
+    def __init__(self, manifest=None, keywords=KEYWORDS):
+        self.manifest = manifest
+        self.keywords = keywords
+        self.paths = {}
+
+    def __contains__(self, header_hash):
+        # Asked before a header is parsed, a wrong guess is read again by
+        # drop_copies
+        if header_hash not in self.paths and self.manifest is not None:
+            self.load([header_hash])
+        return header_hash in self.paths
+
+    def load(self, header_hashes):
+        for header_hash, (path, data_size) in get_fingerprint_paths(
+                self.manifest, header_hashes).items():
+            if os.path.isfile(path):
+                self.paths[header_hash] = (path, data_size)
+
+    def drop_copies(self, frames):
+        # frames: (path, frame) in file order
+        header_hashes = {
+            split_fingerprint(frame['fingerprint'])[0] for f, frame in frames
+            if frame.get('fingerprint')
+        } - set(self.paths)
+        if self.manifest is not None and header_hashes:
+            self.load(header_hashes)
+        new_paths = {}
+        unique_frames = []
+        for f, frame in frames:
+            fingerprint = frame.get('fingerprint')
+            if fingerprint:
+                header_hash, data_size = split_fingerprint(fingerprint)
+                first, first_size = self.paths.setdefault(
+                    header_hash, (f, data_size))
+                if first != f and is_same_data_size(data_size, first_size):
+                    logger.info(f'Frame {f} is a copy of {first}, skipped')
+                    metrics.count('frame_copies')
+                    continue
+                if first == f and header_hash in header_hashes:
+                    new_paths[header_hash] = (f, data_size)
+            if frame.get('copy'):
+                # Its header was known but it is not a copy: the first copy
+                # was removed or has other data
+                frame, error = get_file_frame(f, self.keywords)
+                if error:
+                    logger.log(*error)
+                    metrics.count('parse_errors')
+                    continue
+            unique_frames.append((f, frame))
+        if self.manifest is not None and new_paths:
+            update_fingerprints(self.manifest, new_paths)
+        return unique_frames
+
+
+def get_files_stats(files_to_open):
+    files_stats = {}
     for f in files_to_open:
         try:
-            f_in = gzip.open(f, 'rb')
+            stat = os.stat(f)
         except OSError as e:
             logger.error(e)
             continue
-            # with gzip.open(f, 'rb') as f_in:
+        files_stats[f] = (stat.st_size, stat.st_mtime_ns)
+    return files_stats
+
+
+def iter_folder_frames(files_to_open, executor=None, manifest=None,
+                       workers=1, keywords=KEYWORDS):
+    # Yields frames in file order. Files are taken lazily in chunks and at
+    # most READ_WINDOW chunks per worker are read ahead, so memory does not
+    # depend on the number of files
+    window = 1 if executor is None else READ_WINDOW * workers
+    pending = deque()
+    copies = FrameCopies(manifest, keywords)
+
+    def finish(chunk, files_stats, cached, result):
+        if not isinstance(result, tuple):
+            result = result.result()
+        result, seconds, stats = result
+        metrics.add('parse', seconds, len(result))
+        metrics.count('bytes_read', stats['bytes'])
+        metrics.count('astropy_fallbacks', stats['fallbacks'])
+        metrics.count('unparsed_copies', stats['copies'])
+        metrics.count('manifest_hits', len(cached))
+        read = {}
+        for f, (frame, error) in zip(
+                [f for f in chunk if f not in cached], result):
+            if error:
+                logger.log(*error)
+                metrics.count('parse_errors')
+                continue
+            read[f] = frame
+        if manifest is not None and read:
+            update_manifest(manifest, files_stats, read, keywords)
+        frames = [
+            (f, cached.get(f) or read.get(f)) for f in chunk
+            if f in cached or f in read
+        ]
+        for f, frame in copies.drop_copies(frames):
+            frame['path'] = f
+            yield frame
+
+    for chunk in iter_chunks(files_to_open, READ_CHUNK):
+        files_stats = None
+        cached = {}
+        if manifest is not None:
+            files_stats = get_files_stats(chunk)
+            chunk = [f for f in chunk if f in files_stats]
+            cached = get_manifest_frames(manifest, files_stats, keywords)
+        files_to_read = [f for f in chunk if f not in cached]
+        if executor is None or not files_to_read:
+            result = get_files_frames(files_to_read, keywords, copies)
         else:
-            with f_in:        
-                try:
-                    hdr = dict(fits.getheader(f, ignore_missing_end=True))
-                except OSError as e:
-                    logger.warning(f'HDR problem in file: {f} - {e}')
-                    continue
+            result = executor.submit(get_files_frames, files_to_read, keywords)
+        pending.append((chunk, files_stats, cached, result))
+        if len(pending) >= window:
+            yield from finish(*pending.popleft())
+    while pending:
+        yield from finish(*pending.popleft())
+
+
+def iter_folder_data(files_to_open, names_dict, filters_dict, observers_dict,
+                     executor=None, manifest=None, workers=1,
+                     keywords=KEYWORDS):
+    for frame in iter_folder_frames(
+            files_to_open, executor, manifest, workers, keywords):
+        row = get_row(frame, names_dict, filters_dict, observers_dict)
+        logger.debug(f'data row: {row}')
+        yield row
+
+
+def get_folder_data(files_to_open, names_dict, filters_dict, observers_dict,
+                    workers=1, manifest=None):
+    logger.debug(files_to_open)
+    if workers <= 1:
+        folder_data = list(iter_folder_data(
+            files_to_open, names_dict, filters_dict, observers_dict,
+            None, manifest))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            folder_data = list(iter_folder_data(
+                files_to_open, names_dict, filters_dict, observers_dict,
+                executor, manifest, workers))
 
-                obs_datetime = dt.datetime.strptime(
-                    hdr['DATE-OBS'] + 'T' + hdr['TIME-OBS'],
-                    '%Y-%m-%dT%H:%M:%S.%f').isoformat()
-                
-                object_name = check_in_dict(names_dict, hdr['OBJECT'])
-                observers = [
-                    check_in_dict(observers_dict, observer) for observer in hdr['OBSERVER'].strip().split()
-                ]
-                observers = [
-                    {'name': observer} for observer in observers
-                ]
-                color_filter = check_in_dict(filters_dict, hdr['FILTER'])
-                exptime = hdr['EXPTIME']
-                
-            row = {
-                'obs_datetime': obs_datetime,
-                'object_name': object_name,
-                'observers': observers,
-                'color_filter': color_filter,
-                'exptime': exptime,
-            }
-            logger.debug(f'data row: {row}')
-            folder_data.append(row)
-        
     folder_data = sorted(folder_data, key=lambda x: x['obs_datetime'])
     
     return folder_data
 
 
-def get_grouped_folder_data(folder_data, telescope_name):
+class FrameTable:
+    # Frames of one directory kept as a numpy structured array. Object
+    # names, filters and observer lists are stored once and the array only
+    # holds their indices. Rows are buffered and packed every TABLE_CHUNK.
+    # Paths are only kept with with_paths, they are needed for frames data
+
+    def __init__(self, with_paths=True):
+        import numpy as np
+
+        self.dtype = np.dtype([
+            ('obs_datetime', 'datetime64[us]'),
+            ('object_name', 'i4'),
+            ('observers', 'i4'),
+            ('color_filter', 'i4'),
+            ('exptime', 'f8'),
+            ('ccd_temp', 'f8'),
+        ])
+        self.values = {'object_name': {}, 'observers': {}, 'color_filter': {}}
+        self.chunks = []
+        self.buffer = []
+        self.paths = [] if with_paths else None
+
+    def index(self, column, value):
+        return self.values[column].setdefault(value, len(self.values[column]))
+
+    def append(self, row):
+        import numpy as np
+
+        self.buffer.append((
+            np.datetime64(row['obs_datetime'], 'us'),
+            self.index('object_name', str(row['object_name']).strip()),
+            self.index('observers', tuple(o['name'] for o in row['observers'])),
+            self.index('color_filter', row['color_filter']),
+            float(row.get('exptime', 0)),
+            np.nan if row.get('ccd_temp') is None else float(row['ccd_temp']),
+        ))
+        if self.paths is not None:
+            self.paths.append(row.get('path'))
+        if len(self.buffer) >= TABLE_CHUNK:
+            self.pack()
+
+    def pack(self):
+        import numpy as np
+
+        if self.buffer:
+            self.chunks.append(np.array(self.buffer, dtype=self.dtype))
+            self.buffer = []
+
+    def get_array(self):
+        import numpy as np
+
+        self.pack()
+        if not self.chunks:
+            return np.empty(0, dtype=self.dtype)
+        if len(self.chunks) > 1:
+            self.chunks = [np.concatenate(self.chunks)]
+        return self.chunks[0]
+
+    def take(self, indices):
+        # Keeps the rows at indices, in that order
+        self.chunks = [self.get_array()[indices]]
+        if self.paths is not None:
+            self.paths = [self.paths[i] for i in indices]
+
+    def get_values(self, column):
+        return list(self.values[column])
+
+    def __len__(self):
+        return sum(len(c) for c in self.chunks) + len(self.buffer)
+
+
+def get_frames_data(table, frames, order, color_filters):
+    import numpy as np
+
+    obs_datetimes = frames['obs_datetime'].astype(dt.datetime)
+    return [
+        {
+            'path': table.paths[i],
+            'obs_datetime': obs_datetime.isoformat(),
+            'colorfilter': color_filters[frame['color_filter']],
+            'exposure_time': float(frame['exptime']),
+            'ccd_temp': None if np.isnan(frame['ccd_temp'])
+                else float(frame['ccd_temp']),
+        }
+        for i, frame, obs_datetime in zip(order, frames, obs_datetimes)
+    ]
+
+
+def get_visits(frames, visit_gap=None):
+    # Sorts frames by (object, time) and returns the order with the first
+    # and last sorted index of every visit. Frames of an object are split
+    # where the gap between them is longer than visit_gap, without it all
+    # frames of an object make one visit
+    import numpy as np
+
+    # lexsort is stable, so frames with equal times keep the file order
+    order = np.lexsort((frames['obs_datetime'], frames['object_name']))
+    frames = frames[order]
+    boundaries = frames['object_name'][1:] != frames['object_name'][:-1]
+    if visit_gap:
+        boundaries |= np.diff(frames['obs_datetime']) > np.timedelta64(
+            visit_gap, 'us')
+    starts = np.flatnonzero(np.r_[True, boundaries])
+    ends = np.r_[starts[1:], len(frames)] - 1
+    return order, frames, starts, ends
+
+
+def get_visit_targets(table, telescope_name, order, frames, starts, ends,
+                      with_frames=False, selected=None):
+    # One target per visit, or per selected visit
+    import numpy as np
+
+    number_of_frames = ends - starts + 1
+    total_exposure_time = np.add.reduceat(frames['exptime'], starts)
+    # fmin and fmax skip frames without a temperature
+    ccd_temps_min = np.fmin.reduceat(frames['ccd_temp'], starts)
+    ccd_temps_max = np.fmax.reduceat(frames['ccd_temp'], starts)
+    visits = np.repeat(np.arange(len(starts)), number_of_frames)
+    visit_filters = np.unique(
+        np.stack([visits, frames['color_filter']]), axis=1)
+    filters_split = np.searchsorted(
+        visit_filters[0], np.arange(1, len(starts)))
+
+    object_names = table.get_values('object_name')
+    observers = table.get_values('observers')
+    color_filters = table.get_values('color_filter')
+    datetimes_start = frames['obs_datetime'][starts].astype(dt.datetime)
+    datetimes_end = frames['obs_datetime'][ends].astype(dt.datetime)
+
     results = {}
+    for i, visit_filter_ids in enumerate(
+            np.split(visit_filters[1], filters_split)):
+        if selected is not None and not selected[i]:
+            continue
+        start = starts[i]
+        object_name = object_names[frames['object_name'][start]]
+        datetime_start = datetimes_start[i].isoformat()
+        results[(object_name, datetime_start)] = {
+            'name': object_name,
+            'datetime_start': datetime_start,
+            'datetime_end': datetimes_end[i].isoformat(),
+            'observers': [
+                {'name': o} for o in observers[frames['observers'][start]]
+            ],
+            'colorfilters': [
+                {'name': color_filters[c]} for c in visit_filter_ids
+            ],
+            'total_exposure_time': round(float(total_exposure_time[i]), 2),
+            'number_of_frames': int(number_of_frames[i]),
+            'ccd_temp_min': None if np.isnan(ccd_temps_min[i])
+                else math.floor(ccd_temps_min[i]),
+            'ccd_temp_max': None if np.isnan(ccd_temps_max[i])
+                else math.ceil(ccd_temps_max[i]),
+            'telescope': telescope_name,
+        }
+        if with_frames:
+            results[(object_name, datetime_start)]['frames'] = get_frames_data(
+                table, frames[start:ends[i] + 1], order[start:ends[i] + 1],
+                color_filters)
+
+    return dict(sorted(
+        results.items(), key=lambda x: x[1]['datetime_start']))
+
+
+def group_frame_table(table, telescope_name, visit_gap=None,
+                      with_frames=False):
+    # One target per visit: frames of the same object sorted by time are
+    # split where the gap between frames is longer than visit_gap.
+    # Without visit_gap all frames of an object make one target
+    frames = table.get_array()
+    if not len(frames):
+        return {}
+    return get_visit_targets(
+        table, telescope_name, *get_visits(frames, visit_gap), with_frames)
+
+
+class VisitGrouper:
+    # Groups the frames of one directory while they are read. Frames come
+    # in write order, which for camera frames is the order of observation.
+    # While their times do not go back, a visit is final once the newest
+    # frame is more than visit_gap after its end: its target is returned
+    # and its frames are dropped. Once a frame goes back in time nothing
+    # more is final before the end of the directory. Without visit_gap a
+    # visit is the whole night and all targets come at the end
+
+    def __init__(self, telescope_name, visit_gap=None, with_frames=False):
+        self.telescope_name = telescope_name
+        self.visit_gap = visit_gap
+        self.with_frames = with_frames
+        self.table = FrameTable(with_paths=with_frames)
+        self.newest = None
+        self.in_order = True
+        self.sent = {}
+        self.appended = 0
+
+    def append(self, row):
+        # Returns targets which can no longer change
+        import numpy as np
+
+        obs_datetime = np.datetime64(row['obs_datetime'], 'us')
+        if self.newest is not None and obs_datetime < self.newest:
+            self.in_order = False
+            self.check_late(row, obs_datetime)
+        if self.newest is None or obs_datetime > self.newest:
+            self.newest = obs_datetime
+        self.table.append(row)
+        self.appended += 1
+        if self.visit_gap and self.in_order \
+                and self.appended % TABLE_CHUNK == 0:
+            return self.pop_final()
+        return {}
+
+    def check_late(self, row, obs_datetime):
+        # A frame next to a visit which was already sent can not join it
+        import numpy as np
+
+        gap = np.timedelta64(self.visit_gap or 0, 'us')
+        name = str(row['object_name']).strip()
+        for start, end in self.sent.get(name, ()):
+            if start - gap <= obs_datetime <= end + gap:
+                logger.warning(
+                    f'Frame {row.get("path")} belongs to an already sent '
+                    f'visit of {name}, it makes a separate target')
+                metrics.count('late_frames')
+                return
+
+    def pop_final(self):
+        import numpy as np
+
+        frames = self.table.get_array()
+        if not len(frames):
+            return {}
+        order, frames, starts, ends = get_visits(frames, self.visit_gap)
+        final = frames['obs_datetime'][ends] + np.timedelta64(
+            self.visit_gap, 'us') < self.newest
+        if not final.any():
+            return {}
+        targets = get_visit_targets(
+            self.table, self.telescope_name, order, frames, starts, ends,
+            self.with_frames, final)
+        object_names = self.table.get_values('object_name')
+        for i in np.flatnonzero(final):
+            self.sent.setdefault(
+                object_names[frames['object_name'][starts[i]]], []).append(
+                    (frames['obs_datetime'][starts[i]],
+                     frames['obs_datetime'][ends[i]]))
+        visits = np.repeat(np.arange(len(starts)), ends - starts + 1)
+        self.table.take(np.sort(order[~final[visits]]))
+        return targets
+
+    def close(self):
+        # Targets of the visits left at the end of the directory
+        return group_frame_table(
+            self.table, self.telescope_name, self.visit_gap,
+            self.with_frames)
+
+
+def get_grouped_folder_data(folder_data, telescope_name, visit_gap=None,
+                            with_frames=False):
+    table = FrameTable()
     for frame in folder_data:
-        object_name = str(frame['object_name']).strip()
-        if object_name not in results:
-            object_dict = {
-                'name': object_name,
-                'datetime_start': frame['obs_datetime'],
-                'observers': frame['observers'],
-                'colorfilters': [],
-                'total_exposure_time': 0,
-                'number_of_frames': 0,
-                'telescope': telescope_name,
-            }
-            results[object_name] = object_dict
-        else:
-            object_dict = results[object_name]
-        object_dict['colorfilters'].append(frame['color_filter'])
-        object_dict['datetime_end'] = frame['obs_datetime']
-        object_dict['number_of_frames'] += 1
-        object_dict['total_exposure_time'] += float(frame.get('exptime', 0))
+        table.append(frame)
+    return group_frame_table(table, telescope_name, visit_gap, with_frames)
 
-    for object_name in results.keys():
-        object_dict = results[object_name]
-        object_dict['total_exposure_time'] = round(
-                    object_dict['total_exposure_time'], 2)
-        object_dict['colorfilters'] = [
-                    {'name': c} for c in set(object_dict['colorfilters'])
-                ]
 
-    return results
+def get_visit_gap(minutes):
+    if not minutes:
+        return None
+    return int(float(minutes) * 60 * 1e6)
 
 
-def send_data(data_to_send):
-    for folder_results in data_to_send:
-        for _, target_data in folder_results.items():
+class Uploader:
+    # Posts through one keep-alive session from a thread pool. The number
+    # of requests in flight starts low and follows the observed latency:
+    # it grows by one while latency stays near the best seen and is halved
+    # when it rises above LATENCY_TOLERANCE times that
+
+    def __init__(self, max_workers=4, timeout=10, retries=3, backoff=0.5):
+        import requests
+
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        self.session.auth = (config['REST_USER'], config['REST_PASSWORD'])
+        self.session.headers['content-type'] = 'application/json'
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.limit = min(2, self.max_workers)
+        self.in_flight = 0
+        self.best_latency = None
+        self.window = []
+        self.latencies = []
+        self.error = None
+        self.condition = threading.Condition()
+
+    def post(self, url, data):
+        import requests
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
             try:
-                logger.debug(f'Sending data: {target_data}')
-                response = requests.post(
-                    url=config['UPLOAD_URL'],
-                    auth=(
-                        config['REST_USER'],
-                        config['REST_PASSWORD']
-                        ),
-                    data=json.dumps(target_data),
-                    headers={'content-type': 'application/json'})
+                logger.debug(f'Sending data: {data}')
+                start = time.perf_counter()
+                metrics.count('upload_requests')
+                response = self.session.post(
+                    url=url, data=json.dumps(data), timeout=self.timeout)
+                latency = time.perf_counter() - start
+                self.record_latency(latency)
+                metrics.observe_latency(latency)
             except (requests.ConnectionError, requests.Timeout) as e:
-                logger.error(f'No DB connection - {e}')
-                raise Exception(f'No connection to DB! - {e}')
-            
-            if not response.ok:
-                logger.error(f'{response.content}\n {target_data}')
+                logger.warning(f'Upload attempt {attempt + 1} failed - {e}')
+                metrics.count('connection_errors')
+                error = e
+                continue
+            if response.status_code not in RETRY_STATUSES:
+                return response
+            error = response.content
+
+        logger.error(f'No DB connection - {error}')
+        raise Exception(f'No connection to DB! - {error}')
+
+    def record_latency(self, latency):
+        with self.condition:
+            self.latencies.append(latency)
+            self.window.append(latency)
+            if len(self.window) < self.limit:
+                return
+            mean = sum(self.window) / len(self.window)
+            self.window = []
+            if self.best_latency is None or mean < self.best_latency:
+                self.best_latency = mean
+            if mean > self.best_latency * LATENCY_TOLERANCE:
+                self.limit = max(1, self.limit // 2)
+            elif self.limit < self.max_workers:
+                self.limit += 1
+            self.condition.notify_all()
+
+    def submit(self, url, data, callback=None, errback=None):
+        # Without errback a failed upload stops all further submits
+        with self.condition:
+            while self.in_flight >= self.limit and not self.error:
+                self.condition.wait()
+            if self.error:
+                raise self.error
+            self.in_flight += 1
+        return self.executor.submit(self._run, url, data, callback, errback)
+
+    def _run(self, url, data, callback, errback):
+        try:
+            with metrics.timer(
+                    'upload', len(data) if isinstance(data, list) else 1):
+                response = self.post(url, data)
+            if callback:
+                callback(response, data)
+        except Exception as e:
+            if errback:
+                errback(e, data)
+                return
+            with self.condition:
+                self.error = self.error or e
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def join(self):
+        with self.condition:
+            while self.in_flight:
+                self.condition.wait()
+            if self.error:
+                raise self.error
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+
+class Outbox:
+    # Uploads waiting in the state sqlite file, so they survive API
+    # outages and restarts. Sent items are deleted, rejected ones are kept
+    # with the server answer for keep_rejected seconds after they were
+    # queued, like the items refused out of a bulk upload which was accepted
+    # otherwise. Lists of targets go to the bulk endpoint, urls are taken
+    # from the config when sending
+
+    def __init__(self, state_file, keep_rejected=OUTBOX_KEEP_REJECTED):
+        self.db = sqlite3.connect(
+            state_file, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS outbox ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'payload TEXT, status TEXT, attempts INTEGER DEFAULT 0, '
+                'last_error TEXT, created REAL)'
+            )
+            self.db.commit()
+        pruned = self.prune_rejected(keep_rejected)
+        if pruned:
+            logger.info(f'{pruned} rejected outbox items deleted')
+
+    def prune_rejected(self, max_age):
+        with self.lock:
+            deleted = self.db.execute(
+                'DELETE FROM outbox WHERE status = ? AND created < ?',
+                (OUTBOX_REJECTED, time.time() - max_age)).rowcount
+            self.db.commit()
+        return deleted
+
+    def put(self, data):
+        with self.lock:
+            self.db.execute(
+                'INSERT INTO outbox (payload, status, created) '
+                'VALUES (?, ?, ?)',
+                (json.dumps(data), OUTBOX_PENDING, time.time()))
+            self.db.commit()
+
+    def get_pending(self, exclude, limit):
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT id, payload FROM outbox WHERE status = ? '
+                f'AND id NOT IN ({",".join("?" * len(exclude))}) '
+                'ORDER BY id LIMIT ?',
+                (OUTBOX_PENDING, *exclude, limit)).fetchall()
+        return [(item_id, json.loads(payload)) for item_id, payload in rows]
+
+    def set_sent(self, item_id):
+        with self.lock:
+            self.db.execute('DELETE FROM outbox WHERE id = ?', (item_id,))
+            self.db.commit()
+
+    def put_rejected(self, data, error):
+        # Items the API refused out of an accepted bulk upload
+        with self.lock:
+            self.db.execute(
+                'INSERT INTO outbox '
+                '(payload, status, attempts, last_error, created) '
+                'VALUES (?, ?, 1, ?, ?)',
+                (json.dumps(data), OUTBOX_REJECTED, f'{error}', time.time()))
+            self.db.commit()
 
+    def set_error(self, item_id, error, status=OUTBOX_PENDING):
+        with self.lock:
+            self.db.execute(
+                'UPDATE outbox SET status = ?, attempts = attempts + 1, '
+                'last_error = ? WHERE id = ?', (status, f'{error}', item_id))
+            self.db.commit()
+
+    def set_server_error(self, item_id, error, max_attempts):
+        # Returns True when the item got rejected
+        with self.lock:
+            self.db.execute(
+                'UPDATE outbox SET attempts = attempts + 1, last_error = ?, '
+                'status = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END '
+                'WHERE id = ?',
+                (f'{error}', max_attempts, OUTBOX_REJECTED, OUTBOX_PENDING,
+                 item_id))
+            self.db.commit()
+            status = self.db.execute(
+                'SELECT status FROM outbox WHERE id = ?',
+                (item_id,)).fetchone()
+        return status == (OUTBOX_REJECTED,)
+
+    def count(self, status=OUTBOX_PENDING):
+        with self.lock:
+            return self.db.execute(
+                'SELECT COUNT(*) FROM outbox WHERE status = ?',
+                (status,)).fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+
+class Checkpoints:
+    # Progress of every directory in the state sqlite file: number of
+    # files and newest file mtime at the last read, and the digest of
+    # every target found there. A target is queued when it goes to the
+    # outbox and done when the API answered it. A directory is done when
+    # it did not change and none of its targets is still queued. The
+    # newest mtime of the directory tree itself lets a run skip a done
+    # directory without listing its files
+
+    def __init__(self, state_file, telescope_name):
+        self.telescope_name = telescope_name
+        self.db = sqlite3.connect(
+            state_file, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS checkpoints ('
+                'directory TEXT PRIMARY KEY, telescope TEXT, '
+                'files INTEGER, last_mtime_ns INTEGER, updated REAL, '
+                'tree_mtime_ns INTEGER)'
+            )
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS dir_targets ('
+                'directory TEXT, key TEXT PRIMARY KEY, digest TEXT, '
+                'done INTEGER)'
+            )
+            self.db.execute(
+                'CREATE INDEX IF NOT EXISTS dir_targets_directory '
+                'ON dir_targets (directory, done)'
+            )
+            self.db.commit()
+
+    def is_done(self, directory, files, last_mtime_ns):
+        with self.lock:
+            checkpoint = self.db.execute(
+                'SELECT files, last_mtime_ns FROM checkpoints '
+                'WHERE directory = ?', (directory,)).fetchone()
+            queued = self.db.execute(
+                'SELECT COUNT(*) FROM dir_targets '
+                'WHERE directory = ? AND done = 0', (directory,)).fetchone()
+        return checkpoint == (files, last_mtime_ns) and not queued[0]
+
+    def is_unchanged(self, directory, tree_mtime_ns):
+        with self.lock:
+            checkpoint = self.db.execute(
+                'SELECT tree_mtime_ns FROM checkpoints '
+                'WHERE directory = ?', (directory,)).fetchone()
+            queued = self.db.execute(
+                'SELECT COUNT(*) FROM dir_targets '
+                'WHERE directory = ? AND done = 0', (directory,)).fetchone()
+        return checkpoint == (tree_mtime_ns,) and not queued[0]
+
+    def set_tree_mtime(self, directory, tree_mtime_ns):
+        with self.lock:
+            self.db.execute(
+                'UPDATE checkpoints SET tree_mtime_ns = ? WHERE directory = ?',
+                (tree_mtime_ns, directory))
+            self.db.commit()
+
+    def get_known(self, directory):
+        with self.lock:
+            return {
+                key: (digest, done) for key, digest, done in self.db.execute(
+                    'SELECT key, digest, done FROM dir_targets '
+                    'WHERE directory = ?', (directory,)).fetchall()
+            }
+
+    def get_new_targets(self, directory, targets):
+        # Targets which are neither queued nor done with the same content
+        known = self.get_known(directory)
+        return [
+            t for t in targets
+            if known.get(get_target_key(t), (None,))[0] != get_target_digest(t)
+        ]
+
+    def queue(self, directory, targets):
+        # Called before targets go to the outbox, so that an answer which
+        # comes while the directory is still read finds them
+        with self.lock:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO dir_targets '
+                '(directory, key, digest, done) VALUES (?, ?, ?, 0)',
+                [(directory, get_target_key(t), get_target_digest(t))
+                 for t in targets])
+            self.db.commit()
+
+    def update(self, directory, files, last_mtime_ns, keys,
+               tree_mtime_ns=None):
+        # Called when the directory was read, keys are those of all its
+        # targets. Targets which are gone are forgotten
+        keys = set(keys)
+        with self.lock:
+            gone = [
+                (key,) for key, in self.db.execute(
+                    'SELECT key FROM dir_targets WHERE directory = ?',
+                    (directory,)).fetchall()
+                if key not in keys
+            ]
+            self.db.executemany(
+                'DELETE FROM dir_targets WHERE key = ?', gone)
+            self.db.execute(
+                'INSERT OR REPLACE INTO checkpoints '
+                '(directory, telescope, files, last_mtime_ns, updated, '
+                'tree_mtime_ns) VALUES (?, ?, ?, ?, ?, ?)',
+                (directory, self.telescope_name, files, last_mtime_ns,
+                 time.time(), tree_mtime_ns))
+            self.db.commit()
+
+    def set_done(self, data):
+        # Keys hold the telescope, so any instance marks targets of all
+        targets = data if isinstance(data, list) else [data]
+        with self.lock:
+            self.db.executemany(
+                'UPDATE dir_targets SET done = 1 '
+                'WHERE key = ? AND digest = ?',
+                [(get_target_key(t), get_target_digest(t)) for t in targets])
+            self.db.commit()
+
+    def plan(self, directories):
+        # Rows without files mark directories of a run which were not
+        # read yet. Directories are not walked in date order (the newest
+        # comes first), so a run stopped midway leaves older ones behind
+        with self.lock:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO checkpoints '
+                '(directory, telescope, updated) VALUES (?, ?, ?)',
+                [(d, self.telescope_name, time.time()) for d in directories])
+            self.db.commit()
+
+    def get_resume_directory(self):
+        # The oldest directory which was not read or has queued targets,
+        # otherwise the newest one, as it may still get frames
+        with self.lock:
+            directory = self.db.execute(
+                'SELECT MIN(directory) FROM checkpoints '
+                'WHERE telescope = ? AND (files IS NULL OR directory IN ('
+                'SELECT directory FROM dir_targets WHERE done = 0))',
+                (self.telescope_name,)).fetchone()[0]
+            if directory is None:
+                directory = self.db.execute(
+                    'SELECT MAX(directory) FROM checkpoints '
+                    'WHERE telescope = ?',
+                    (self.telescope_name,)).fetchone()[0]
+        return directory
+
+    def close(self):
+        self.db.close()
+
+
+def get_target_key(target):
+    return f'{target["telescope"]}|{target["name"]}|{target["datetime_start"]}'
+
+
+def get_target_digest(target):
+    return hashlib.sha1(
+        json.dumps(target, sort_keys=True).encode()).hexdigest()
+
+
+def get_dir_state(files_to_open):
+    # Number of files and the newest mtime, to see if a directory changed
+    last_mtime_ns = 0
+    for f in files_to_open:
+        try:
+            last_mtime_ns = max(last_mtime_ns, os.stat(f).st_mtime_ns)
+        except OSError:
+            continue
+    return len(files_to_open), last_mtime_ns
+
+
+def get_tree_mtime(directory):
+    # Newest mtime of a directory and its subdirectories. Adding, removing
+    # or renaming a file changes it, files are not listed
+    tree_mtime_ns = os.stat(directory).st_mtime_ns
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                tree_mtime_ns = max(tree_mtime_ns, get_tree_mtime(entry.path))
+    return tree_mtime_ns
+
+
+def get_settled_state(dir_state, tree_mtime_ns, listed_ns):
+    # Timestamps are coarse (jiffies on ext4, NFS servers): a file written
+    # in the same tick as the newest recorded mtime leaves it unchanged, and
+    # a frame still being written changes nothing the directory shows. When
+    # the newest mtime is that recent at listing, no mtime is recorded and
+    # the next run lists and compares the directory again
+    files, last_mtime_ns = dir_state
+    if max(last_mtime_ns, tree_mtime_ns) > listed_ns - MTIME_SETTLE_NS:
+        return (files, None), None
+    return dir_state, tree_mtime_ns
+
+
+def is_unchanged(dirs_to_walk, checkpoints, outbox):
+    # Fast path for frequent runs: nothing waits in the outbox and no
+    # directory changed since its last read
+    if outbox.count():
+        return False
+    return all(
+        checkpoints.is_unchanged(_dir, get_tree_mtime(_dir))
+        for _dir in dirs_to_walk
+    )
+
+
+def get_dir_datetime_start(directory):
+    # Directories are named after the morning date of the night
+    dir_date = dt.datetime.strptime(os.path.basename(directory), '%Y-%m-%d')
+    return (dir_date - dt.timedelta(hours=12)).isoformat()
+
+
+class OutboxSender:
+    # Drains the outbox through the uploader from a background thread.
+    # submit only stores the data, so parsing goes on while the API is
+    # down. After a failed upload sending pauses for retry_interval
+    # seconds, items left at the end are sent by the next run
+
+    def __init__(self, outbox, uploader, retry_interval=60, on_done=None,
+                 upsert=False):
+        self.outbox = outbox
+        self.uploader = uploader
+        self.retry_interval = retry_interval
+        self.on_done = on_done
+        self.upsert = upsert
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.offline_until = 0
+        self.stopping = False
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def submit(self, url, data, callback=None):
+        self.outbox.put(data)
+        self.wake.set()
+
+    def run(self):
+        while True:
+            offline = time.time() < self.offline_until
+            items = [] if offline else self.outbox.get_pending(
+                list(self.in_flight), self.uploader.max_workers * 2)
+            with self.lock:
+                idle = not self.in_flight
+            if self.stopping and (offline or (not items and idle)):
+                return
+            if not items:
+                self.wake.wait(
+                    max(0, self.offline_until - time.time()) if offline
+                    else OUTBOX_POLL)
+                self.wake.clear()
+                continue
+            for item_id, data in items:
+                with self.lock:
+                    self.in_flight.add(item_id)
+                self.uploader.submit(
+                    get_upload_url(data, self.upsert), data,
+                    self.get_callback(item_id),
+                    self.get_errback(item_id))
+
+    def get_callback(self, item_id):
+        def callback(response, data):
+            log_response(response, data)
+            if response.ok:
+                self.outbox.set_sent(item_id)
+                rejected = get_rejected(response, data)
+                if rejected:
+                    self.outbox.put_rejected(
+                        [data[r['index']] for r in rejected],
+                        json.dumps([r['errors'] for r in rejected]))
+            elif response.status_code < 500:
+                self.outbox.set_error(
+                    item_id, response.content, OUTBOX_REJECTED)
+            elif not self.outbox.set_server_error(
+                    item_id, response.content, OUTBOX_MAX_ATTEMPTS):
+                # Paused like when the API is down, so that a failing
+                # endpoint is not posted to in a loop
+                self.pause(f'status {response.status_code}')
+                self.done(item_id)
+                return
+            if self.on_done:
+                self.on_done(data)
+            self.done(item_id)
+        return callback
+
+    def get_errback(self, item_id):
+        def errback(error, data):
+            self.outbox.set_error(item_id, error)
+            self.pause(error)
+            self.done(item_id)
+        return errback
+
+    def pause(self, error):
+        self.offline_until = time.time() + self.retry_interval
+        logger.warning(
+            f'API unavailable, upload paused for '
+            f'{self.retry_interval} s - {error}')
+
+    def done(self, item_id):
+        with self.lock:
+            self.in_flight.discard(item_id)
+        self.wake.set()
+
+    def join(self):
+        self.stopping = True
+        self.wake.set()
+        self.thread.join()
+        self.uploader.join()
+        pending = self.outbox.count()
+        if pending:
+            logger.warning(f'{pending} uploads left in outbox for next run')
+        return pending
+
+
+def get_rejected(response, data):
+    # Items of a bulk upload refused by the API, the others were stored
+    if not isinstance(data, list):
+        return []
+    return response.json().get('rejected', [])
+
+
+def log_response(response, data):
+    if not response.ok:
+        logger.error(f'{response.content}\n {data}')
+        metrics.count('upload_errors')
+        return
+    if isinstance(data, list):
+        response_data = response.json()
+        for duplicate in response_data['duplicates']:
+            logger.error(f'Target already in DB: {duplicate}')
+            metrics.count('duplicates')
+        for rejected in get_rejected(response, data):
+            logger.error(f'Target rejected: {rejected}')
+            metrics.count('rejected')
+        if response_data.get('updated'):
+            logger.info(f'Updated {response_data["updated"]} targets')
+            metrics.count('targets_updated', response_data['updated'])
+
+
+def get_upload_url(data, upsert=False):
+    # Only the bulk endpoint updates existing targets
+    if isinstance(data, list):
+        url = config.get(
+            'BULK_UPLOAD_URL', config['UPLOAD_URL'].rstrip('/') + '/bulk/')
+        return f'{url}?upsert=1' if upsert else url
+    return config['UPLOAD_URL']
+
+
+def send_data(data_to_send, uploader, bulk_size=0, upsert=False):
+    for folder_results in data_to_send:
+        targets_data = list(folder_results.values())
+        if bulk_size:
+            targets_data = [
+                targets_data[i:i + bulk_size]
+                for i in range(0, len(targets_data), bulk_size)
+            ]
+        for data in targets_data:
+            uploader.submit(get_upload_url(data, upsert), data, log_response)
+
+
+def get_info_from_db(telescope_name):
+    import requests
 
-def get_info_from_db(args):
     try:
-        telescope_url = config['TELESCOPE_STATS_URL'] + args.telescope_name
+        telescope_url = config['TELESCOPE_STATS_URL'] + telescope_name
         response = requests.get(
             url=telescope_url,
             timeout=float(config.get('TIMEOUT', 10)),
@@ -216,6 +1712,14 @@ def get_info_from_db(args):
     return json.loads(response.content)
 
 def validate_datetime(datetime_str):
+    try:
+        # ISO dates from the state file need no dateutil
+        return dt.datetime.fromisoformat(datetime_str)
+    except ValueError:
+        pass
+
+    import dateutil.parser as dateparser
+
     try:
         datetime_object = dateparser.parse(datetime_str)
     except ValueError as e:
@@ -236,38 +1740,491 @@ def validate_dict_file(dict_file):
         return False
     return True
 
-def process(
-    data_dir, datetime_start, datetime_end,
-    telescope_name, names_dict, filters_dict, observers_dict):
-    dirs_to_walk = sorted(
-        get_dirs_to_walk(data_dir, datetime_start, datetime_end)
+
+def get_dict(dict_file):
+    if dict_file and validate_dict_file(dict_file):
+        return read_dict(dict_file)
+    return AliasDict()
+
+
+def get_datetime_start(telescope_name, checkpoints, datetime_start=None):
+    if not datetime_start:
+        resume_directory = checkpoints.get_resume_directory()
+        if resume_directory:
+            logger.info(
+                f'Resuming {telescope_name} from directory: {resume_directory}')
+            datetime_start = get_dir_datetime_start(resume_directory)
+        else:
+            # First run with this state file
+            db_info = get_info_from_db(telescope_name)
+            if db_info['last_datetime']:
+                datetime_start = db_info['last_datetime']
+            else:
+                datetime_start = config.get(
+                    'ZERO_DATETIME', '1900-01-01T12:00:00')
+    return validate_datetime(datetime_start)
+
+
+def get_datetime_end(datetime_end=None):
+    return validate_datetime(
+        datetime_end or config.get('INF_DATETIME', '2100-01-01T12:00:00'))
+
+
+def get_keywords(profile=None, keywords=None):
+    if profile and profile not in KEYWORD_PROFILES:
+        raise Exception(f'No keyword profile {profile}')
+    return dict(KEYWORDS, **KEYWORD_PROFILES[profile or 'default'],
+                **(keywords or {}))
+
+
+def read_telescopes_config(config_file):
+    # Json list of telescopes. name and data_dir are needed, names_dict,
+    # filters_dict, observers_dict, profile (of KEYWORD_PROFILES), keywords
+    # (header keywords which differ from the profile), datetime_start and
+    # datetime_end are optional
+    with open(config_file) as f:
+        telescopes = json.load(f)
+    for telescope in telescopes:
+        missing = {'name', 'data_dir'} - set(telescope)
+        if missing:
+            raise Exception(f'Telescope config without: {sorted(missing)}')
+        validate_data_dir(telescope['data_dir'])
+        telescope['keywords'] = get_keywords(
+            telescope.get('profile'), telescope.get('keywords'))
+    return telescopes
+
+def get_sender(upload_workers=4, outbox=None, checkpoints=None,
+               upsert=False):
+    uploader = Uploader(
+        max_workers=upload_workers,
+        timeout=float(config.get('TIMEOUT', 10)),
+        retries=int(config.get('RETRIES', 3)),
     )
+    sender = uploader
+    if outbox is not None:
+        sender = OutboxSender(
+            outbox, uploader, float(config.get('OUTBOX_RETRY', 60)),
+            checkpoints.set_done if checkpoints else None, upsert).start()
+    return uploader, sender
+
+
+def get_executor(workers):
+    if workers <= 1:
+        return None
+    from concurrent.futures import ProcessPoolExecutor
+
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def send_targets(_dir, targets, sender, bulk_size=0, checkpoints=None,
+                 upsert=False):
+    # Sends targets which are new or changed since they were last queued
+    if checkpoints:
+        targets = checkpoints.get_new_targets(_dir, targets)
+        checkpoints.queue(_dir, targets)
+    send_data([{(t['name'], t['datetime_start']): t for t in targets}],
+              sender, bulk_size, upsert)
+    return len(targets)
+
+
+def send_table(_dir, table, telescope_name, sender, bulk_size=0,
+               visit_gap=None, with_frames=False, checkpoints=None,
+               dir_state=None, tree_mtime_ns=None, upsert=False):
+    # Groups all frames of a directory and sends what changed
+    with metrics.timer('grouping', len(table)):
+        targets = list(group_frame_table(
+            table, telescope_name, visit_gap, with_frames).values())
+    sent = send_targets(_dir, targets, sender, bulk_size, checkpoints, upsert)
+    if checkpoints:
+        checkpoints.update(
+            _dir, *dir_state, map(get_target_key, targets), tree_mtime_ns)
+    return sent
+
+
+def sort_by_mtime(files):
+    # Write order, for camera frames the order of observation. Files with
+    # the same mtime keep their order
+    mtimes = {}
+    for f in files:
+        try:
+            mtimes[f] = os.stat(f).st_mtime_ns
+        except OSError:
+            mtimes[f] = 0
+    return sorted(mtimes, key=mtimes.get)
+
+
+def send_dir(_dir, folder_data, telescope_name, sender, bulk_size=0,
+             visit_gap=None, with_frames=False, checkpoints=None,
+             dir_state=None, tree_mtime_ns=None, upsert=False):
+    # Targets are sent as soon as their visit is final, see VisitGrouper
+    grouper = VisitGrouper(telescope_name, visit_gap, with_frames)
+    keys = []
+
+    def send(targets):
+        targets = list(targets.values())
+        keys.extend(map(get_target_key, targets))
+        return send_targets(
+            _dir, targets, sender, bulk_size, checkpoints, upsert)
+
+    sent = 0
+    for row in folder_data:
+        targets = grouper.append(row)
+        if targets:
+            sent += send(targets)
+    with metrics.timer('grouping', len(grouper.table)):
+        targets = grouper.close()
+    sent += send(targets)
+    if checkpoints:
+        checkpoints.update(_dir, *dir_state, keys, tree_mtime_ns)
+    return sent
+
+
+def process_dirs(
+    dirs_to_walk, telescope_name, names_dict, filters_dict, observers_dict,
+    sender, executor=None, manifest=None, workers=1, bulk_size=0,
+    visit_gap=None, with_frames=False, checkpoints=None, full_scan=False,
+    upsert=False, keywords=KEYWORDS):
+    if checkpoints:
+        checkpoints.plan(dirs_to_walk)
     for _dir in dirs_to_walk:
+        # Taken before listing, so files added meanwhile are seen by the
+        # next run
+        listed_ns = time.time_ns()
+        tree_mtime_ns = get_tree_mtime(_dir)
+        if (checkpoints and not full_scan
+                and checkpoints.is_unchanged(_dir, tree_mtime_ns)):
+            logger.info(f'Directory done and unchanged: {_dir}')
+            metrics.count('directories_skipped')
+            continue
+        files = sort_by_mtime(
+            metrics.timed_iter('enumeration', iter_files(_dir)))
+        dir_state = get_dir_state(files)
+        if (checkpoints and not full_scan
+                and checkpoints.is_done(_dir, *dir_state)):
+            logger.info(f'Directory done and unchanged: {_dir}')
+            metrics.count('directories_skipped')
+            checkpoints.set_tree_mtime(
+                _dir, get_settled_state(dir_state, tree_mtime_ns, listed_ns)[1])
+            continue
+        dir_state, tree_mtime_ns = get_settled_state(
+            dir_state, tree_mtime_ns, listed_ns)
         logger.info(f'Processing directory: {_dir}')
         print(f'Processing directory: {_dir}')
-        data_to_send = []
+        folder_data = iter_folder_data(
+            files, names_dict, filters_dict, observers_dict,
+            executor, manifest, workers, keywords
+        )
+        send_dir(
+            _dir, folder_data, telescope_name, sender, bulk_size, visit_gap,
+            with_frames, checkpoints, dir_state, tree_mtime_ns, upsert
+        )
 
-        folder_files = get_files(_dir)
-        folder_data = get_folder_data(
-            folder_files, names_dict, filters_dict, observers_dict
+
+def process(
+    data_dir, datetime_start, datetime_end,
+    telescope_name, names_dict, filters_dict, observers_dict, workers=1,
+    outbox=None, manifest=None, bulk_size=0, upload_workers=4, visit_gap=None,
+    with_frames=False, checkpoints=None, full_scan=False, upsert=False,
+    keywords=KEYWORDS):
+    with metrics.timer('discovery'):
+        dirs_to_walk = sorted(
+            get_dirs_to_walk(data_dir, datetime_start, datetime_end)
         )
-        grouped_folder_data = get_grouped_folder_data(
-            folder_data, telescope_name
+    metrics.add('discovery', 0, len(dirs_to_walk))
+    uploader, sender = get_sender(upload_workers, outbox, checkpoints, upsert)
+    executor = get_executor(workers)
+    try:
+        process_dirs(
+            dirs_to_walk, telescope_name,
+            names_dict, filters_dict, observers_dict,
+            sender, executor, manifest, workers, bulk_size, visit_gap,
+            with_frames, checkpoints, full_scan, upsert, keywords
+        )
+        sender.join()
+    finally:
+        uploader.close()
+        if executor is not None:
+            executor.shutdown()
+
+
+def process_telescope(
+    telescope, checkpoints, sender, executor=None, outbox=None,
+    state_file=None, workers=1, bulk_size=0, visit_gap=None,
+    with_frames=False, full_scan=False, upsert=False):
+    telescope_name = telescope['name']
+    datetime_start = get_datetime_start(
+        telescope_name, checkpoints, telescope.get('datetime_start'))
+    datetime_end = get_datetime_end(telescope.get('datetime_end'))
+    dirs_to_walk = sorted(
+        get_dirs_to_walk(telescope['data_dir'], datetime_start, datetime_end)
+    )
+    metrics.add('discovery', 0, len(dirs_to_walk))
+    if not full_scan and is_unchanged(dirs_to_walk, checkpoints, outbox):
+        logger.info(f'Nothing changed for {telescope_name}')
+        return
+    # The newest directory first, it may be a night being observed
+    dirs_to_walk = dirs_to_walk[-1:] + dirs_to_walk[:-1]
+    # sqlite connections can not be shared by threads
+    manifest = open_manifest(state_file) if state_file else None
+    try:
+        process_dirs(
+            dirs_to_walk, telescope_name,
+            get_dict(telescope.get('names_dict')),
+            get_dict(telescope.get('filters_dict')),
+            get_dict(telescope.get('observers_dict')),
+            sender, executor, manifest, workers, bulk_size, visit_gap,
+            with_frames, checkpoints, full_scan, upsert, telescope['keywords']
+        )
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+
+def process_telescopes(
+    telescopes, state_file, workers=1, use_manifest=True, bulk_size=0,
+    upload_workers=4, visit_gap=None, with_frames=False, full_scan=False,
+    upsert=False):
+    # Every telescope runs in its own thread, all of them share the process
+    # pool and one uploader. A thread reads ahead a bounded number of
+    # chunks, so the pool takes chunks of all telescopes in turn and a
+    # long backfill can not starve a live night
+    outbox = Outbox(state_file)
+    checkpoints = {
+        t['name']: Checkpoints(state_file, t['name']) for t in telescopes
+    }
+    uploader, sender = get_sender(
+        upload_workers, outbox, checkpoints[telescopes[0]['name']], upsert)
+    executor = get_executor(workers)
+    failed = []
+
+    def run(telescope):
+        try:
+            process_telescope(
+                telescope, checkpoints[telescope['name']], sender, executor,
+                outbox, state_file if use_manifest else None, workers,
+                bulk_size, visit_gap, with_frames, full_scan, upsert
+            )
+        except Exception as e:
+            logger.error(f'Big Error for {telescope["name"]}!: {e}')
+            metrics.count('fatal_errors')
+            failed.append(telescope['name'])
+
+    try:
+        threads = [
+            threading.Thread(target=run, args=(telescope,))
+            for telescope in telescopes
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        sender.join()
+    finally:
+        uploader.close()
+        if executor is not None:
+            executor.shutdown()
+        for telescope_checkpoints in checkpoints.values():
+            telescope_checkpoints.close()
+        outbox.close()
+    if failed:
+        raise Exception(f'Failed telescopes: {failed}')
+
+
+class PollingWatcher:
+    # Lists the directory every `interval` seconds. A file counts as
+    # written once its size and mtime did not change between two listings.
+    # Files present at the start are only reported when they change
+
+    def __init__(self, directory, interval=2):
+        self.directory = directory
+        self.interval = interval
+        self.last = self.get_stats()
+        self.reported = dict(self.last)
+
+    def get_stats(self):
+        stats = {}
+        for f in iter_files(self.directory):
+            try:
+                stat = os.stat(f)
+            except OSError:
+                continue
+            stats[f] = (stat.st_size, stat.st_mtime_ns)
+        return stats
+
+    def get_written(self, timeout):
+        time.sleep(timeout)
+        stats = self.get_stats()
+        written = [
+            f for f, stat in stats.items()
+            if self.last.get(f) == stat and self.reported.get(f) != stat
+        ]
+        self.reported.update({f: stats[f] for f in written})
+        self.last = stats
+        return written
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    # Reports files closed after writing or moved into the directory tree,
+    # new subdirectories are watched as they appear. Needs inotify_simple
+
+    def __init__(self, directory):
+        import inotify_simple
+
+        self.flags = inotify_simple.flags
+        self.mask = (self.flags.CLOSE_WRITE | self.flags.MOVED_TO
+                     | self.flags.CREATE)
+        self.inotify = inotify_simple.INotify()
+        self.dirs = {}
+        self.add_tree(directory)
+
+    def add_tree(self, directory):
+        for r, d, f in os.walk(directory):
+            self.dirs[self.inotify.add_watch(r, self.mask)] = r
+
+    def get_written(self, timeout):
+        written = set()
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if event.wd not in self.dirs:
+                continue
+            path = os.path.join(self.dirs[event.wd], event.name)
+            if event.mask & self.flags.ISDIR:
+                if event.mask & (self.flags.CREATE | self.flags.MOVED_TO):
+                    self.add_tree(path)
+                    written.update(iter_files(path))
+            elif event.mask & (self.flags.CLOSE_WRITE | self.flags.MOVED_TO):
+                if os.path.splitext(path)[-1] in ALLOWED_EXT:
+                    written.add(path)
+        return sorted(f for f in written if os.path.isfile(f))
+
+    def close(self):
+        self.inotify.close()
+
+
+def get_watcher(directory, interval=2, polling=False):
+    if not polling:
+        try:
+            return InotifyWatcher(directory)
+        except ImportError:
+            logger.warning('inotify_simple not installed, polling directory')
+    return PollingWatcher(directory, interval)
+
+
+def get_night_dir(data_dir):
+    p = re.compile(DATE_REGEX)
+    dirs = sorted(
+        _d for _d in os.listdir(data_dir)
+        if p.match(_d) and os.path.isdir(os.path.join(data_dir, _d))
+    )
+    if not dirs:
+        return None
+    return os.path.join(data_dir, dirs[-1])
+
+
+def follow(
+    data_dir, telescope_name, names_dict, filters_dict, observers_dict,
+    workers=1, outbox=None, manifest=None, bulk_size=0, upload_workers=4,
+    visit_gap=None, with_frames=False, checkpoints=None, interval=2,
+    polling=False, keywords=KEYWORDS):
+    # Watches the newest night directory until interrupted. Written frames
+    # are read once and appended to the table of the night, which is
+    # grouped again after each change. Targets which changed are sent as
+    # upserts. The directory state is kept up to date from the written
+    # frames, the frames read before are not looked at again
+    uploader, sender = get_sender(
+        upload_workers, outbox, checkpoints, upsert=True)
+    executor = get_executor(workers)
+    night_dir = None
+    watcher = None
+    rows = {}
+    table = FrameTable()
+    last_mtime_ns = 0
+
+    def ingest(paths):
+        nonlocal table, last_mtime_ns
+        listed_ns = time.time_ns()
+        tree_mtime_ns = get_tree_mtime(night_dir)
+        rewritten = False
+        for row in iter_folder_data(
+                paths, names_dict, filters_dict, observers_dict,
+                executor, manifest, workers, keywords):
+            rewritten = rewritten or row['path'] in rows
+            rows[row['path']] = row
+            if not rewritten:
+                table.append(row)
+        if rewritten:
+            # A frame written again replaces its row, rows can not be
+            # removed from the table so it is built again
+            table = FrameTable()
+            for row in rows.values():
+                table.append(row)
+        last_mtime_ns = max(last_mtime_ns, get_dir_state(paths)[1])
+        dir_state, tree_mtime_ns = get_settled_state(
+            (len(rows), last_mtime_ns), tree_mtime_ns, listed_ns)
+        sent = send_table(
+            night_dir, table, telescope_name, sender, bulk_size, visit_gap,
+            with_frames, checkpoints, dir_state, tree_mtime_ns, upsert=True
         )
-        data_to_send.append(grouped_folder_data)
-        send_data(data_to_send)
+        logger.info(f'{len(paths)} new frames, {sent} targets sent')
+
+    try:
+        while True:
+            newest_dir = get_night_dir(data_dir)
+            if newest_dir != night_dir:
+                if watcher is not None:
+                    written = watcher.get_written(0)
+                    if written:
+                        ingest(written)
+                    watcher.close()
+                    watcher = None
+                night_dir = newest_dir
+                rows = {}
+                table = FrameTable()
+                last_mtime_ns = 0
+                if night_dir is None:
+                    time.sleep(interval)
+                    continue
+                logger.info(f'Following directory: {night_dir}')
+                print(f'Following directory: {night_dir}')
+                # The watcher starts before listing, so no file is missed
+                watcher = get_watcher(night_dir, interval, polling)
+                ingest(get_files(night_dir))
+                continue
+            written = watcher.get_written(interval)
+            if written:
+                ingest(written)
+    except KeyboardInterrupt:
+        logger.info('Follow mode stopped')
+    finally:
+        if watcher is not None:
+            watcher.close()
+        try:
+            sender.join()
+        finally:
+            uploader.close()
+            if executor is not None:
+                executor.shutdown()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "-t", "--telescope_name", type=str, required=True,
+        "-t", "--telescope_name", type=str,
         help="Telescope name. Must exist in database"
     )
     parser.add_argument(
-        "-d", "--data_dir", type=str, required=True,
+        "-d", "--data_dir", type=str,
         help="Data directory for telescope"
     )
+    parser.add_argument(
+        "-c", "--config", type=str, default=config.get('TELESCOPES_CONFIG'),
+        help=("Json file with a list of telescopes to ingest together \
+               instead of -t and -d: name, data_dir and optionally \
+               names_dict, filters_dict, observers_dict, keywords, \
+               datetime_start, datetime_end")
+    )
     parser.add_argument(
         "-nd", "--names_dict", type=str, nargs='?', const='',
         help="Path to csv file with names dictionary"
@@ -282,8 +2239,10 @@ if __name__ == '__main__':
     )       
     parser.add_argument(
         "-s", "--datetime_start", type=str, nargs='?', const='',
-        help=("Where to start. If none, taken from database, \
-               if none form database start from year 1900. \
+        help=("Where to start. If none, resumed from the oldest directory \
+               not fully uploaded in the state file. On the first run \
+               taken from database, if none form database start from \
+               year 1900. \
                Datetime must be in iso format e.g  2019-01-27T12:06:21")
     )
     parser.add_argument(
@@ -291,53 +2250,175 @@ if __name__ == '__main__':
         help=("Where to end. If none, there is no end... \
                Datetime must be in iso format e.g  2019-01-27T12:06:21")
     )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=int(config.get('WORKERS', 1)),
+        help="Number of processes used for reading FITS headers"
+    )
+    parser.add_argument(
+        "-m", "--manifest", type=str,
+        default=config.get('MANIFEST_FILE', 'ingest_state.sqlite'),
+        help=("Path to sqlite file with the ingest state: already read \
+               frames and uploads waiting in the outbox. Unchanged files \
+               are taken from it instead of being read again")
+    )
+    parser.add_argument(
+        "--no_manifest", action='store_true',
+        help="Read every file, do not use the manifest"
+    )
+    parser.add_argument(
+        "--full_scan", action='store_true',
+        help=("Read every directory even if it did not change since the \
+               last run, e.g. after files were rewritten in place or a \
+               dictionary was fixed. Only targets which changed are sent, \
+               add --upsert to update the stored ones")
+    )
+    parser.add_argument(
+        "-b", "--bulk_size", type=int, default=int(config.get('BULK_SIZE', 0)),
+        help=("Send targets in batches of this size to the bulk endpoint. \
+               0 sends targets one by one")
+    )
+    parser.add_argument(
+        "-uw", "--upload_workers", type=int,
+        default=int(config.get('UPLOAD_WORKERS', 4)),
+        help="Maximal number of uploads in flight"
+    )
+    parser.add_argument(
+        "-g", "--visit_gap", type=float,
+        default=float(config.get('VISIT_GAP', 60)),
+        help=("Frames of one object separated by more minutes than this \
+               are sent as separate targets. 0 joins all frames of an \
+               object in a night")
+    )
+    parser.add_argument(
+        "-k", "--keywords_profile", choices=sorted(KEYWORD_PROFILES),
+        default=config.get('KEYWORDS_PROFILE', 'default'),
+        help=("Header keywords of the frames: default has the date in \
+               DATE-OBS and the time in TIME-OBS, isot both in DATE-OBS")
+    )
+    parser.add_argument(
+        "--frames", action='store_true',
+        help="Send every frame of a target too. Needs --bulk_size"
+    )
+    parser.add_argument(
+        "--upsert", action='store_true',
+        help=("Update targets which are already in the DB instead of \
+               reporting them as duplicates. Needs --bulk_size")
+    )
+    parser.add_argument(
+        "--follow", action='store_true',
+        help=("After the run, keep watching the newest night directory \
+               and send new frames as they are written. Implies --upsert")
+    )
+    parser.add_argument(
+        "--poll", action='store_true',
+        help=("Follow by listing the directory instead of inotify, \
+               e.g. on network mounts")
+    )
+    parser.add_argument(
+        "--poll_interval", type=float,
+        default=float(config.get('POLL_INTERVAL', 2)),
+        help="Seconds between directory listings or inotify reads"
+    )
+    parser.add_argument(
+        "--metrics_json", type=str, default=config.get('METRICS_JSON'),
+        help="Json file for stage timings and counters of the run"
+    )
+    parser.add_argument(
+        "--prom_file", type=str, default=config.get('PROM_FILE'),
+        help="Prometheus textfile collector file for the same metrics"
+    )
+    parser.add_argument(
+        "--profile", type=str, nargs='?', const='update_logs.prof',
+        help="Dump cProfile stats of the processing to this file"
+    )
     args = parser.parse_args()
+    if args.frames and not args.bulk_size:
+        parser.error('--frames needs --bulk_size')
+    if (args.upsert or args.follow) and not args.bulk_size:
+        parser.error('--upsert and --follow need --bulk_size')
 
-    db_info = get_info_from_db(args)
-
-    if args.datetime_start:
-        datetime_start = args.datetime_start
+    if args.config:
+        if args.follow:
+            parser.error('--follow works with one telescope')
+        telescopes = read_telescopes_config(args.config)
+        telescope_label = ','.join(t['name'] for t in telescopes)
     else:
-        if db_info['last_datetime']:
-            datetime_start = db_info['last_datetime']
-        else:
-            datetime_start = config.get('ZERO_DATETIME', '1900-01-01T12:00:00')
-    datetime_start_parsed = validate_datetime(datetime_start)
+        if not args.telescope_name or not args.data_dir:
+            parser.error('--telescope_name and --data_dir or --config needed')
+        telescope_label = args.telescope_name
 
-    if args.datetime_end:
-        datetime_end = args.datetime_end
-    else:
-        datetime_end = config.get('INF_DATETIME', '2100-01-01T12:00:00')
-    datetime_end_parsed = validate_datetime(datetime_end)
+        checkpoints = Checkpoints(args.manifest, args.telescope_name)
+        datetime_start_parsed = get_datetime_start(
+            args.telescope_name, checkpoints, args.datetime_start)
+        datetime_end_parsed = get_datetime_end(args.datetime_end)
 
-    data_dir = validate_data_dir(args.data_dir)
+        data_dir = validate_data_dir(args.data_dir)
 
-    names_dict = {}
-    if args.names_dict:
-        if validate_dict_file(args.names_dict):
-            names_dict = read_dict(args.names_dict)
+        outbox = Outbox(args.manifest)
+        nothing_to_do = not args.full_scan and is_unchanged(
+            get_dirs_to_walk(
+                data_dir, datetime_start_parsed, datetime_end_parsed),
+            checkpoints, outbox
+        )
 
-    filters_dict = {}
-    if args.filters_dict:
-        if validate_dict_file(args.filters_dict):
-            names_dict = read_dict(args.filters_dict)
+        keywords = get_keywords(args.keywords_profile)
+        names_dict = get_dict(args.names_dict)
+        filters_dict = get_dict(args.filters_dict)
+        observers_dict = get_dict(args.observers_dict)
 
-    observers_dict = {}
-    if args.observers_dict:
-        if validate_dict_file(args.observers_dict):
-            observers_dict = read_dict(args.observers_dict)
+        manifest = None
+        if not args.no_manifest:
+            manifest = open_manifest(args.manifest)
 
     print('Process start')
     logger.info(f'Process start - {dt.datetime.now().isoformat()}')
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
     try:
-        process(
-            data_dir,
-            datetime_start_parsed,
-            datetime_end_parsed,
-            args.telescope_name,
-            names_dict, filters_dict, observers_dict
-        )
+        if args.config:
+            process_telescopes(
+                telescopes, args.manifest, args.workers, not args.no_manifest,
+                args.bulk_size, args.upload_workers,
+                get_visit_gap(args.visit_gap), args.frames, args.full_scan,
+                args.upsert
+            )
+        elif nothing_to_do:
+            print('Nothing changed since the last run')
+            logger.info('Nothing changed since the last run')
+        else:
+            process(
+                data_dir,
+                datetime_start_parsed,
+                datetime_end_parsed,
+                args.telescope_name,
+                names_dict, filters_dict, observers_dict,
+                args.workers, outbox, manifest, args.bulk_size,
+                args.upload_workers, get_visit_gap(args.visit_gap),
+                args.frames, checkpoints, args.full_scan,
+                args.upsert or args.follow, keywords
+            )
+        if args.follow:
+            follow(
+                data_dir, args.telescope_name,
+                names_dict, filters_dict, observers_dict,
+                args.workers, outbox, manifest, args.bulk_size,
+                args.upload_workers, get_visit_gap(args.visit_gap),
+                args.frames, checkpoints, args.poll_interval, args.poll,
+                keywords
+            )
         logger.info(f'Finished')
     except Exception as e:
         logger.error(f'Big Error!: {e}')
-        raise(e)
\ No newline at end of file
+        metrics.count('fatal_errors')
+        raise(e)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        logger.info(f'Metrics: {json.dumps(metrics.summary())}')
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json)
+        if args.prom_file:
+            metrics.write_prometheus(args.prom_file, telescope_label)
\ No newline at end of file